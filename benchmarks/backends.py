@@ -0,0 +1,226 @@
+#! /usr/bin/python3
+"""
+Compares the dbus-python/GLib and dbus-fast/asyncio backends.
+
+Each backend runs in its own process on a private dbus-daemon, exports the
+GATT application and then emits synthetic reports through the
+ReportCharacteristic, WINDOW reports per request so the daemon never drops
+signals. A client connection, using dbus-fast, counts the PropertiesChanged
+signals that arrive. Recorded per backend:
+startup time split into imports, connecting and exporting, RSS once exported,
+notification throughput seen by the client and server CPU per 1k reports.
+
+    python3 -m benchmarks.backends --reports 20000 --output bench_backends.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+
+from benchmarks.dbus_session import PrivateBus, rss_kib
+
+BACKENDS = ("glib", "asyncio")
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+WINDOW = 256
+
+
+def process_cpu(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def ready(start, imported, connected, exported, unique_name, path):
+    print(json.dumps({"import_ms": (imported - start) * 1000,
+                      "connect_ms": (connected - imported) * 1000,
+                      "export_ms": (exported - connected) * 1000,
+                      "unique_name": unique_name,
+                      "path": path}), flush=True)
+
+
+def find_report_characteristic(services, report_class):
+    for service in services:
+        for chrc in service.characteristics:
+            if isinstance(chrc, report_class):
+                return chrc
+    raise LookupError("ReportCharacteristic not found")
+
+
+def serve_glib(address):
+    start = time.perf_counter()
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+    from benchmarks.synthetic import synthetic_report
+    from core.ble_hid_keyboard import BleHidKeyboardApplication, ReportCharacteristic
+    imported = time.perf_counter()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    connected = time.perf_counter()
+    mainloop = GLib.MainLoop()
+    app = BleHidKeyboardApplication(bus, mainloop)
+    chrc = find_report_characteristic(app.services, ReportCharacteristic)
+    ready(start, imported, connected, time.perf_counter(), bus.get_unique_name(), chrc.path)
+
+    def command(source, condition):
+        words = sys.stdin.readline().split()
+        if not words or words[0] != "send":
+            mainloop.quit()
+            return False
+        for i in range(int(words[1]), int(words[2])):
+            chrc.send(synthetic_report(i))
+        return True
+
+    GLib.io_add_watch(sys.stdin.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, command)
+    mainloop.run()
+
+
+async def serve_asyncio(address):
+    start = time.perf_counter()
+    from dbus_fast.aio import MessageBus
+    from benchmarks.synthetic import synthetic_report
+    from core.aio_ble_hid_keyboard import BleHidKeyboardApplication, ReportCharacteristic
+    from core.event_loop import event_loop
+    imported = time.perf_counter()
+
+    loop = asyncio.get_running_loop()
+    event_loop.attach(loop)
+    bus = await MessageBus(bus_address=address).connect()
+    connected = time.perf_counter()
+    app = BleHidKeyboardApplication()
+    app.export(bus)
+    chrc = find_report_characteristic(app.services, ReportCharacteristic)
+    ready(start, imported, connected, time.perf_counter(), bus.unique_name, chrc.path)
+
+    stopped = loop.create_future()
+
+    def command():
+        words = sys.stdin.readline().split()
+        if not words or words[0] != "send":
+            loop.remove_reader(sys.stdin.fileno())
+            stopped.set_result(None)
+            return
+        for i in range(int(words[1]), int(words[2])):
+            chrc.send(synthetic_report(i))
+
+    loop.add_reader(sys.stdin.fileno(), command)
+    await stopped
+    bus.disconnect()
+
+
+def serve(backend, address):
+    # the event loop is picked from the configuration when core is imported
+    from core.config import config
+    config.config["Server"] = {"backend": backend}
+    if backend == "glib":
+        serve_glib(address)
+    else:
+        asyncio.run(serve_asyncio(address))
+
+
+async def start_server(backend, address):
+    """
+    Starts a server process exporting the application; returns it with its ready line,
+    or None with an error description.
+    """
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.backends", "--serve", backend, "--address", address,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    line = await server.stdout.readline()
+    if not line:
+        await server.wait()
+        error = (await server.stderr.read()).decode().strip().splitlines()
+        return None, {"error": error[-1] if error else f"exit status {server.returncode}"}
+    return server, json.loads(line)
+
+
+async def stop_server(server):
+    server.stdin.write(b"quit\n")
+    await server.stdin.drain()
+    await server.wait()
+
+
+async def measure(backend, address, count):
+    from dbus_fast import Message, MessageType
+    from dbus_fast.aio import MessageBus
+
+    spawned = time.perf_counter()
+    server, result = await start_server(backend, address)
+    if server is None:
+        return result
+    result["startup_ms"] = (time.perf_counter() - spawned) * 1000
+    result["rss_kib"] = rss_kib(server.pid)
+
+    client = await MessageBus(bus_address=address).connect()
+    received = 0
+    expected = 0
+    done = None
+
+    def handler(message):
+        nonlocal received
+        if message.message_type == MessageType.SIGNAL and message.member == "PropertiesChanged":
+            received += 1
+            if received == expected:
+                done.set_result(None)
+
+    client.add_message_handler(handler)
+    await client.call(Message(destination="org.freedesktop.DBus", path="/org/freedesktop/DBus",
+                              interface="org.freedesktop.DBus", member="AddMatch", signature="s",
+                              body=[f"type='signal',sender='{result.pop('unique_name')}',"
+                                    f"interface='{DBUS_PROP_IFACE}',path='{result.pop('path')}'"]))
+
+    cpu = process_cpu(server.pid)
+    start = time.perf_counter()
+    while expected < count:
+        first, expected = expected, min(count, expected + WINDOW)
+        done = asyncio.get_running_loop().create_future()
+        server.stdin.write(f"send {first} {expected}\n".encode())
+        await server.stdin.drain()
+        await done
+    elapsed = time.perf_counter() - start
+    result["reports"] = count
+    result["reports_per_sec"] = count / elapsed
+    result["cpu_ms_per_1k_reports"] = (process_cpu(server.pid) - cpu) * 1000 * 1000 / count
+    result["rss_kib_after"] = rss_kib(server.pid)
+
+    await stop_server(server)
+    client.disconnect()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reports", type=int, default=20000)
+    parser.add_argument("--backend", choices=BACKENDS, action="append", help="backends to run, default all")
+    parser.add_argument("--output", default="bench_backends.json")
+    parser.add_argument("--serve", choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument("--address", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.address)
+        return
+
+    results = {"benchmark": "backends", "time": time.time(),
+               "python": platform.python_version(), "machine": platform.machine()}
+    with PrivateBus() as private_bus:
+        for backend in args.backend or BACKENDS:
+            results[backend] = asyncio.run(measure(backend, private_bus.address, args.reports))
+            if "error" in results[backend]:
+                print(f"{backend}: {results[backend]['error']}")
+            else:
+                print(f"{backend}: startup {results[backend]['startup_ms']:.0f} ms, "
+                      f"RSS {results[backend]['rss_kib']} KiB, "
+                      f"{results[backend]['reports_per_sec']:.0f} reports/s")
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import os
+import subprocess
+
+
+class PrivateBus:
+    """
+    A private ``dbus-daemon --session`` for the duration of a ``with`` block.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.address = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+                                        stdout=subprocess.PIPE, text=True)
+        self.address = self.process.stdout.readline().strip()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        self.process.wait()
+
+    def cpu_time(self):
+        """
+        User + system CPU seconds consumed by the daemon so far.
+        """
+        with open(f"/proc/{self.process.pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_kib(pid="self"):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
@@ -0,0 +1,91 @@
+#! /usr/bin/python3
+"""
+Round-trip latency of the calls BlueZ makes during service discovery and reconnect.
+
+The GATT application of each backend is served on a private dbus-daemon (see
+benchmarks/backends.py) and a dbus-fast client times GetManagedObjects and
+ReadValue of the static characteristics, one call at a time.
+
+    python3 -m benchmarks.gatt_reads --calls 2000 --output bench_gatt_reads.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import time
+
+from benchmarks.backends import BACKENDS, start_server, stop_server
+from benchmarks.dbus_session import PrivateBus
+from core.gatt_profile import REPORT_MAP_CHARACTERISTIC_UUID, PNP_CHARACTERISTIC_UUID, \
+    HID_INFO_CHARACTERISTIC_UUID, BATTERY_LVL_UUID
+from core.tracing import percentiles
+
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+READS = {"ReportMap": REPORT_MAP_CHARACTERISTIC_UUID, "PnP": PNP_CHARACTERISTIC_UUID,
+         "HIDInfo": HID_INFO_CHARACTERISTIC_UUID, "BatteryLevel": BATTERY_LVL_UUID}
+
+
+def find_characteristic(objects, uuid):
+    for path, interfaces in objects.items():
+        chrc = interfaces.get(GATT_CHRC_IFACE)
+        if chrc is not None and chrc["UUID"].value == uuid:
+            return path
+    raise LookupError(f"Characteristic {uuid} not found")
+
+
+async def time_calls(client, message, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await client.call(message)
+        latencies.append(time.perf_counter() - start)
+    return percentiles(latencies)
+
+
+async def measure(backend, address, calls):
+    from dbus_fast import Message
+    from dbus_fast.aio import MessageBus
+
+    server, ready = await start_server(backend, address)
+    if server is None:
+        return ready
+    client = await MessageBus(bus_address=address).connect()
+    get_managed_objects = Message(destination=ready["unique_name"], path="/",
+                                  interface="org.freedesktop.DBus.ObjectManager", member="GetManagedObjects")
+    objects = (await client.call(get_managed_objects)).body[0]
+    result = {"objects": len(objects), "GetManagedObjects": await time_calls(client, get_managed_objects, calls)}
+    for name, uuid in READS.items():
+        read_value = Message(destination=ready["unique_name"], path=find_characteristic(objects, uuid),
+                             interface=GATT_CHRC_IFACE, member="ReadValue", signature="a{sv}", body=[{}])
+        result[f"ReadValue {name}"] = await time_calls(client, read_value, calls)
+    await stop_server(server)
+    client.disconnect()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--backend", choices=BACKENDS, action="append", help="backends to run, default all")
+    parser.add_argument("--output", default="bench_gatt_reads.json")
+    args = parser.parse_args()
+
+    results = {"benchmark": "gatt_reads", "time": time.time(),
+               "python": platform.python_version(), "machine": platform.machine()}
+    with PrivateBus() as private_bus:
+        for backend in args.backend or BACKENDS:
+            results[backend] = asyncio.run(measure(backend, private_bus.address, args.calls))
+            if "error" in results[backend]:
+                print(f"{backend}: {results[backend]['error']}")
+                continue
+            for call, latency in results[backend].items():
+                if isinstance(latency, dict):
+                    print(f"{backend} {call}: p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms")
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
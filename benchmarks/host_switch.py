@@ -0,0 +1,233 @@
+#! /usr/bin/python3
+"""
+Host switching latency.
+
+A server process exports the application for two adapters on a private
+dbus-daemon, with both hosts subscribed and the switching hotkey configured.
+Each round first holds a key and queues --backlog reports for the active host,
+then presses the hotkey. A client connection, using dbus-fast, measures the
+time from the hotkey press until the old host has been sent the release of all
+keys and the new host the held key, and compares it with the pacing interval.
+The server reports when it processed the hotkey; both processes use the
+system wide monotonic clock. When the old host already had a report sent in
+the current interval its release goes out with the next one, so a switch is
+counted as within one interval up to TIMER_SLACK_MS, the millisecond
+resolution of the event loop timers.
+
+    python3 -m benchmarks.host_switch --switches 200 --output bench_host_switch.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+
+from benchmarks.dbus_session import PrivateBus
+from benchmarks.backends import BACKENDS, DBUS_PROP_IFACE
+from core.tracing import percentiles
+
+ADAPTERS = ("/org/bluez/hci0", "/org/bluez/hci1")
+HOTKEY = "RCTRL+SCROLLLOCK"
+HELD_KEY = 0x04
+SOURCE = "benchmark"
+TIMER_SLACK_MS = 1.0
+
+
+class Switcher:
+    """
+    Feeds the reports of one round through the keyboards, as if they were typed.
+    """
+
+    def __init__(self, keyboards, report_fanout, apps):
+        from core.input_pipeline import parse_hotkey
+        self.keyboards = keyboards
+        self.report_fanout = report_fanout
+        self.modifiers, self.hotkey = parse_hotkey(HOTKEY)
+        keyboards.attach_source(SOURCE)
+        pipelines = [app.hid_service.pipeline for app in apps]
+        # subscribed without reading hidraw: reports only come from the benchmark
+        report_fanout.subscribed = pipelines
+        report_fanout.active = pipelines[0]
+        keyboards.set_event_callback(report_fanout.emit())
+        self.interval_ms = pipelines[0].scheduler.interval * 1000
+
+    def feed(self, report):
+        self.keyboards.on_reports([(SOURCE, bytes(report), 0.0, 0.0)])
+
+    def round(self, backlog):
+        for i in range(backlog):
+            self.feed([0, 0, HELD_KEY, 0x05 + i % 2, 0, 0, 0, 0])
+        pressed = time.monotonic()
+        self.feed([self.modifiers, 0, HELD_KEY, self.hotkey, 0, 0, 0, 0])
+        self.feed([0, 0, HELD_KEY, 0, 0, 0, 0, 0])
+        self.feed(bytes(8))
+        print(json.dumps({"pressed": pressed}), flush=True)
+
+
+def ready(app_paths, unique_name, interval_ms):
+    print(json.dumps({"unique_name": unique_name, "paths": app_paths, "interval_ms": interval_ms}), flush=True)
+
+
+def serve_glib(address):
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+    from core.ble_hid_keyboard import BleHidKeyboardApplication
+    from core.hidraw_keyboard import keyboards
+    from core.input_pipeline import report_fanout
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    mainloop = GLib.MainLoop()
+    apps = [BleHidKeyboardApplication(bus, mainloop, adapter, ADAPTERS) for adapter in ADAPTERS]
+    switcher = Switcher(keyboards, report_fanout, apps)
+    ready([app.hid_service.report.path for app in apps], bus.get_unique_name(), switcher.interval_ms)
+
+    def command(source, condition):
+        words = sys.stdin.readline().split()
+        if not words or words[0] != "switch":
+            mainloop.quit()
+            return False
+        switcher.round(int(words[1]))
+        return True
+
+    GLib.io_add_watch(sys.stdin.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, command)
+    mainloop.run()
+
+
+async def serve_asyncio(address):
+    from dbus_fast.aio import MessageBus
+    from core.aio_ble_hid_keyboard import BleHidKeyboardApplication
+    from core.event_loop import event_loop
+    from core.hidraw_keyboard import keyboards
+    from core.input_pipeline import report_fanout
+
+    loop = asyncio.get_running_loop()
+    event_loop.attach(loop)
+    bus = await MessageBus(bus_address=address).connect()
+    apps = [BleHidKeyboardApplication(adapter, ADAPTERS) for adapter in ADAPTERS]
+    for app in apps:
+        app.export(bus)
+    switcher = Switcher(keyboards, report_fanout, apps)
+    ready([app.hid_service.report.path for app in apps], bus.unique_name, switcher.interval_ms)
+
+    stopped = loop.create_future()
+
+    def command():
+        words = sys.stdin.readline().split()
+        if not words or words[0] != "switch":
+            loop.remove_reader(sys.stdin.fileno())
+            stopped.set_result(None)
+            return
+        switcher.round(int(words[1]))
+
+    loop.add_reader(sys.stdin.fileno(), command)
+    await stopped
+    bus.disconnect()
+
+
+def serve(backend, address):
+    # the event loop and the hotkey are picked from the configuration when core is imported
+    from core.config import config
+    config.config["Server"] = {"backend": backend}
+    config.config["Switching"] = {"hotkey": HOTKEY}
+    if backend == "glib":
+        serve_glib(address)
+    else:
+        asyncio.run(serve_asyncio(address))
+
+
+async def measure(backend, address, switches, backlog):
+    from dbus_fast import Message, MessageType
+    from dbus_fast.aio import MessageBus
+
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.host_switch", "--serve", backend, "--address", address,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    line = await server.stdout.readline()
+    if not line:
+        await server.wait()
+        error = (await server.stderr.read()).decode().strip().splitlines()
+        return {"error": error[-1] if error else f"exit status {server.returncode}"}
+    info = json.loads(line)
+    paths = info["paths"]
+
+    client = await MessageBus(bus_address=address).connect()
+    waiting = {}
+
+    def handler(message):
+        if message.message_type != MessageType.SIGNAL or message.member != "PropertiesChanged":
+            return
+        value = bytes(message.body[1]["Value"].value)
+        expected = waiting.get(message.path)
+        if expected is not None and expected[0](value) and not expected[1].done():
+            expected[1].set_result(time.monotonic())
+
+    client.add_message_handler(handler)
+    await client.call(Message(destination="org.freedesktop.DBus", path="/org/freedesktop/DBus",
+                              interface="org.freedesktop.DBus", member="AddMatch", signature="s",
+                              body=[f"type='signal',sender='{info['unique_name']}',"
+                                    f"interface='{DBUS_PROP_IFACE}'"]))
+
+    loop = asyncio.get_running_loop()
+    latencies = []
+    active = 0
+    for _ in range(switches):
+        old, new = paths[active], paths[1 - active]
+        released = loop.create_future()
+        resynced = loop.create_future()
+        waiting[old] = (lambda value: value == bytes(8), released)
+        waiting[new] = (lambda value: value[2] == HELD_KEY, resynced)
+        server.stdin.write(f"switch {backlog}\n".encode())
+        await server.stdin.drain()
+        pressed = json.loads(await server.stdout.readline())["pressed"]
+        done = await asyncio.gather(released, resynced)
+        latencies.append(max(done) - pressed)
+        active = 1 - active
+        # let the new host's queue drain before the next round
+        await asyncio.sleep(info["interval_ms"] * 8 / 1000)
+
+    server.stdin.write(b"quit\n")
+    await server.stdin.drain()
+    await server.wait()
+    client.disconnect()
+    interval = (info["interval_ms"] + TIMER_SLACK_MS) / 1000
+    return {"switches": switches, "backlog": backlog, "interval_ms": info["interval_ms"],
+            "switch_ms": percentiles(latencies), "max_ms": max(latencies) * 1000,
+            "within_interval": sum(1 for latency in latencies if latency <= interval) / len(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--switches", type=int, default=200)
+    parser.add_argument("--backlog", type=int, default=32, help="reports queued for the old host before a switch")
+    parser.add_argument("--backend", choices=BACKENDS, action="append", help="backends to run, default all")
+    parser.add_argument("--output", default="bench_host_switch.json")
+    parser.add_argument("--serve", choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument("--address", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.address)
+        return
+
+    results = {"benchmark": "host_switch", "time": time.time(),
+               "python": platform.python_version(), "machine": platform.machine()}
+    with PrivateBus() as private_bus:
+        for backend in args.backend or BACKENDS:
+            result = results[backend] = asyncio.run(measure(backend, private_bus.address, args.switches,
+                                                            args.backlog))
+            if "error" in result:
+                print(f"{backend}: {result['error']}")
+            else:
+                print(f"{backend}: switch p50 {result['switch_ms']['p50']:.2f} ms, "
+                      f"p99 {result['switch_ms']['p99']:.2f} ms, max {result['max_ms']:.2f} ms, "
+                      f"{result['within_interval'] * 100:.0f}% within one {result['interval_ms']} ms interval")
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+"""
+Microbenchmark of the hidraw read -> report value path.
+
+Reports are replayed through a SOCK_SEQPACKET socketpair, which keeps report
+boundaries the way a hidraw node does. The "before" path is the original
+os.read/dbus.Array/f-string log sequence, the "after" path is read_reports() of the input reader and
+Keyboards.on_reports feeding ReportFilter, ReportMerger and the ValueCache used
+by ReportCharacteristic.send, without the thread handoff. The "read" path is
+read_reports() alone, the part of the "after" path that replaces os.read.
+Signal emission itself is not part of this benchmark. Without dbus-python
+the paths stop before the value is marshalled.
+
+The "after" path is slower than "before": it filters and merges the reports,
+which the baseline did not do at all. What it keeps on the heap per report is
+the copy of the report and the item queued for it, less than the buffer
+os.read allocates in the baseline.
+
+    python3 -m benchmarks.hot_path [--no-tracemalloc] [reports]
+
+Reports per second are only meaningful with --no-tracemalloc: tracing every
+allocation slows the paths down several times, and unevenly.
+"""
+import logging
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+from benchmarks.synthetic import BOOT_KEYBOARD_DESCRIPTOR, synthetic_reports
+from core.config import config
+
+try:
+    import dbus
+    import dbus.service
+    from core.ble_dbus import ValueCache
+except ImportError:
+    # without dbus-python the reports are read and filtered but not marshalled,
+    # and the input path runs on the asyncio event loop
+    dbus = None
+    config.config["Server"] = {"backend": "asyncio"}
+
+from core.hidraw_keyboard import Keyboard, Keyboards
+from core.input_reader import read_reports
+
+BATCH = 64
+
+
+def replay(reports, step):
+    writer, reader = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    reader.setblocking(False)
+    tracing = tracemalloc.is_tracing()
+    peaks = 0
+    start = time.perf_counter()
+    for i in range(0, len(reports), BATCH):
+        for report in reports[i:i + BATCH]:
+            writer.send(report)
+        if tracing:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            step(reader)
+            peaks += tracemalloc.get_traced_memory()[1] - base
+        else:
+            step(reader)
+    elapsed = time.perf_counter() - start
+    writer.close()
+    reader.close()
+    return elapsed, peaks
+
+
+def before(reports):
+    def emit(data):
+        logging.info("Send key")
+        if dbus is not None:
+            {"Value": dbus.Array(data, signature=dbus.Signature("y"))}
+
+    def step(reader):
+        while True:
+            try:
+                data = os.read(reader.fileno(), 4096)
+            except BlockingIOError:
+                break
+            emit(data)
+
+    return replay(reports, step)
+
+
+def read_only(reports):
+    keyboard = Keyboard("bench", "bench", list(BOOT_KEYBOARD_DESCRIPTOR))
+
+    def step(reader):
+        if keyboard.file is None:
+            keyboard.file = open(reader.fileno(), "r+b", buffering=0, closefd=False)
+        read_reports(keyboard, [], 0.0)
+
+    return replay(reports, step)
+
+
+def after(reports):
+    keyboards = Keyboards()
+    keyboards.set_event_callback(ValueCache().get if dbus is not None else lambda report: None)
+    keyboard = Keyboard("bench", "bench", list(BOOT_KEYBOARD_DESCRIPTOR))
+
+    def step(reader):
+        if keyboard.file is None:
+            keyboard.file = open(reader.fileno(), "r+b", buffering=0, closefd=False)
+            keyboards.keyboards[keyboard.dev_node] = keyboard
+        batch = []
+        read_reports(keyboard, batch, 0.0)
+        keyboards.on_reports(batch)
+
+    return replay(reports, step)
+
+
+def main():
+    args = sys.argv[1:]
+    trace = "--no-tracemalloc" not in args
+    args = [arg for arg in args if arg != "--no-tracemalloc"]
+    count = int(args[0]) if args else 200000
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+    reports = synthetic_reports(count)
+    if dbus is None:
+        print("dbus-python is not installed, values are not marshalled")
+    if trace:
+        tracemalloc.start()
+    for name, run in (("before", before), ("read", read_only), ("after", after)):
+        elapsed, peaks = run(reports)
+        heap = f", {peaks / count:7.1f} heap bytes/report" if trace else ""
+        print(f"{name:>6}: {count / elapsed:10.0f} reports/s{heap}")
+    if trace:
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#! /usr/bin/python3
+"""
+Hotplug churn stress test for the keyboard lifecycle.
+
+Fake udev add/remove events for keyboards and non-keyboard devices are fed to
+Keyboards.on_device_event thousands of times. The device nodes are FIFOs, so
+attach() opens real fds and registers them with the input reader's epoll. After a warm-up, the
+number of open fds and the RSS must stay flat; the exit status is 1 otherwise.
+
+    python3 -m benchmarks.hotplug_stress --cycles 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from gi.repository import GLib
+
+from benchmarks.dbus_session import rss_kib
+from benchmarks.synthetic import BOOT_KEYBOARD_DESCRIPTOR
+from core.device_cache import DeviceCache
+from core.hidraw_keyboard import Keyboards
+
+MOUSE_DESCRIPTOR = bytes.fromhex(
+    "05010902a1010901a10005091901290315002501950375018102950175058103050109300931150081257f750895028106c0c0")
+RSS_SLACK_KIB = 512
+
+
+class FakeHidDevice:
+    def __init__(self, hid_id, name, descriptor):
+        self.properties = {"HID_ID": hid_id, "HID_NAME": name}
+        self.attributes = {"report_descriptor": descriptor}
+
+
+class FakeHidrawDevice:
+    def __init__(self, device_node, parent):
+        self.device_node = device_node
+        self.parent = parent
+
+    def find_parent(self, subsystem):
+        return self.parent if subsystem == "hid" else None
+
+    def __str__(self):
+        return f"FakeHidrawDevice({self.device_node})"
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=5000)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=200)
+    args = parser.parse_args()
+
+    context = GLib.MainContext.default()
+    with tempfile.TemporaryDirectory() as tmp:
+        keyboards = Keyboards()
+        keyboards.device_cache = DeviceCache(os.path.join(tmp, "devices.json"))
+        keyboards.set_event_callback(lambda report: None)
+        devices = []
+        for i in range(args.devices):
+            node = os.path.join(tmp, f"hidraw{i}")
+            os.mkfifo(node)
+            if i % 2:
+                parent = FakeHidDevice(f"0003:0000046D:0000C0{i:02X}", f"Mouse {i}", MOUSE_DESCRIPTOR)
+            else:
+                parent = FakeHidDevice(f"0003:00001D6B:000001{i:02X}", f"Keyboard {i}", BOOT_KEYBOARD_DESCRIPTOR)
+            devices.append(FakeHidrawDevice(node, parent))
+
+        baseline = None
+        for cycle in range(args.cycles):
+            for device in devices:
+                keyboards.on_device_event("add", device)
+            # a duplicate add must replace, not leak, the existing keyboard
+            keyboards.on_device_event("add", devices[0])
+            while context.iteration(False):
+                pass
+            for device in devices:
+                keyboards.on_device_event("remove", device)
+            if cycle == min(args.warmup, args.cycles - 1):
+                baseline = (open_fds(), rss_kib())
+
+        # the LED writer of a removed device closes its descriptor on its own thread
+        deadline = time.monotonic() + 1
+        while any(thread.name.startswith("LedWriter") for thread in threading.enumerate()) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+        fds, rss = open_fds(), rss_kib()
+        print(f"{args.cycles} cycles x {args.devices} devices: fds {baseline[0]} -> {fds}, "
+              f"RSS {baseline[1]} -> {rss} KiB, resources {keyboards.resources()}")
+        ok = fds == baseline[0] and rss - baseline[1] <= RSS_SLACK_KIB \
+            and keyboards.resources() == {"keyboards": 0, "files": 0, "watches": 0, "led_fds": 0}
+        keyboards.close()
+    if not ok:
+        print("FAILED: resources leaked")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#! /usr/bin/python3
+"""
+Hardware-free benchmark of the hidraw -> GATT notification pipeline.
+
+Synthetic keyboard reports are written to a SOCK_SEQPACKET socketpair (or to a
+/dev/uhid virtual keyboard with --source uhid), read by Keyboards and emitted
+by the ReportCharacteristic of a BleHidKeyboardApplication exported on a
+private dbus-daemon. A second connection to that daemon subscribes to
+PropertiesChanged, so latency is measured from the write to the signal
+arriving at a client.
+
+    python3 -m benchmarks.pipeline --reports 100000 --soak 1000000 --output bench_output.json
+"""
+import argparse
+import json
+import platform
+import socket
+import threading
+import time
+
+import dbus
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+from benchmarks.dbus_session import PrivateBus, rss_kib
+from benchmarks.synthetic import BOOT_KEYBOARD_DESCRIPTOR, synthetic_report
+from benchmarks.uhid import UhidDevice
+from core.ble_dbus import DBUS_PROP_IFACE
+from core.ble_hid_keyboard import BleHidKeyboardApplication, ReportCharacteristic
+from core.hidraw_keyboard import Keyboard, keyboards
+from core.tracing import percentiles
+
+IN_FLIGHT = 32
+
+
+class SocketSource:
+    def __init__(self):
+        self.writer, self.reader = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        keyboard = Keyboard("bench0", "Synthetic keyboard", list(BOOT_KEYBOARD_DESCRIPTOR))
+        keyboard.file = open(self.reader.fileno(), "r+b", buffering=0, closefd=False)
+        keyboards.attach(keyboard)
+
+    def send(self, report):
+        self.writer.send(report)
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+
+class UhidSource:
+    def __init__(self):
+        self.device = UhidDevice("ble-hid-keyboard benchmark", BOOT_KEYBOARD_DESCRIPTOR)
+        keyboards.on_add(self.device.find_hidraw(keyboards.context))
+
+    def send(self, report):
+        self.device.send(report)
+
+    def close(self):
+        self.device.close()
+
+
+class Run:
+    def __init__(self, source, count, rss_every=0):
+        self.source = source
+        self.count = count
+        self.rss_every = rss_every
+        self.sent_at = []
+        self.latencies = []
+        self.rss = []
+        self.window = threading.Semaphore(IN_FLIGHT)
+        self.elapsed = 0.0
+        self.cpu = 0.0
+
+    def feed(self):
+        for i in range(self.count):
+            self.window.acquire()
+            self.sent_at.append(time.perf_counter())
+            self.source.send(synthetic_report(i))
+
+    def received(self, interface, changed, invalidated):
+        now = time.perf_counter()
+        received = len(self.latencies)
+        self.latencies.append(now - self.sent_at[received])
+        self.window.release()
+        received += 1
+        if self.rss_every and received % self.rss_every == 0:
+            self.rss.append([received, rss_kib()])
+        if received == self.count:
+            self.mainloop.quit()
+
+    def run(self, mainloop):
+        self.mainloop = mainloop
+        feeder = threading.Thread(target=self.feed, daemon=True)
+        cpu = time.process_time()
+        start = time.perf_counter()
+        feeder.start()
+        mainloop.run()
+        self.elapsed = time.perf_counter() - start
+        self.cpu = time.process_time() - cpu
+        feeder.join()
+
+
+def find_report_characteristic(app):
+    for service in app.services:
+        for chrc in service.get_characteristics():
+            if isinstance(chrc, ReportCharacteristic):
+                return chrc
+    raise LookupError("ReportCharacteristic not found")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=("socket", "uhid"), default="socket")
+    parser.add_argument("--reports", type=int, default=100000)
+    parser.add_argument("--soak", type=int, default=1000000, help="reports in the memory soak, 0 to skip")
+    parser.add_argument("--interval-ms", type=float, default=0.0, help="pacing interval, 0 disables pacing")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    mainloop = GLib.MainLoop()
+    results = {"benchmark": "pipeline", "source": args.source, "time": time.time(),
+               "python": platform.python_version(), "machine": platform.machine()}
+
+    with PrivateBus() as private_bus:
+        bus = dbus.bus.BusConnection(private_bus.address)
+        client = dbus.bus.BusConnection(private_bus.address)
+        app = BleHidKeyboardApplication(bus, mainloop)
+        chrc = find_report_characteristic(app)
+        scheduler = app.hid_service.pipeline.scheduler
+        scheduler.configure(args.interval_ms, 1)
+        keyboards.set_event_callback(scheduler.submit)
+        source = UhidSource() if args.source == "uhid" else SocketSource()
+        try:
+            for name, count, rss_every in (("throughput", args.reports, 0),
+                                           ("soak", args.soak, max(1, args.soak // 100))):
+                if not count:
+                    continue
+                run = Run(source, count, rss_every)
+                receiver = client.add_signal_receiver(run.received, signal_name="PropertiesChanged",
+                                                      dbus_interface=DBUS_PROP_IFACE, path=chrc.path)
+                rss_before = rss_kib()
+                daemon_cpu = private_bus.cpu_time()
+                run.run(mainloop)
+                receiver.remove()
+                results[name] = {
+                    "reports": count,
+                    "reports_per_sec": count / run.elapsed,
+                    "latency_ms": percentiles(run.latencies),
+                    "max_latency_ms": max(run.latencies) * 1000,
+                    "cpu_ms_per_1k_reports": run.cpu * 1000 * 1000 / count,
+                    "dbus_daemon_cpu_ms_per_1k_reports": (private_bus.cpu_time() - daemon_cpu) * 1000 * 1000 / count,
+                    "rss_kib_before": rss_before,
+                    "rss_kib_after": rss_kib(),
+                    "rss_growth_kib": rss_kib() - rss_before,
+                }
+                if rss_every:
+                    results[name]["rss_kib_samples"] = run.rss
+                print(f"{name}: {results[name]['reports_per_sec']:.0f} reports/s, "
+                      f"p99 {results[name]['latency_ms']['p99']:.3f} ms, "
+                      f"RSS +{results[name]['rss_growth_kib']} KiB")
+        finally:
+            source.close()
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
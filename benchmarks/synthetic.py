@@ -0,0 +1,15 @@
+# Boot keyboard layout without a report ID, as sent by most USB keyboards
+BOOT_KEYBOARD_DESCRIPTOR = bytes.fromhex(
+    "05010906a101050719e029e715002501750195088102750895018101050875019505190129059102750395019101"
+    "050719002aff00150026ff00750895068100c0")
+
+
+def synthetic_report(i):
+    """
+    Alternating press/release of varying keys, so no report is filtered out.
+    """
+    return bytes([0, 0, 4 + (i // 2) % 26 if i % 2 == 0 else 0, 0, 0, 0, 0, 0])
+
+
+def synthetic_reports(count):
+    return [synthetic_report(i) for i in range(count)]
@@ -0,0 +1,46 @@
+import os
+import struct
+import time
+
+UHID_PATH = "/dev/uhid"
+UHID_DESTROY = 1
+UHID_CREATE2 = 11
+UHID_INPUT2 = 12
+BUS_USB = 0x03
+
+
+class UhidDevice:
+    """
+    Virtual HID device created through /dev/uhid, so input goes through a real hidraw node.
+    """
+
+    def __init__(self, name, descriptor, vendor=0x1d6b, product=0x0104):
+        self.name = name
+        self.fd = os.open(UHID_PATH, os.O_RDWR)
+        event = struct.pack("<I128s64s64sHHIIII", UHID_CREATE2, name.encode(), b"", b"",
+                            len(descriptor), BUS_USB, vendor, product, 0, 0)
+        os.write(self.fd, event + bytes(descriptor))
+
+    @staticmethod
+    def available():
+        return os.access(UHID_PATH, os.R_OK | os.W_OK)
+
+    def send(self, report):
+        os.write(self.fd, struct.pack("<IH", UHID_INPUT2, len(report)) + report)
+
+    def find_hidraw(self, context, timeout=5.0):
+        """
+        The udev hidraw device node created for this virtual device.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for device in context.list_devices(subsystem='hidraw'):
+                parent = device.find_parent('hid')
+                if parent is not None and parent.properties.get('HID_NAME') == self.name:
+                    return device
+            time.sleep(0.05)
+        raise TimeoutError(f"No hidraw node for {self.name}")
+
+    def close(self):
+        os.write(self.fd, struct.pack("<I", UHID_DESTROY))
+        os.close(self.fd)
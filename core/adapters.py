@@ -0,0 +1,50 @@
+"""
+Bluetooth adapters the keyboard is served on.
+
+[Bluetooth] adapters lists adapter names, e.g. ``hci0, hci1``, or is ``all``;
+without it the first adapter with a GATT manager is used. Every adapter gets a
+GATT application and an advertisement of its own.
+"""
+import logging
+
+from core.config import config
+
+OBJECT_PATH_BASE = "/org/bluez/BLEHidKeyBoard"
+DEFAULT_ADAPTER = "/org/bluez/hci0"
+
+
+def adapter_name(adapter):
+    return adapter.rsplit("/", 1)[-1]
+
+
+def select_adapters(adapters):
+    """
+    The configured adapters among the object paths of the adapters found.
+    """
+    adapters = sorted(adapters)
+    selected = config.get("Bluetooth", "adapters", "").strip()
+    if not selected:
+        return adapters[:1]
+    if selected == "all":
+        return adapters
+    names = [name.strip() for name in selected.split(",") if name.strip()]
+    by_name = {adapter_name(adapter): adapter for adapter in adapters}
+    for name in names:
+        if name not in by_name:
+            logging.warning(f"Adapter {name} not found, adapters: {', '.join(by_name)}")
+    return [by_name[name] for name in names if name in by_name]
+
+
+def object_paths(adapter, adapters):
+    """
+    (application path, object path prefix) of the application served on adapter.
+
+    A single adapter keeps the application at / and the services right under
+    OBJECT_PATH_BASE. With several adapters each application and its objects
+    live under OBJECT_PATH_BASE/<adapter>, so the object manager of one
+    application never reports the objects of another.
+    """
+    if len(adapters) == 1:
+        return "/", OBJECT_PATH_BASE
+    path = f"{OBJECT_PATH_BASE}/{adapter_name(adapter)}"
+    return path, path + "/"
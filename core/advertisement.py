@@ -2,7 +2,12 @@ import dbus
 import logging
 
 from core.ble_dbus import InvalidArgsException, DBUS_PROP_IFACE, BLUEZ_SERVICE_NAME
+from core.adapters import DEFAULT_ADAPTER
 from core.bluetooth_utils import enable_discovering
+from core.config import config
+from core.gatt_profile import LOCAL_NAME, ADVERTISED_SERVICE_UUIDS, APPEARANCE_KEYBOARD
+from core.reconnect import ReconnectAdvertising, advertising_timeout, includes
+from core.startup import startup
 
 LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
@@ -11,14 +16,18 @@ LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 class LEAdvertisement(dbus.service.Object):
     PATH_BASE = '/org/bluez/BLEHidKeyBoard/LEAdvertisement'
 
-    def __init__(self, bus, index, discoverable):
+    def __init__(self, bus, index, discoverable, adapter=DEFAULT_ADAPTER):
         self.path = self.PATH_BASE + str(index)
         self.bus = bus
+        self.adapter = adapter
         self.ad_type = "peripheral"
-        self.local_name = "BLE Keyboard"
-        self.service_uuids = ["1812", "180F"]
-        self.appearance = 0x03c1
+        self.local_name = config.get("Bluetooth", "name", LOCAL_NAME)
+        self.service_uuids = ADVERTISED_SERVICE_UUIDS
+        self.appearance = APPEARANCE_KEYBOARD
         self.discoverable = discoverable
+        self.manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter, introspect=False),
+                                      LE_ADVERTISING_MANAGER_IFACE)
+        self.reconnect = ReconnectAdvertising(adapter, self.update)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -27,6 +36,12 @@ class LEAdvertisement(dbus.service.Object):
         properties["ServiceUUIDs"] = dbus.Array(self.service_uuids, signature='s')
         properties["LocalName"] = dbus.String(self.local_name)
         properties["Appearance"] = dbus.UInt16(self.appearance)
+        min_interval, max_interval = self.reconnect.intervals()
+        properties["MinInterval"] = dbus.UInt32(min_interval)
+        properties["MaxInterval"] = dbus.UInt32(max_interval)
+        properties["Discoverable"] = dbus.Boolean(self.reconnect.discoverable(self.discoverable))
+        properties["Includes"] = dbus.Array(includes(), signature='s')
+        properties["Timeout"] = dbus.UInt16(advertising_timeout())
         return {LE_ADVERTISEMENT_IFACE: properties}
 
     def get_path(self):
@@ -42,23 +57,41 @@ class LEAdvertisement(dbus.service.Object):
     def Release(self):
         logging.info("%s: Released!" % self.path)
 
+    def register(self):
+        self.manager.RegisterAdvertisement(self, {},
+                                           reply_handler=self.register_ad_cb,
+                                           error_handler=self.register_ad_error_cb)
+
+    def config_changed(self):
+        name = config.get("Bluetooth", "name", LOCAL_NAME)
+        if name == self.local_name:
+            return
+        logging.info(f"Advertising as {name} on {self.adapter}")
+        self.local_name = name
+        self.update()
+
+    def update(self):
+        # BlueZ reads the advertisement's properties when it is registered
+        self.manager.UnregisterAdvertisement(self, reply_handler=self.register,
+                                             error_handler=lambda error: self.register())
+
     def register_ad_cb(self):
-        logging.info("Advertisement registered")
+        logging.info(f"Advertisement registered on {self.adapter}")
+        startup.mark("advertising")
         if self.discoverable:
             logging.info("Enable discovering")
-            enable_discovering(self.bus)
+            enable_discovering(self.bus, self.adapter)
 
     def register_ad_error_cb(self, error):
-        print(error.get_dbus_message())
-        logging.info("Failed to register advertisement: " + str(error))
+        logging.error(f"Failed to register advertisement on {self.adapter}: " + str(error))
 
 
-def register_advertisement(adapter, bus, discoverable):
-    manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter), LE_ADVERTISING_MANAGER_IFACE)
-    advertisement = LEAdvertisement(bus, 0, discoverable)
-    manager.RegisterAdvertisement(advertisement, {},
-                                  reply_handler=advertisement.register_ad_cb,
-                                  error_handler=advertisement.register_ad_error_cb)
+def register_advertisement(adapter, bus, discoverable, index=0):
+    advertisement = LEAdvertisement(bus, index, discoverable, adapter)
+    advertisement.register()
+    advertisement.reconnect.start()
+    config.watch("Bluetooth", advertisement.config_changed)
+    return advertisement
 
 
 
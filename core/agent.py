@@ -1,11 +1,11 @@
 import logging
 
 import dbus
-import keyboard
 
 from core.ble_dbus import BLUEZ_SERVICE_NAME
 
 from core.config import config
+from core.passkey import get_passkey, parse_passkey
 
 AGENT_IFACE = "org.bluez.Agent1"
 AGENT_MANAGER_IFACE = "org.bluez.AgentManager1"
@@ -20,7 +20,10 @@ class Agent(dbus.service.Object):
     @dbus.service.method(AGENT_IFACE, in_signature="o", out_signature="u")
     def RequestPasskey(self, device):
         logging.info(f"Requesting passkey {device}")
-        passkey = get_passkey()
+        passkey = parse_passkey(get_passkey())
+        if passkey is None:
+            logging.info("Passkey rejected: not a six digit number")
+            raise Rejected("Passkey is not a six digit number")
         return dbus.UInt32(passkey)
 
     @dbus.service.method(AGENT_IFACE, in_signature="", out_signature="")
@@ -38,23 +41,19 @@ class Rejected(dbus.DBusException):
     _dbus_error_name = "org.bluez.Error.Rejected"
 
 
-def get_passkey():
-    recorded = keyboard.record(until="enter")
-    passkey = ''
-    for i in range(len(recorded) - 2):
-        event = recorded[i]
-        if event.event_type == "down":
-            passkey = passkey + event.name
-    return passkey
-
-
 def register_agent(adapter, bus):
-    bluez = bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez")
+    bluez = bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez", introspect=False)
     manager = dbus.Interface(bluez, "org.bluez.AgentManager1")
 
 #    manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter), AGENT_MANAGER_IFACE)
     agent = Agent(bus, "KeyboardOnly")
-    manager.RegisterAgent(agent, agent.get_capability())
-    logging.info("Agent registered")
-    manager.RequestDefaultAgent(agent)
-    logging.info("Default Agent is Registered")
+
+    def registered():
+        logging.info("Agent registered")
+        manager.RequestDefaultAgent(agent, reply_handler=lambda: logging.info("Default Agent is Registered"),
+                                    error_handler=failed)
+
+    def failed(error):
+        logging.error("Failed to register agent: " + str(error))
+
+    manager.RegisterAgent(agent, agent.get_capability(), reply_handler=registered, error_handler=failed)
@@ -0,0 +1,219 @@
+"""
+GATT server objects for the asyncio backend, built on dbus-fast.
+
+Mirrors core/ble_dbus.py: the object paths and properties are the same, so
+BlueZ sees the same object tree whichever backend exports it.
+GetManagedObjects is answered by dbus-fast's ObjectManager for every exported
+path.
+"""
+import logging
+
+from dbus_fast import Message, MessageType, Variant, DBusError
+from dbus_fast.service import ServiceInterface, method, dbus_property, PropertyAccess
+
+from core.adapters import OBJECT_PATH_BASE, select_adapters
+from core.bluez_objects import bluez_objects
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+
+DBUS_IFACE = "org.freedesktop.DBus"
+DBUS_PATH = "/org/freedesktop/DBus"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+GATT_SERVICE_IFACE = "org.bluez.GattService1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
+
+NOT_SUPPORTED = "org.bluez.Error.NotSupported"
+
+
+class Service(ServiceInterface):
+
+    PATH_BASE = OBJECT_PATH_BASE
+
+    def __init__(self, uuid, primary, path_base=None):
+        ServiceInterface.__init__(self, GATT_SERVICE_IFACE)
+        # ServiceInterface keeps the interface name in self.name
+        self.path = (path_base or self.PATH_BASE) + self.__class__.__name__
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+
+    def export(self, bus):
+        bus.export(self.path, self)
+        for chrc in self.characteristics:
+            chrc.export(bus)
+
+    def ro_charateristic(self, name, uuid, value):
+        return ReadOnlyCharacteristic(name, self, uuid, value)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> "b":
+        return self.primary
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristics(self) -> "ao":
+        return [chrc.path for chrc in self.characteristics]
+
+
+class Characteristic(ServiceInterface):
+
+    def __init__(self, name, service, uuid, flags):
+        ServiceInterface.__init__(self, GATT_CHRC_IFACE)
+        self.object_name = name
+        self.path = service.path + name
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        self.bus = None
+
+    def export(self, bus):
+        self.bus = bus
+        bus.export(self.path, self)
+        for desc in self.descriptors:
+            bus.export(desc.path, desc)
+
+    def notify_value(self, value):
+        """
+        PropertiesChanged for Value, built directly instead of through the property table.
+        """
+        self.bus.send(Message(message_type=MessageType.SIGNAL, path=self.path, interface=DBUS_PROP_IFACE,
+                              member="PropertiesChanged", signature="sa{sv}as",
+                              body=[GATT_CHRC_IFACE, {"Value": Variant("ay", value)}, []]))
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> "o":
+        return self.service.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "as":
+        return self.flags
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Descriptors(self) -> "ao":
+        return [desc.path for desc in self.descriptors]
+
+    @method()
+    def ReadValue(self, options: "a{sv}") -> "ay":
+        return self.read_value(options)
+
+    @method()
+    def WriteValue(self, value: "ay", options: "a{sv}"):
+        self.write_value(value, options)
+
+    @method()
+    def StartNotify(self):
+        self.start_notify()
+
+    @method()
+    def StopNotify(self):
+        self.stop_notify()
+
+    def read_value(self, options):
+        logging.error("Default ReadValue called, returning error")
+        raise DBusError(NOT_SUPPORTED, "ReadValue is not supported")
+
+    def write_value(self, value, options):
+        logging.error("Default WriteValue called, returning error")
+        raise DBusError(NOT_SUPPORTED, "WriteValue is not supported")
+
+    def start_notify(self):
+        logging.error("Default StartNotify called, returning error")
+        raise DBusError(NOT_SUPPORTED, "StartNotify is not supported")
+
+    def stop_notify(self):
+        logging.error("Default StopNotify called, returning error")
+        raise DBusError(NOT_SUPPORTED, "StopNotify is not supported")
+
+
+class ReadOnlyCharacteristic(Characteristic):
+    def __init__(self, name, service, uuid, value):
+        Characteristic.__init__(self, name, service, uuid, ["read"])
+        self.value = value
+
+    def read_value(self, options):
+        return self.value
+
+
+class Descriptor(ServiceInterface):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+    """
+    def __init__(self, index, uuid, flags, characteristic):
+        ServiceInterface.__init__(self, GATT_DESC_IFACE)
+        self.path = characteristic.path + '/desc' + str(index)
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = characteristic
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristic(self) -> "o":
+        return self.chrc.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "as":
+        return self.flags
+
+    @method()
+    def ReadValue(self, options: "a{sv}") -> "ay":
+        return self.read_value(options)
+
+    def read_value(self, options):
+        raise DBusError(NOT_SUPPORTED, "ReadValue is not supported")
+
+
+async def call(bus, path, interface, member, signature="", body=None, destination=BLUEZ_SERVICE_NAME):
+    reply = await bus.call(Message(destination=destination, path=path, interface=interface, member=member,
+                                   signature=signature, body=body or []))
+    if reply.message_type == MessageType.ERROR:
+        raise DBusError(reply.error_name, reply.body[0] if reply.body else "")
+    return reply.body
+
+
+async def watch_bluez_objects(bus):
+    """
+    Keeps bluez_objects current from the signals of org.bluez.
+    """
+    owner, = await call(bus, DBUS_PATH, DBUS_IFACE, "GetNameOwner", "s", [BLUEZ_SERVICE_NAME], destination=DBUS_IFACE)
+
+    def handler(message):
+        if message.message_type != MessageType.SIGNAL or message.sender != owner:
+            return
+        if message.member == "PropertiesChanged":
+            bluez_objects.properties_changed(*message.body, path=message.path)
+        elif message.member == "InterfacesAdded":
+            bluez_objects.interfaces_added(*message.body)
+        elif message.member == "InterfacesRemoved":
+            bluez_objects.interfaces_removed(*message.body)
+
+    bus.add_message_handler(handler)
+    for interface in (DBUS_OM_IFACE, DBUS_PROP_IFACE):
+        await call(bus, DBUS_PATH, DBUS_IFACE, "AddMatch", "s",
+                   [f"type='signal',sender='{BLUEZ_SERVICE_NAME}',interface='{interface}'"], destination=DBUS_IFACE)
+
+
+async def find_adapters(bus):
+    # subscribed before the objects are read, so no change in between is missed
+    await watch_bluez_objects(bus)
+    objects, = await call(bus, "/", DBUS_OM_IFACE, "GetManagedObjects")
+    bluez_objects.load(objects)
+    return select_adapters(bluez_objects.paths(GATT_MANAGER_IFACE))
+
+
+async def set_adapter_property(bus, adapter, name, value):
+    await call(bus, adapter, DBUS_PROP_IFACE, "Set", "ssv", ["org.bluez.Adapter1", name, Variant("b", value)])
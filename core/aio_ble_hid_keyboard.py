@@ -0,0 +1,307 @@
+import asyncio
+import logging
+
+from dbus_fast import DBusError
+from dbus_fast.service import ServiceInterface, method
+
+from core.adapters import DEFAULT_ADAPTER, adapter_name, object_paths
+from core.aio_ble_dbus import Service, Characteristic, Descriptor, call, GATT_MANAGER_IFACE
+from core.battery import battery
+from core.bluez_objects import bluez_objects
+from core.gatt_profile import HID_REPORT_DESCRIPTOR, BATTERY_SERVICE_UUID, BATTERY_LVL_UUID, \
+    DEVICE_INFO_SERVICE_UUID, VENDOR_CHARACTERISTIC_UUID, PRODUCT_CHARACTERISTIC_UUID, VERSION_CHARACTERISTIC_UUID, \
+    PNP_CHARACTERISTIC_UUID, HID_SERVICE_UUID, PROTOCOL_MODE_CHARACTERISTIC_UUID, HID_INFO_CHARACTERISTIC_UUID, \
+    CONTROL_POINT_CHARACTERISTIC_UUID, REPORT_MAP_CHARACTERISTIC_UUID, REPORT_CHARACTERISTIC_UUID, APPLICATION_IFACE, \
+    BOOT_KEYBOARD_INPUT_REPORT_UUID, BOOT_KEYBOARD_OUTPUT_REPORT_UUID, PROTOCOL_MODES, \
+    PNP_ID, VENDOR, PRODUCT, VERSION, HID_INFO, PROTOCOL_MODE_REPORT, REPORT_REFERENCE_INPUT, \
+    REPORT_REFERENCE_OUTPUT
+from core.hidraw_keyboard import keyboards
+from core.input_pipeline import InputPipeline, adapter_stats, report_fanout
+from core.log import EventRate
+from core.startup import startup
+from core.text_typer import compile_text, compile_macro
+from core.tracing import tracer
+
+
+class BleHidKeyboardApplication(ServiceInterface):
+    """
+    The HID keyboard GATT application exported with dbus-fast.
+    """
+
+    def __init__(self, adapter=DEFAULT_ADAPTER, adapters=(DEFAULT_ADAPTER,)):
+        ServiceInterface.__init__(self, APPLICATION_IFACE)
+        self.path, path_base = object_paths(adapter, adapters)
+        self.adapter = adapter
+        self.hid_service = HIDService(adapter_name(adapter), path_base)
+        self.services = [self.hid_service, DeviceInfoService(path_base), BatteryService(path_base)]
+
+    def export(self, bus):
+        bus.export(self.path, self)
+        for service in self.services:
+            service.export(bus)
+
+    @method()
+    def GetLatencyStats(self) -> "a{sa{sa{sd}}}":
+        return tracer.stats()
+
+    @method()
+    def GetBatteryStats(self) -> "a{sd}":
+        return battery.stats()
+
+    @method()
+    def GetAdapterStats(self) -> "a{sa{sd}}":
+        return adapter_stats()
+
+    @method()
+    def SwitchHost(self, adapter: "s"):
+        try:
+            report_fanout.switch_to(adapter)
+        except ValueError as e:
+            raise DBusError("org.freedesktop.DBus.Error.InvalidArgs", str(e))
+
+    @method()
+    async def TypeText(self, text: "s", layout: "s") -> "a{sd}":
+        return await self.type(compile_text, text, layout)
+
+    @method()
+    async def TypeMacro(self, script: "s", layout: "s") -> "a{sd}":
+        return await self.type(compile_macro, script, layout)
+
+    async def type(self, compile, text, layout):
+        pipeline = self.hid_service.pipeline
+        if not pipeline.subscribed:
+            raise DBusError("org.bluez.Error.NotPermitted", "No host is subscribed to keyboard reports")
+        try:
+            sequence = compile(text, layout)
+        except ValueError as e:
+            raise DBusError("org.freedesktop.DBus.Error.InvalidArgs", str(e))
+        if pipeline.typer.busy():
+            raise DBusError("org.bluez.Error.Failed", "Typing is in progress")
+        done = asyncio.get_running_loop().create_future()
+        pipeline.typer.type(sequence, done.set_result,
+                            lambda message: done.set_exception(DBusError("org.bluez.Error.Failed", message)))
+        stats = await done
+        return {name: float(value) for name, value in stats.items()}
+
+
+class BatteryService(Service):
+    def __init__(self, path_base=None):
+        Service.__init__(self, BATTERY_SERVICE_UUID, True, path_base)
+        self.characteristics = [BatteryLevelCharacteristic(self)]
+
+
+class BatteryLevelCharacteristic(Characteristic):
+    def __init__(self, service):
+        Characteristic.__init__(self, self.__class__.__name__, service, BATTERY_LVL_UUID, ["read", "notify"])
+        self.notifying = False
+
+    def send_level(self, level):
+        if self.notifying:
+            self.notify_value(bytes([level]))
+
+    def read_value(self, options):
+        level = battery.read()
+        logging.debug("Battery Level read: " + repr(level))
+        return bytes([level])
+
+    def start_notify(self):
+        logging.info("Start Battery Notify")
+        self.notifying = True
+        battery.subscribe(self)
+
+    def stop_notify(self):
+        logging.info("Stop Battery Notify")
+        self.notifying = False
+        battery.unsubscribe(self)
+
+
+class DeviceInfoService(Service):
+    def __init__(self, path_base=None):
+        Service.__init__(self, DEVICE_INFO_SERVICE_UUID, True, path_base)
+        self.characteristics = [self.ro_charateristic("PnP", PNP_CHARACTERISTIC_UUID, bytes.fromhex(PNP_ID)),
+                                self.ro_charateristic("Vendor", VENDOR_CHARACTERISTIC_UUID, VENDOR.encode()),
+                                self.ro_charateristic("Product", PRODUCT_CHARACTERISTIC_UUID, PRODUCT.encode()),
+                                self.ro_charateristic("Version", VERSION_CHARACTERISTIC_UUID, VERSION.encode())
+                                ]
+
+
+class HIDService(Service):
+
+    def __init__(self, name=adapter_name(DEFAULT_ADAPTER), path_base=None):
+        Service.__init__(self, HID_SERVICE_UUID, True, path_base)
+        self.report = ReportCharacteristic(self)
+        self.boot_input = BootKeyboardInputReportCharacteristic(self)
+        self.pipeline = InputPipeline(name, self.report.send, self.boot_input.send)
+        self.characteristics = [
+            ProtocolModeCharacteristic(self),
+            HIDInfoCharacteristic(self),
+            ControlPointCharacteristic(self),
+            ReportMapCharacteristic(self),
+            self.report,
+            LedReportCharacteristic(self),
+            self.boot_input,
+            BootKeyboardOutputReportCharacteristic(self)
+        ]
+
+
+class ProtocolModeCharacteristic(Characteristic):
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.__class__.__name__,
+                                service, PROTOCOL_MODE_CHARACTERISTIC_UUID, ["read", "write-without-response"])
+        self.value = bytes.fromhex(PROTOCOL_MODE_REPORT)
+
+    def read_value(self, options):
+        return self.value
+
+    def write_value(self, value, options):
+        logging.info(f"Write {self.object_name}: {value.hex()}")
+        if len(value) != 1:
+            raise DBusError("org.bluez.Error.InvalidValueLength", "Protocol mode is one byte")
+        mode = value.hex()
+        if mode not in PROTOCOL_MODES:
+            raise DBusError("org.bluez.Error.NotSupported", f"Unknown protocol mode {mode}")
+        self.value = bytes(value)
+        self.service.pipeline.set_protocol_mode(mode)
+
+
+class HIDInfoCharacteristic(Characteristic):
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.__class__.__name__,
+                                service, HID_INFO_CHARACTERISTIC_UUID, ['secure-read'])
+        self.value = bytes.fromhex(HID_INFO)
+
+    def read_value(self, options):
+        return self.value
+
+
+class ReportMapCharacteristic(Characteristic):
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.__class__.__name__, service, REPORT_MAP_CHARACTERISTIC_UUID, ['read'])
+        # USB HID Report Descriptor
+        self.value = bytes.fromhex(HID_REPORT_DESCRIPTOR)
+
+    def read_value(self, options):
+        bluez_objects.link(options)
+        return self.value
+
+
+class ControlPointCharacteristic(Characteristic):
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.__class__.__name__, service,
+                                CONTROL_POINT_CHARACTERISTIC_UUID, ["write-without-response"])
+        self.value = b"\x00"
+
+    def write_value(self, value, options):
+        logging.info(f"Write {self.object_name} {value.hex()}")
+        self.value = bytes(value)
+
+
+class InputReportCharacteristic(Characteristic):
+    """
+    Keyboard input report notified to the host; reads return the keys held right now.
+    """
+
+    def __init__(self, service, uuid):
+        Characteristic.__init__(self, self.__class__.__name__, service, uuid, ["secure-read", "notify"])
+        self.notifying = False
+        self.rate = EventRate(f"reports sent by {self.object_name}")
+
+    def send(self, data):
+        self.rate.hit()
+        if tracer.enabled:
+            trace = tracer.send_entry(data)
+            self.notify_value(data)
+            tracer.emitted(trace)
+        else:
+            self.notify_value(data)
+        return True
+
+    def read_value(self, options):
+        bluez_objects.link(options)
+        return bytes(keyboards.report_merger.current())
+
+    def start_notify(self):
+        if self.notifying:
+            logging.info(f"{self.object_name} is already notifying")
+            return
+        logging.info(f"Started {self.object_name} notifying")
+        self.notifying = True
+        self.service.pipeline.subscribe(self)
+
+    def stop_notify(self):
+        logging.info(f"Stop {self.object_name}")
+        if not self.notifying:
+            return
+        self.notifying = False
+        self.service.pipeline.unsubscribe(self)
+
+
+class ReportCharacteristic(InputReportCharacteristic):
+
+    def __init__(self, service):
+        InputReportCharacteristic.__init__(self, service, REPORT_CHARACTERISTIC_UUID)
+        self.descriptors = [Report1ReferenceDescriptor(1, self)]
+
+
+class BootKeyboardInputReportCharacteristic(InputReportCharacteristic):
+
+    def __init__(self, service):
+        InputReportCharacteristic.__init__(self, service, BOOT_KEYBOARD_INPUT_REPORT_UUID)
+
+
+class OutputReportCharacteristic(Characteristic):
+    """
+    Keyboard LED state written by the host, forwarded to the physical keyboards.
+    """
+
+    def __init__(self, service, uuid):
+        Characteristic.__init__(self, self.__class__.__name__, service, uuid,
+                                ["secure-read", "secure-write", "write-without-response"])
+
+    def read_value(self, options):
+        return bytes([keyboards.leds or 0])
+
+    def write_value(self, value, options):
+        logging.debug("Write %s: %s", self.object_name, value.hex())
+        bluez_objects.link(options)
+        if len(value) != 1:
+            raise DBusError("org.bluez.Error.InvalidValueLength", "LED report is one byte")
+        keyboards.set_leds(value[0])
+
+
+class LedReportCharacteristic(OutputReportCharacteristic):
+
+    def __init__(self, service):
+        OutputReportCharacteristic.__init__(self, service, REPORT_CHARACTERISTIC_UUID)
+        self.descriptors = [Report1ReferenceDescriptor(1, self, REPORT_REFERENCE_OUTPUT)]
+
+
+class BootKeyboardOutputReportCharacteristic(OutputReportCharacteristic):
+
+    def __init__(self, service):
+        OutputReportCharacteristic.__init__(self, service, BOOT_KEYBOARD_OUTPUT_REPORT_UUID)
+
+
+class Report1ReferenceDescriptor(Descriptor):
+    DESCRIPTOR_UUID = '2908'
+
+    def __init__(self, index, characteristic, reference=REPORT_REFERENCE_INPUT):
+        Descriptor.__init__(self, index, self.DESCRIPTOR_UUID, ['read'], characteristic)
+        self.value = bytes.fromhex(reference)
+
+    def read_value(self, options):
+        return self.value
+
+
+async def register_application(adapter, bus, adapters=None):
+    logging.info(f"Registering GATT application on {adapter}...")
+    app = BleHidKeyboardApplication(adapter, adapters or (adapter,))
+    app.export(bus)
+    await call(bus, adapter, GATT_MANAGER_IFACE, "RegisterApplication", "oa{sv}", [app.path, {}])
+    logging.info(f'GATT application registered on {adapter}')
+    startup.mark("GATT registered")
+    return app
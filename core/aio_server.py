@@ -0,0 +1,230 @@
+"""
+asyncio backend of the server: dbus-fast on an asyncio loop that also reads hidraw.
+
+Selected with [Server] backend = asyncio.
+"""
+import asyncio
+import logging
+import signal
+
+from dbus_fast import BusType, DBusError
+from dbus_fast.aio import MessageBus
+from dbus_fast.service import ServiceInterface, method, dbus_property, PropertyAccess
+
+from core.aio_ble_dbus import call, find_adapters, set_adapter_property
+from core.aio_ble_hid_keyboard import register_application
+from core.bluez_objects import bluez_objects, remember_pairing
+from core.config import config
+from core.event_loop import event_loop
+from core.gatt_profile import LOCAL_NAME, ADVERTISED_SERVICE_UUIDS, APPEARANCE_KEYBOARD
+from core.log import log_pipeline
+from core.reconnect import ReconnectAdvertising, advertising_timeout, includes
+from core.startup import startup
+from core.tracing import tracer
+
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+AGENT_IFACE = "org.bluez.Agent1"
+AGENT_MANAGER_IFACE = "org.bluez.AgentManager1"
+REJECTED = "org.bluez.Error.Rejected"
+
+
+class LEAdvertisement(ServiceInterface):
+    PATH_BASE = '/org/bluez/BLEHidKeyBoard/LEAdvertisement'
+
+    def __init__(self, bus, index, discoverable, adapter):
+        ServiceInterface.__init__(self, LE_ADVERTISEMENT_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.adapter = adapter
+        self.ad_type = "peripheral"
+        self.local_name = config.get("Bluetooth", "name", LOCAL_NAME)
+        self.service_uuids = ADVERTISED_SERVICE_UUIDS
+        self.appearance = APPEARANCE_KEYBOARD
+        self.discoverable = discoverable
+        # registrations in flight, kept so they are not garbage collected
+        self.tasks = set()
+        self.reconnect = ReconnectAdvertising(adapter, self.update)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Type(self) -> "s":
+        return self.ad_type
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceUUIDs(self) -> "as":
+        return self.service_uuids
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LocalName(self) -> "s":
+        return self.local_name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Appearance(self) -> "q":
+        return self.appearance
+
+    @dbus_property(access=PropertyAccess.READ)
+    def MinInterval(self) -> "u":
+        return self.reconnect.intervals()[0]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def MaxInterval(self) -> "u":
+        return self.reconnect.intervals()[1]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Discoverable(self) -> "b":
+        return self.reconnect.discoverable(self.discoverable)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Includes(self) -> "as":
+        return includes()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Timeout(self) -> "q":
+        return advertising_timeout()
+
+    @method()
+    def Release(self):
+        logging.info("%s: Released!" % self.path)
+
+    async def register(self):
+        try:
+            await call(self.bus, self.adapter, LE_ADVERTISING_MANAGER_IFACE, "RegisterAdvertisement", "oa{sv}",
+                       [self.path, {}])
+        except DBusError as error:
+            logging.error(f"Failed to register advertisement on {self.adapter}: " + str(error))
+            return False
+        return True
+
+    async def reregister(self):
+        # BlueZ reads the advertisement's properties when it is registered
+        try:
+            await call(self.bus, self.adapter, LE_ADVERTISING_MANAGER_IFACE, "UnregisterAdvertisement", "o",
+                       [self.path])
+        except DBusError:
+            pass
+        await self.register()
+
+    def update(self):
+        task = asyncio.get_running_loop().create_task(self.reregister())
+        self.tasks.add(task)
+        task.add_done_callback(self.reregistered)
+
+    def reregistered(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Failed to register advertisement on {self.adapter}: " + str(task.exception()))
+
+    def config_changed(self):
+        name = config.get("Bluetooth", "name", LOCAL_NAME)
+        if name == self.local_name:
+            return
+        logging.info(f"Advertising as {name} on {self.adapter}")
+        self.local_name = name
+        self.update()
+
+
+class Agent(ServiceInterface):
+    def __init__(self, capability):
+        ServiceInterface.__init__(self, AGENT_IFACE)
+        self.path = "/org/bluez/BLEHidKeyBoard/Agent"
+        self.capability = capability
+
+    @method()
+    async def RequestPasskey(self, device: "o") -> "u":
+        logging.info(f"Requesting passkey {device}")
+        from core.passkey import get_passkey, parse_passkey
+        # keyboard.record() blocks, keep the loop serving input and D-Bus meanwhile
+        passkey = parse_passkey(await asyncio.get_running_loop().run_in_executor(None, get_passkey))
+        if passkey is None:
+            logging.info("Passkey rejected: not a six digit number")
+            raise DBusError(REJECTED, "Passkey is not a six digit number")
+        return passkey
+
+    @method()
+    def Cancel(self):
+        logging.info("Cancel")
+
+
+async def register_agent(bus):
+    agent = Agent("KeyboardOnly")
+    bus.export(agent.path, agent)
+    await call(bus, "/org/bluez", AGENT_MANAGER_IFACE, "RegisterAgent", "os", [agent.path, agent.capability])
+    logging.info("Agent registered")
+    await call(bus, "/org/bluez", AGENT_MANAGER_IFACE, "RequestDefaultAgent", "o", [agent.path])
+    logging.info("Default Agent is Registered")
+
+
+async def register_advertisement(adapter, bus, discoverable, index=0):
+    advertisement = LEAdvertisement(bus, index, discoverable, adapter)
+    bus.export(advertisement.path, advertisement)
+    config.watch("Bluetooth", advertisement.config_changed)
+    advertisement.reconnect.start()
+    if not await advertisement.register():
+        return
+    logging.info(f"Advertisement registered on {adapter}")
+    startup.mark("advertising")
+    if discoverable and not bluez_objects.discoverable(adapter):
+        logging.info("Enable discovering")
+        try:
+            await set_adapter_property(bus, adapter, "Discoverable", True)
+        except DBusError as error:
+            logging.error(f"Failed to make {adapter} discoverable: " + str(error))
+
+
+async def advertise(adapter, bus, discoverable, index):
+    if not bluez_objects.powered(adapter):
+        try:
+            await set_adapter_property(bus, adapter, "Powered", True)
+        except DBusError as error:
+            logging.error(f"Failed to power on {adapter}: " + str(error))
+            return
+    startup.mark("adapter ready")
+    await register_advertisement(adapter, bus, discoverable, index)
+
+
+async def main():
+    startup.mark("import")
+    loop = asyncio.get_running_loop()
+    event_loop.attach(loop)
+
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+    startup.mark("bus connect")
+    adapters = await find_adapters(bus)
+    if not adapters:
+        logging.error('GattManager1 interface not found')
+        return -1
+    logging.info(f"Serving adapters: {', '.join(adapters)}")
+
+    stopped = loop.create_future()
+    loop.add_signal_handler(signal.SIGINT, lambda: stopped.done() or stopped.set_result(None))
+    loop.add_signal_handler(signal.SIGUSR1, tracer.print)
+    loop.add_signal_handler(signal.SIGUSR2, log_pipeline.dump)
+
+    discoverable = not config.get_boolean("Bluetooth", "paired")
+    if discoverable:
+        bluez_objects.listeners.append(remember_pairing)
+    config.watch_file()
+    # every adapter is powered on and advertised, its application and the
+    # agent registered concurrently instead of one call after another; a
+    # registration that fails is logged and does not stop the others
+    registrations = {f"Advertising on {adapter}": advertise(adapter, bus, discoverable, index)
+                     for index, adapter in enumerate(adapters)}
+    registrations.update({f"Application on {adapter}": register_application(adapter, bus, adapters)
+                          for adapter in adapters})
+    if discoverable:
+        registrations["Agent"] = register_agent(bus)
+    results = await asyncio.gather(*registrations.values(), return_exceptions=True)
+    for name, result in zip(registrations, results):
+        if isinstance(result, Exception):
+            logging.error(f"{name} not registered: {result}")
+
+    await stopped
+    logging.info('SIGINT RECEIVED')
+    for adapter in adapters:
+        await set_adapter_property(bus, adapter, "Powered", False)
+    bus.disconnect()
+    return 0
+
+
+def run():
+    return asyncio.run(main())
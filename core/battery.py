@@ -0,0 +1,212 @@
+"""
+Battery level of the Battery service.
+
+[Battery] source selects where the level comes from:
+
+none  - always 100, for mains powered units
+sysfs - capacity of a power_supply battery, read from its udev change events
+file  - a number in [Battery] path, read when the file is written; a stand-in
+        for testing or for a fuel gauge read by another process
+
+Sources are event driven, nothing is polled, and they are only watched while
+a host is subscribed to the battery level. A new level is notified once it is
+at least [Battery] hysteresis percent away from the level notified last, or
+reaches empty or full, so a gauge wobbling around a value does not wake the
+radio.
+"""
+import logging
+import os
+import time
+
+import pyudev
+
+from core import inotify
+from core.config import config
+from core.event_loop import event_loop
+
+SOURCE_NONE = "none"
+SOURCE_SYSFS = "sysfs"
+SOURCE_FILE = "file"
+DEFAULT_HYSTERESIS = 2
+DEFAULT_PATH = "/run/ble-hid-keyboard/battery"
+FULL = 100
+
+
+class SysfsBatterySource:
+    """
+    Capacity of the power_supply named [Battery] supply, or of the first battery.
+    """
+
+    def __init__(self, supply=None):
+        self.context = pyudev.Context()
+        self.supply = supply
+        self.monitor = None
+        self.source = None
+        self.callback = None
+
+    def device(self):
+        if self.supply:
+            return pyudev.Devices.from_name(self.context, "power_supply", self.supply)
+        for device in self.context.list_devices(subsystem="power_supply"):
+            if device.attributes.get("type") == b"Battery":
+                self.supply = device.sys_name
+                return device
+        raise LookupError("No battery found")
+
+    def read(self):
+        try:
+            return self.device().attributes.asint("capacity")
+        except (LookupError, pyudev.DeviceNotFoundError, ValueError, OSError) as error:
+            logging.warning(f"Battery level is not available: {error}")
+            return None
+
+    def start(self, callback):
+        self.callback = callback
+        self.monitor = pyudev.Monitor.from_netlink(self.context)
+        self.monitor.filter_by(subsystem="power_supply")
+        self.monitor.start()
+        self.source = event_loop.io_add_watch(self.monitor.fileno(), self.on_event)
+
+    def stop(self):
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+        self.source = None
+        self.monitor = None
+
+    def on_event(self):
+        level = None
+        device = self.monitor.poll(timeout=0)
+        while device is not None:
+            capacity = device.properties.get("POWER_SUPPLY_CAPACITY")
+            if device.sys_name == self.supply and capacity is not None:
+                level = int(capacity)
+            device = self.monitor.poll(timeout=0)
+        self.callback(level)
+        return True
+
+
+class FileBatterySource:
+    """
+    Level written as a number to a file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.source = None
+        self.callback = None
+
+    def read(self):
+        try:
+            with open(self.path) as level_file:
+                return int(level_file.read().strip())
+        except (OSError, ValueError) as error:
+            logging.warning(f"Battery level is not available: {error}")
+            return None
+
+    def start(self, callback):
+        self.callback = callback
+        try:
+            self.fd = inotify.watch_file(self.path)
+        except OSError as error:
+            logging.warning(f"Battery level changes are not watched: {error}")
+            return
+        self.source = event_loop.io_add_watch(self.fd, self.on_event)
+
+    def stop(self):
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+            os.close(self.fd)
+        self.source = None
+        self.fd = None
+
+    def on_event(self):
+        changed = os.path.basename(self.path) in inotify.changed_names(self.fd)
+        self.callback(self.read() if changed else None)
+        return True
+
+
+def create_source():
+    name = config.get("Battery", "source", SOURCE_NONE)
+    if name == SOURCE_SYSFS:
+        return SysfsBatterySource(config.get("Battery", "supply", "") or None)
+    if name == SOURCE_FILE:
+        return FileBatterySource(config.get("Battery", "path", DEFAULT_PATH))
+    if name != SOURCE_NONE:
+        logging.warning(f"Unknown battery source {name}, reporting a full battery")
+    return None
+
+
+class BatteryMonitor:
+    """
+    Battery level notified to every subscribed host.
+    """
+
+    def __init__(self):
+        self.source = create_source()
+        self.level = FULL
+        self.notified = None
+        self.subscribers = []
+        self.hysteresis = DEFAULT_HYSTERESIS
+        # times the source woke the process, and levels notified
+        self.wakeups = 0
+        self.notifications = 0
+        self.started = time.monotonic()
+        self.configure()
+        config.watch("Battery", self.configure)
+
+    def configure(self):
+        self.hysteresis = max(1, config.get_int("Battery", "hysteresis", DEFAULT_HYSTERESIS))
+
+    def read(self):
+        """
+        Level read from the source now, the last known level when it cannot be read.
+        """
+        if self.source is not None:
+            level = self.source.read()
+            if level is not None:
+                self.level = min(FULL, max(0, level))
+        return self.level
+
+    def subscribe(self, characteristic):
+        if characteristic in self.subscribers:
+            return
+        if not self.subscribers and self.source is not None:
+            self.source.start(self.on_level)
+            logging.info("Watching the battery level")
+        self.subscribers.append(characteristic)
+        # the host reads the level when it subscribes
+        self.notified = self.read()
+
+    def unsubscribe(self, characteristic):
+        if characteristic not in self.subscribers:
+            return
+        self.subscribers.remove(characteristic)
+        if not self.subscribers and self.source is not None:
+            self.source.stop()
+            logging.info("Stopped watching the battery level")
+
+    def on_level(self, level):
+        self.wakeups += 1
+        if level is None:
+            return
+        self.level = min(FULL, max(0, level))
+        if self.notified is not None and abs(self.level - self.notified) < self.hysteresis \
+                and self.level not in (0, FULL):
+            return
+        if self.level == self.notified:
+            return
+        logging.info(f"Battery level {self.level}%")
+        self.notified = self.level
+        self.notifications += 1
+        for characteristic in self.subscribers:
+            characteristic.send_level(self.level)
+
+    def stats(self):
+        hours = (time.monotonic() - self.started) / 3600
+        return {"level": float(self.level), "wakeups": float(self.wakeups),
+                "wakeups_per_hour": self.wakeups / hours if hours else 0.0,
+                "notifications": float(self.notifications), "subscribed": float(len(self.subscribers))}
+
+
+battery = BatteryMonitor()
@@ -3,6 +3,9 @@ import logging
 import dbus
 import dbus.exceptions
 
+from core.adapters import OBJECT_PATH_BASE, select_adapters
+from core.bluez_objects import bluez_objects
+
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
 
@@ -13,53 +16,70 @@ GATT_SERVICE_IFACE = "org.bluez.GattService1"
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
 GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
 
+NO_INVALIDATED = dbus.Array([], signature="s")
+
 
 class Application(dbus.service.Object):
+    """
+    GATT application root.
 
-    def __init__(self, bus):
-        self.path = "/"
+    The object tree returned by GetManagedObjects is built on the first call
+    and reused: services, characteristics and descriptors are only created
+    with the application, and the properties listed hold no values, so the
+    tree does not change while the application is exported.
+    """
+
+    def __init__(self, bus, path="/"):
+        self.path = path
         self.services = []
+        self.managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def get_managed_objects(self):
+        if self.managed_objects is None:
+            response = dbus.Dictionary({}, signature="oa{sa{sv}}")
+            for service in self.services:
+                response[service.get_path()] = service.get_properties()
+                characteristics = service.get_characteristics()
+                for chrc in characteristics:
+                    response[chrc.get_path()] = chrc.get_properties()
+                    descriptors = chrc.get_descriptors()
+                    for desc in descriptors:
+                        response[desc.get_path()] = desc.get_properties()
+            self.managed_objects = response
+        return self.managed_objects
+
     @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
     def GetManagedObjects(self):
-        response = {}
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            characteristics = service.get_characteristics()
-            for chrc in characteristics:
-                response[chrc.get_path()] = chrc.get_properties()
-                descriptors = chrc.get_descriptors()
-                for desc in descriptors:
-                    response[desc.get_path()] = desc.get_properties()
-        return response
+        return self.get_managed_objects()
 
 
 class Service(dbus.service.Object):
 
-    PATH_BASE = "/org/bluez/BLEHidKeyBoard"
+    PATH_BASE = OBJECT_PATH_BASE
 
-    def __init__(self, bus, uuid, primary):
+    def __init__(self, bus, uuid, primary, path_base=None):
         self.name = self.__class__.__name__
         logging.info(f"NAME : {self.name}")
-        self.path = self.PATH_BASE + self.name
+        self.path = (path_base or self.PATH_BASE) + self.name
         self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_SERVICE_IFACE: {
+        if self.properties is None:
+            self.properties = properties(GATT_SERVICE_IFACE, {
                 "UUID": self.uuid,
-                "Primary": self.primary,
+                "Primary": dbus.Boolean(self.primary),
                 "Characteristics": dbus.Array(self.get_characteristic_paths(), signature="o")
-            }
-        }
+            })
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -94,19 +114,20 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.properties = None
         dbus.service.Object.__init__(self, service.bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
+        if self.properties is None:
+            self.properties = properties(GATT_CHRC_IFACE, {
                 "Service": self.service.get_path(),
                 "UUID": self.uuid,
-                "Flags": self.flags,
+                "Flags": dbus.Array(self.flags, signature="s"),
                 "Descriptors": dbus.Array(
                     self.get_descriptor_paths(),
                     signature="o")
-            }
-        }
+            })
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -121,7 +142,7 @@ class Characteristic(dbus.service.Object):
         return self.descriptors
 
     def properties_changed(self, values):
-        self.PropertiesChanged(GATT_CHRC_IFACE, values, [])
+        self.PropertiesChanged(GATT_CHRC_IFACE, values, NO_INVALIDATED)
 
     @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
     def GetAll(self, interface):
@@ -164,6 +185,27 @@ class ReadOnlyCharacteristic(Characteristic):
         return self.value
 
 
+class ValueCache:
+    """
+    Pre-marshalled ``{"Value": ay}`` property dicts keyed by value.
+
+    A keyboard only ever sends a small set of distinct reports, so reusing the
+    marshalled dict avoids building a new ``dbus.Array`` for every notification.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.values = {}
+
+    def get(self, value):
+        changed = self.values.get(value)
+        if changed is None:
+            if len(self.values) >= self.max_size:
+                self.values.clear()
+            changed = self.values[value] = {"Value": dbus.Array(value, signature=dbus.Signature("y"))}
+        return changed
+
+
 class Descriptor(dbus.service.Object):
     """
     org.bluez.GattDescriptor1 interface implementation
@@ -174,16 +216,17 @@ class Descriptor(dbus.service.Object):
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_DESC_IFACE: {
-                        'Characteristic': self.chrc.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                }
-        }
+        if self.properties is None:
+            self.properties = properties(GATT_DESC_IFACE, {
+                'Characteristic': self.chrc.get_path(),
+                'UUID': self.uuid,
+                'Flags': dbus.Array(self.flags, signature="s"),
+            })
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -201,15 +244,22 @@ class Descriptor(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
+        logging.error('Default ReadValue called, returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        logging.error('Default WriteValue called, returning error')
         raise NotSupportedException()
 
 
+def properties(interface, values):
+    """
+    ``{interface: {name: value}}`` with explicit signatures, so dbus-python does not guess types when marshalling.
+    """
+    return dbus.Dictionary({interface: dbus.Dictionary(values, signature="sv")}, signature="sa{sv}")
+
+
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
 
@@ -234,12 +284,21 @@ class Rejected(dbus.DBusException):
     _dbus_error_name = "org.bluez.Error.Rejected"
 
 
-def find_adapter(bus):
-    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
-
-    for o, props in objects.items():
-        if GATT_MANAGER_IFACE in props.keys():
-            return o
-
-    return None
+def watch_bluez_objects(bus):
+    """
+    Keeps bluez_objects current from the signals of org.bluez.
+    """
+    bus.add_signal_receiver(bluez_objects.interfaces_added, dbus_interface=DBUS_OM_IFACE,
+                            signal_name="InterfacesAdded", bus_name=BLUEZ_SERVICE_NAME)
+    bus.add_signal_receiver(bluez_objects.interfaces_removed, dbus_interface=DBUS_OM_IFACE,
+                            signal_name="InterfacesRemoved", bus_name=BLUEZ_SERVICE_NAME)
+    bus.add_signal_receiver(bluez_objects.properties_changed, dbus_interface=DBUS_PROP_IFACE,
+                            signal_name="PropertiesChanged", bus_name=BLUEZ_SERVICE_NAME, path_keyword="path")
+
+
+def find_adapters(bus):
+    # subscribed before the objects are read, so no change in between is missed
+    watch_bluez_objects(bus)
+    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/", introspect=False), DBUS_OM_IFACE)
+    bluez_objects.load(remote_om.GetManagedObjects())
+    return select_adapters(bluez_objects.paths(GATT_MANAGER_IFACE))
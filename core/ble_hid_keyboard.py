@@ -3,98 +3,164 @@ import signal
 
 import dbus
 
-from core.ble_dbus import Service, Characteristic, Application, BLUEZ_SERVICE_NAME, GATT_MANAGER_IFACE, Descriptor
+from core.ble_dbus import Service, Characteristic, Application, BLUEZ_SERVICE_NAME, GATT_MANAGER_IFACE, Descriptor, \
+    ValueCache, InvalidArgsException, NotPermittedException, FailedException, NotSupportedException, \
+    InvalidValueLengthException
+from core.adapters import DEFAULT_ADAPTER, adapter_name, object_paths
+from core.battery import battery
 from core.bluetooth_utils import turn_off
+from core.bluez_objects import bluez_objects
+from core.gatt_profile import HID_REPORT_DESCRIPTOR, BATTERY_SERVICE_UUID, BATTERY_LVL_UUID, \
+    DEVICE_INFO_SERVICE_UUID, VENDOR_CHARACTERISTIC_UUID, PRODUCT_CHARACTERISTIC_UUID, VERSION_CHARACTERISTIC_UUID, \
+    PNP_CHARACTERISTIC_UUID, HID_SERVICE_UUID, PROTOCOL_MODE_CHARACTERISTIC_UUID, HID_INFO_CHARACTERISTIC_UUID, \
+    CONTROL_POINT_CHARACTERISTIC_UUID, REPORT_MAP_CHARACTERISTIC_UUID, REPORT_CHARACTERISTIC_UUID, APPLICATION_IFACE, \
+    BOOT_KEYBOARD_INPUT_REPORT_UUID, BOOT_KEYBOARD_OUTPUT_REPORT_UUID, PROTOCOL_MODES, \
+    PNP_ID, VENDOR, PRODUCT, VERSION, HID_INFO, PROTOCOL_MODE_REPORT, REPORT_REFERENCE_INPUT, \
+    REPORT_REFERENCE_OUTPUT
 from core.hidraw_keyboard import keyboards
-
-#HID_REPORT_DESCRIPTOR = '05010906a1018501050719e029e71500250175019508810295017508810395057501050819012905910295017503910395067508150025ff0507190029ff8100c0'
-#HID_REPORT_DESCRIPTOR = '05010906a101050719e029e715002501750195088102750895018101050875019505190129059102750395019101050719002aff00150026ff00750895068100c0'
-HID_REPORT_DESCRIPTOR = "05010906a1018501050719e029e715002501750195088102750895018101050875019505190129059102750395019101050719002aff00150026ff00750895068100c0"
-#HID_REPORT_DESCRIPTOR = "05010906a101050719e029e715002501750195088102750895018101050875019505190129059102750395019101050719002aff00150026ff00750895068100c0"
-
-BATTERY_SERVICE_UUID = '180f'
-BATTERY_LVL_UUID = '2a19'
-DEVICE_INFO_SERVICE_UUID = '180A'
-VENDOR_CHARACTERISTIC_UUID = '2A29'
-PRODUCT_CHARACTERISTIC_UUID = '2A24'
-VERSION_CHARACTERISTIC_UUID = '2A28'
-PNP_CHARACTERISTIC_UUID = '2A50'
-HID_SERVICE_UUID = '1812'
-PROTOCOL_MODE_CHARACTERISTIC_UUID = '2A4E'
-HID_INFO_CHARACTERISTIC_UUID = '2A4A'
-CONTROL_POINT_CHARACTERISTIC_UUID = '2A4C'
-REPORT_MAP_CHARACTERISTIC_UUID = '2A4B'
-REPORT_CHARACTERISTIC_UUID = '2A4D'
+from core.log import EventRate, log_pipeline
+from core.input_pipeline import InputPipeline, adapter_stats, report_fanout
+from core.startup import startup
+from core.text_typer import compile_text, compile_macro
+from core.tracing import tracer
 
 
 class BleHidKeyboardApplication(Application):
-    def __init__(self, bus, mainloop):
-        Application.__init__(self, bus)
+    def __init__(self, bus, mainloop, adapter=DEFAULT_ADAPTER, adapters=(DEFAULT_ADAPTER,)):
+        path, path_base = object_paths(adapter, adapters)
+        Application.__init__(self, bus, path)
 #        self.services = [HIDService(bus), DeviceInfoService(bus), BatteryService(bus)]
-        self.services = [HIDService(bus), DeviceInfoService(bus), BatteryService(bus)]
+        self.hid_service = HIDService(bus, adapter_name(adapter), path_base)
+        self.services = [self.hid_service, DeviceInfoService(bus, path_base), BatteryService(bus, path_base)]
 
         self.mainloop = mainloop
         self.bus = bus
+        self.adapter = adapter
+        self.adapters = adapters
 
     def register_callback(self):
-        logging.info('GATT application registered')
+        logging.info(f'GATT application registered on {self.adapter}')
+        startup.mark("GATT registered")
 
     def error_callback(self, error):
-        logging.error('Failed to register application: ' + str(error))
+        logging.error(f'Failed to register application on {self.adapter}: ' + str(error))
         self.mainloop.quit()
 
+    @dbus.service.method(APPLICATION_IFACE, out_signature="a{sa{sa{sd}}}")
+    def GetLatencyStats(self):
+        return tracer.stats()
+
+    @dbus.service.method(APPLICATION_IFACE, out_signature="a{sd}")
+    def GetBatteryStats(self):
+        return battery.stats()
+
+    @dbus.service.method(APPLICATION_IFACE, out_signature="a{sa{sd}}")
+    def GetAdapterStats(self):
+        return adapter_stats()
+
+    @dbus.service.method(APPLICATION_IFACE, in_signature="s")
+    def SwitchHost(self, adapter):
+        try:
+            report_fanout.switch_to(adapter)
+        except ValueError as e:
+            raise InvalidArgsException(str(e))
+
+    @dbus.service.method(APPLICATION_IFACE, in_signature="ss", out_signature="a{sd}",
+                         async_callbacks=("reply", "error"))
+    def TypeText(self, text, layout, reply, error):
+        self.type(compile_text, text, layout, reply, error)
+
+    @dbus.service.method(APPLICATION_IFACE, in_signature="ss", out_signature="a{sd}",
+                         async_callbacks=("reply", "error"))
+    def TypeMacro(self, script, layout, reply, error):
+        self.type(compile_macro, script, layout, reply, error)
+
+    def type(self, compile, text, layout, reply, error):
+        pipeline = self.hid_service.pipeline
+        if not pipeline.subscribed:
+            raise NotPermittedException("No host is subscribed to keyboard reports")
+        try:
+            sequence = compile(text, layout)
+        except ValueError as e:
+            raise InvalidArgsException(str(e))
+        if pipeline.typer.busy():
+            raise FailedException("Typing is in progress")
+        pipeline.typer.type(sequence, reply, lambda message: error(FailedException(message)))
+
+    def sigusr1_handler(self, sig, frame):
+        tracer.print()
+
+    def sigusr2_handler(self, sig, frame):
+        log_pipeline.dump()
+
     def sigint_handler(self, sig, frame):
         logging.info("Signal Handler")
         if sig != signal.SIGINT:
             raise ValueError("Undefined handler for '{sig}'")
         else:
             logging.info('SIGINT RECEIVED')
-            turn_off(self.bus)
+            for adapter in self.adapters:
+                turn_off(self.bus, adapter)
             self.mainloop.quit()
 
 
 class BatteryService(Service):
-    def __init__(self, bus):
-        Service.__init__(self, bus, BATTERY_SERVICE_UUID, True)
+    def __init__(self, bus, path_base=None):
+        Service.__init__(self, bus, BATTERY_SERVICE_UUID, True, path_base)
         self.characteristics = [BatteryLevelCharacteristic(self)]
 
 
 class BatteryLevelCharacteristic(Characteristic):
     def __init__(self, service):
         Characteristic.__init__(self, self.__class__.__name__, service, BATTERY_LVL_UUID, ["read", "notify"])
-        self.battery_lvl = 100
+        self.notifying = False
+
+    def send_level(self, level):
+        if self.notifying:
+            self.properties_changed({"Value": dbus.Array([level], signature=dbus.Signature("y"))})
 
     def ReadValue(self, options):
-        logging.info("Battery Level read: " + repr(self.battery_lvl))
-        return [dbus.Byte(self.battery_lvl)]
+        level = battery.read()
+        logging.debug("Battery Level read: %d", level)
+        return dbus.Array([level], signature=dbus.Signature("y"))
 
     def StartNotify(self):
         logging.info("Start Battery Notify")
+        self.notifying = True
+        battery.subscribe(self)
 
     def StopNotify(self):
         logging.info("Stop Battery Notify")
+        self.notifying = False
+        battery.unsubscribe(self)
 
 
 class DeviceInfoService(Service):
-    def __init__(self, bus):
-        Service.__init__(self, bus, DEVICE_INFO_SERVICE_UUID, True)
-        self.characteristics = [self.ro_charateristic("PnP", PNP_CHARACTERISTIC_UUID, hex_2_dbus_array("02C41001000100")),
-                                self.ro_charateristic("Vendor", VENDOR_CHARACTERISTIC_UUID, str_2_dbus_array("artyomsoft")),
-                                self.ro_charateristic("Product", PRODUCT_CHARACTERISTIC_UUID, str_2_dbus_array("BLE Keyboard")),
-                                self.ro_charateristic("Version", VERSION_CHARACTERISTIC_UUID, str_2_dbus_array("1.0.0"))
+    def __init__(self, bus, path_base=None):
+        Service.__init__(self, bus, DEVICE_INFO_SERVICE_UUID, True, path_base)
+        self.characteristics = [self.ro_charateristic("PnP", PNP_CHARACTERISTIC_UUID, hex_2_dbus_array(PNP_ID)),
+                                self.ro_charateristic("Vendor", VENDOR_CHARACTERISTIC_UUID, str_2_dbus_array(VENDOR)),
+                                self.ro_charateristic("Product", PRODUCT_CHARACTERISTIC_UUID, str_2_dbus_array(PRODUCT)),
+                                self.ro_charateristic("Version", VERSION_CHARACTERISTIC_UUID, str_2_dbus_array(VERSION))
                                 ]
 
 
 class HIDService(Service):
 
-    def __init__(self, bus):
-        Service.__init__(self, bus, HID_SERVICE_UUID, True)
+    def __init__(self, bus, name=adapter_name(DEFAULT_ADAPTER), path_base=None):
+        Service.__init__(self, bus, HID_SERVICE_UUID, True, path_base)
+        self.report = ReportCharacteristic(self)
+        self.boot_input = BootKeyboardInputReportCharacteristic(self)
+        self.pipeline = InputPipeline(name, self.report.send, self.boot_input.send)
         self.characteristics = [
             ProtocolModeCharacteristic(self),
             HIDInfoCharacteristic(self),
             ControlPointCharacteristic(self),
             ReportMapCharacteristic(self),
-            ReportCharacteristic(self)
+            self.report,
+            LedReportCharacteristic(self),
+            self.boot_input,
+            BootKeyboardOutputReportCharacteristic(self)
         ]
 
 
@@ -103,16 +169,22 @@ class ProtocolModeCharacteristic(Characteristic):
     def __init__(self, service):
         Characteristic.__init__(self, self.__class__.__name__,
                                 service, PROTOCOL_MODE_CHARACTERISTIC_UUID, ["read", "write-without-response"])
-        self.value = hex_2_dbus_array("01")
+        self.value = hex_2_dbus_array(PROTOCOL_MODE_REPORT)
         logging.info(f"Created {self.name}: {self.value}")
 
     def ReadValue(self, options):
-        logging.info(f"Read {self.value}: {self.value}")
+        logging.debug("Read %s", self.name)
         return self.value
 
     def WriteValue(self, value, options):
-        logging.info(f"Write {self.value}: {value}")
-        self.value = value
+        logging.info(f"Write {self.name}: {value}")
+        if len(value) != 1:
+            raise InvalidValueLengthException()
+        mode = bytes(value).hex()
+        if mode not in PROTOCOL_MODES:
+            raise NotSupportedException()
+        self.value = hex_2_dbus_array(mode)
+        self.service.pipeline.set_protocol_mode(mode)
 
 
 class HIDInfoCharacteristic(Characteristic):
@@ -120,11 +192,11 @@ class HIDInfoCharacteristic(Characteristic):
     def __init__(self, service):
         Characteristic.__init__(self, self.__class__.__name__,
                                 service, HID_INFO_CHARACTERISTIC_UUID, ['secure-read'])
-        self.value = hex_2_dbus_array("01110002")
+        self.value = hex_2_dbus_array(HID_INFO)
         logging.info(f"Created {self.name} value: {self.value}")
 
     def ReadValue(self, options):
-        logging.info(f"Read {self.name}: {self.value}")
+        logging.debug("Read %s", self.name)
         return self.value
 
 
@@ -150,74 +222,136 @@ class ReportMapCharacteristic(Characteristic):
         logging.info(f"Created {self.name}: {self.value}")
 
     def ReadValue(self, options):
-        logging.info(f"Read {self.name}: {self.value}")
+        logging.debug("Read %s", self.name)
+        bluez_objects.link(options)
         return self.value
 
 
-class ReportCharacteristic(Characteristic):
+class InputReportCharacteristic(Characteristic):
+    """
+    Keyboard input report notified to the host; reads return the keys held right now.
+    """
 
-    def __init__(self, service):
-        Characteristic.__init__(self, self.__class__.__name__, service,
-                                REPORT_CHARACTERISTIC_UUID, ["secure-read", "notify"])
-        self.value = hex_2_dbus_array("000000000000")
-        self.descriptors = [Report1ReferenceDescriptor(service.bus, 1, self)]
-        logging.info(f"Created ReportCharacteristic: {self.value}")
+    def __init__(self, service, uuid):
+        Characteristic.__init__(self, self.__class__.__name__, service, uuid, ["secure-read", "notify"])
+        self.values = ValueCache()
+        self.notifying = False
+        self.rate = EventRate(f"reports sent by {self.name}")
 
     def send(self, data):
-        logging.info(f"Send key")
-        super().properties_changed({"Value": dbus.Array(data, signature=dbus.Signature("y"))})
+        self.rate.hit()
+        if tracer.enabled:
+            trace = tracer.send_entry(data)
+            self.properties_changed(self.values.get(data))
+            tracer.emitted(trace)
+        else:
+            self.properties_changed(self.values.get(data))
         return True
 
     def ReadValue(self, options):
-        logging.info(f"Read {self.name}: {self.value}")
-        return self.value
-
-    def WriteValue(self, value, options):
-        logging.info(f"Write {self.name}: {value}")
-        self.value = value
+        logging.debug("Read %s", self.name)
+        bluez_objects.link(options)
+        return self.values.get(keyboards.report_merger.current())["Value"]
 
     def StartNotify(self):
-        logging.info(f"Started ReportCharacteristic notifying")
-        keyboards.watch(self.send)
-        logging.info(f"Started HID keyboard watching")
+        if self.notifying:
+            logging.info(f"{self.name} is already notifying")
+            return
+        logging.info(f"Started {self.name} notifying")
+        self.notifying = True
+        self.service.pipeline.subscribe(self)
 
     def StopNotify(self):
-        logging.info(f"Stop Report Keyboard Input")
+        logging.info(f"Stop {self.name}")
+        if not self.notifying:
+            return
+        self.notifying = False
+        self.service.pipeline.unsubscribe(self)
+
+
+class ReportCharacteristic(InputReportCharacteristic):
+
+    def __init__(self, service):
+        InputReportCharacteristic.__init__(self, service, REPORT_CHARACTERISTIC_UUID)
+        self.descriptors = [Report1ReferenceDescriptor(service.bus, 1, self)]
+
+
+class BootKeyboardInputReportCharacteristic(InputReportCharacteristic):
+
+    def __init__(self, service):
+        InputReportCharacteristic.__init__(self, service, BOOT_KEYBOARD_INPUT_REPORT_UUID)
+
+
+class OutputReportCharacteristic(Characteristic):
+    """
+    Keyboard LED state written by the host, forwarded to the physical keyboards.
+    """
+
+    def __init__(self, service, uuid):
+        Characteristic.__init__(self, self.__class__.__name__, service, uuid,
+                                ["secure-read", "secure-write", "write-without-response"])
+
+    def ReadValue(self, options):
+        logging.debug("Read %s", self.name)
+        return dbus.Array([keyboards.leds or 0], signature=dbus.Signature("y"))
+
+    def WriteValue(self, value, options):
+        logging.debug("Write %s: %s", self.name, bytes(value).hex())
+        bluez_objects.link(options)
+        if len(value) != 1:
+            raise InvalidValueLengthException()
+        keyboards.set_leds(int(value[0]))
+
+
+class LedReportCharacteristic(OutputReportCharacteristic):
+
+    def __init__(self, service):
+        OutputReportCharacteristic.__init__(self, service, REPORT_CHARACTERISTIC_UUID)
+        self.descriptors = [Report1ReferenceDescriptor(service.bus, 1, self, REPORT_REFERENCE_OUTPUT)]
+
+
+class BootKeyboardOutputReportCharacteristic(OutputReportCharacteristic):
+
+    def __init__(self, service):
+        OutputReportCharacteristic.__init__(self, service, BOOT_KEYBOARD_OUTPUT_REPORT_UUID)
 
 
 class Report1ReferenceDescriptor(Descriptor):
     DESCRIPTOR_UUID = '2908'
 
-    def __init__(self, bus, index, characteristic):
+    def __init__(self, bus, index, characteristic, reference=REPORT_REFERENCE_INPUT):
         Descriptor.__init__(
             self, bus, index,
             self.DESCRIPTOR_UUID,
             ['read'],
             characteristic)
 
-        self.value = dbus.Array(bytearray.fromhex('0101'), signature=dbus.Signature('y'))
-        print(f'***ReportReference***: {self.value}')
+        self.value = hex_2_dbus_array(reference)
 
     def ReadValue(self, options):
-        print(f'Read ReportReference: {self.value}')
+        logging.debug("Read %s", self.path)
         return self.value
 
 
 def hex_2_dbus_array(value):
-    return dbus.Array(bytearray.fromhex(value))
+    return dbus.Array(bytearray.fromhex(value), signature=dbus.Signature("y"))
 
 
 def str_2_dbus_array(value):
     return dbus.Array(value.encode(), signature=dbus.Signature("y"))
 
 
-def register_application(adapter, bus, mainloop):
-    logging.info("Registering GATT application...")
-    app = BleHidKeyboardApplication(bus, mainloop)
+def register_application(adapter, bus, mainloop, adapters=None):
+    logging.info(f"Registering GATT application on {adapter}...")
+    app = BleHidKeyboardApplication(bus, mainloop, adapter, adapters or (adapter,))
     signal.signal(signal.SIGINT, app.sigint_handler)
+    signal.signal(signal.SIGUSR1, app.sigusr1_handler)
+    signal.signal(signal.SIGUSR2, app.sigusr2_handler)
 
-    service_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter), GATT_MANAGER_IFACE)
+    service_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter, introspect=False),
+                                     GATT_MANAGER_IFACE)
 
     service_manager.RegisterApplication(app.get_path(), {},
                                         reply_handler=app.register_callback,
                                         error_handler=app.error_callback)
+    return app
@@ -1,50 +1,52 @@
+import functools
+
 import dbus
 import logging
 
+from core.adapters import DEFAULT_ADAPTER
+from core.bluez_objects import bluez_objects
+
+
+@functools.lru_cache(maxsize=None)
+def properties(bus, path):
+    controller = bus.get_object("org.bluez", path, introspect=False)
+    return dbus.Interface(controller, "org.freedesktop.DBus.Properties")
+
 
 def disconnect(bus, path):
-    device = bus.get_object("org.bluez", path)
+    device = bus.get_object("org.bluez", path, introspect=False)
     interface = dbus.Interface(device, "org.bluez.Device1")
     interface.Disconnect()
 
 
-def turn_off(bus):
-    controller = bus.get_object("org.bluez", "/org/bluez/hci0")
-    props = dbus.Interface(controller, "org.freedesktop.DBus.Properties")
-    props.Set('org.bluez.Adapter1', 'Powered', dbus.Boolean(False))
+def turn_off(bus, adapter=DEFAULT_ADAPTER):
+    properties(bus, adapter).Set('org.bluez.Adapter1', 'Powered', dbus.Boolean(False))
 
 
-def turn_on(bus):
-    controller = bus.get_object("org.bluez", "/org/bluez/hci0")
-    props = dbus.Interface(controller, "org.freedesktop.DBus.Properties")
-    props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(True))
+def turn_on(bus, adapter=DEFAULT_ADAPTER, reply_handler=None, error_handler=None):
+    """
+    Powers the adapter on, without blocking when given handlers for the reply.
+    """
+    if bluez_objects.powered(adapter):
+        if reply_handler is not None:
+            reply_handler()
+        return
+    properties(bus, adapter).Set("org.bluez.Adapter1", "Powered", dbus.Boolean(True),
+                                 reply_handler=reply_handler, error_handler=error_handler)
 
 
-def enable_discovering(bus):
+def enable_discovering(bus, adapter=DEFAULT_ADAPTER):
     logging.info("Enabling discovering")
-    controller = bus.get_object("org.bluez", "/org/bluez/hci0")
-    props = dbus.Interface(controller, "org.freedesktop.DBus.Properties")
-    props.Set("org.bluez.Adapter1", "Discoverable", dbus.Boolean(True))
-
-
-def disable_discovering(bus):
-    controller = bus.get_object("org.bluez", "/org/bluez/hci0")
-    props = dbus.Interface(controller, "org.freedesktop.DBus.Properties")
-    props.Set("org.bluez.Adapter1", "Discoverable", dbus.Boolean(False))
-
-
-def is_discovering(bus):
-    controller = bus.get_object("org.bluez", "/org/bluez/hci0")
-    props = dbus.Interface(controller, 'org.freedesktop.DBus.Properties')
-    return bool(props.Get('org.bluez.Adapter1', 'Discoverable'))
-
+    if bluez_objects.discoverable(adapter):
+        return
+    properties(bus, adapter).Set("org.bluez.Adapter1", "Discoverable", dbus.Boolean(True))
 
-def properties_changed_callback(*args):
-    logging.info(f"PROPERTIES CHANGED: {args}")
 
+def disable_discovering(bus, adapter=DEFAULT_ADAPTER):
+    if not bluez_objects.discoverable(adapter):
+        return
+    properties(bus, adapter).Set("org.bluez.Adapter1", "Discoverable", dbus.Boolean(False))
 
-def listen_to_device(bus):
-    controller = bus.get_object("org.bluez", "/org/bluez/hci0")
-    props = dbus.Interface(controller, "org.freedesktop.DBus.Properties")
-    props.connect_to_signal("PropertiesChanged", properties_changed_callback)
 
+def is_discovering(bus, adapter=DEFAULT_ADAPTER):
+    return bluez_objects.discoverable(adapter)
@@ -0,0 +1,174 @@
+"""
+Mirror of the BlueZ adapters and devices.
+
+Loaded once from GetManagedObjects and kept current from the InterfacesAdded,
+InterfacesRemoved and PropertiesChanged signals of org.bluez, so whether an
+adapter is powered or which hosts are connected and bonded is read from
+memory instead of asked from BlueZ. The backends subscribe to the signals and
+hand them in; values may be dbus-python types or dbus-fast Variants.
+"""
+import logging
+
+from core.adapters import adapter_name
+from core.config import config
+
+ADAPTER_IFACE = "org.bluez.Adapter1"
+DEVICE_IFACE = "org.bluez.Device1"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+MIRRORED_IFACES = (ADAPTER_IFACE, DEVICE_IFACE, GATT_MANAGER_IFACE, LE_ADVERTISING_MANAGER_IFACE)
+
+
+def plain(value):
+    # dbus-fast wraps a{sv} values in Variants, dbus-python types are already Python types
+    return getattr(value, "value", value)
+
+
+class BluezObjectModel:
+
+    def __init__(self):
+        # {path: {interface: {property: value}}}
+        self.objects = {}
+        # ATT MTU of connected devices by device path, as seen in GATT requests
+        self.mtu = {}
+        # callbacks called with (device path, changed properties)
+        self.listeners = []
+        self.signals = 0
+
+    def load(self, objects):
+        self.objects = {}
+        for path, interfaces in objects.items():
+            self.add(path, interfaces)
+        logging.info(f"BlueZ objects: {len(self.adapters())} adapters, {len(self.devices())} devices, "
+                     f"{len(self.connected())} connected")
+
+    def add(self, path, interfaces):
+        mirrored = {str(interface): {str(name): plain(value) for name, value in properties.items()}
+                    for interface, properties in interfaces.items() if interface in MIRRORED_IFACES}
+        if mirrored:
+            self.objects.setdefault(str(path), {}).update(mirrored)
+        return mirrored
+
+    def interfaces_added(self, path, interfaces):
+        self.signals += 1
+        device = self.add(path, interfaces).get(DEVICE_IFACE)
+        if device is not None and device.get("Connected"):
+            self.device_changed(str(path), {"Connected": True})
+
+    def interfaces_removed(self, path, interfaces):
+        self.signals += 1
+        path = str(path)
+        entry = self.objects.get(path)
+        if entry is None:
+            return
+        if DEVICE_IFACE in interfaces and self.property(path, DEVICE_IFACE, "Connected", False):
+            self.device_changed(path, {"Connected": False})
+        for interface in interfaces:
+            entry.pop(interface, None)
+        if not entry:
+            del self.objects[path]
+
+    def properties_changed(self, interface, changed, invalidated, path):
+        self.signals += 1
+        path = str(path)
+        properties = self.objects.get(path, {}).get(interface)
+        if properties is None:
+            return
+        changed = {str(name): plain(value) for name, value in changed.items()}
+        properties.update(changed)
+        for name in invalidated:
+            properties.pop(name, None)
+        if interface == ADAPTER_IFACE:
+            logging.info(f"{adapter_name(path)}: {changed}")
+        elif interface == DEVICE_IFACE:
+            self.device_changed(path, changed)
+
+    def device_changed(self, path, changed):
+        if "Connected" in changed:
+            if changed["Connected"]:
+                logging.info(f"{self.describe(path)} connected")
+            else:
+                self.mtu.pop(path, None)
+                logging.info(f"{self.describe(path)} disconnected")
+        for listener in self.listeners:
+            listener(path, changed)
+
+    def link(self, options):
+        """
+        Records the MTU from the options of a GATT read or write request.
+        """
+        device = options.get("device")
+        mtu = options.get("mtu")
+        if device is None or mtu is None:
+            return
+        device, mtu = str(plain(device)), int(plain(mtu))
+        if self.mtu.get(device) != mtu:
+            self.mtu[device] = mtu
+            logging.info(f"{self.describe(device)}: MTU {mtu}")
+
+    def property(self, path, interface, name, default=None):
+        return self.objects.get(path, {}).get(interface, {}).get(name, default)
+
+    def paths(self, interface):
+        return sorted(path for path, interfaces in self.objects.items() if interface in interfaces)
+
+    def adapters(self):
+        return self.paths(ADAPTER_IFACE)
+
+    def powered(self, adapter):
+        return bool(self.property(adapter, ADAPTER_IFACE, "Powered", False))
+
+    def discoverable(self, adapter):
+        return bool(self.property(adapter, ADAPTER_IFACE, "Discoverable", False))
+
+    def devices(self, adapter=None):
+        return [path for path in self.paths(DEVICE_IFACE)
+                if adapter is None or self.property(path, DEVICE_IFACE, "Adapter") == adapter]
+
+    def connected(self, adapter=None):
+        return [path for path in self.devices(adapter) if self.property(path, DEVICE_IFACE, "Connected", False)]
+
+    def bonded(self, path):
+        # Bonded is only reported by BlueZ 5.62 and later
+        return bool(self.property(path, DEVICE_IFACE, "Bonded", self.property(path, DEVICE_IFACE, "Paired", False)))
+
+    def device(self, path):
+        return {"address": str(self.property(path, DEVICE_IFACE, "Address", "")),
+                "name": str(self.property(path, DEVICE_IFACE, "Alias", "")),
+                "adapter": str(self.property(path, DEVICE_IFACE, "Adapter", "")),
+                "connected": bool(self.property(path, DEVICE_IFACE, "Connected", False)),
+                "paired": bool(self.property(path, DEVICE_IFACE, "Paired", False)),
+                "bonded": self.bonded(path),
+                "mtu": self.mtu.get(path)}
+
+    def describe(self, path):
+        device = self.device(path)
+        return device["name"] or device["address"] or path
+
+    def stats(self):
+        """
+        {adapter name: {stat: value}}
+        """
+        stats = {}
+        for adapter in self.adapters():
+            connected = self.connected(adapter)
+            stats[adapter_name(adapter)] = {
+                "connected": float(len(connected)),
+                "bonded": float(sum(1 for path in self.devices(adapter) if self.bonded(path))),
+                "mtu": float(max((self.mtu.get(path, 0) for path in connected), default=0)),
+            }
+        return stats
+
+
+def remember_pairing(path, changed):
+    """
+    Saves [Bluetooth] paired to the state file once a host has paired, so the
+    keyboard is not discoverable after the next start.
+    """
+    if changed.get("Paired") and not config.get_boolean("Bluetooth", "paired", False):
+        logging.info(f"Paired with {bluez_objects.describe(path)}")
+        config.set("Bluetooth", "paired", True)
+        config.save()
+
+
+bluez_objects = BluezObjectModel()
@@ -2,13 +2,41 @@ import configparser
 import logging
 import os.path
 
+from core import inotify
+
 CONFIG_FILE = "/etc/ble-hid-keyboard.conf"
+# settings the service changes itself, e.g. [Bluetooth] paired; they override CONFIG_FILE
+STATE_FILE = "/var/lib/ble-hid-keyboard/state.conf"
+# editors write a file in several steps, changes are read once they settle
+RELOAD_DELAY_MS = 200
+# options only read at startup
+RESTART_OPTIONS = {("Server", "backend"), ("Bluetooth", "adapters"), ("Socket", "enabled"), ("Socket", "path"),
+                   ("Tracing", "enabled"), ("Tracing", "window"), ("Battery", "source"), ("Battery", "supply"),
+                   ("Battery", "path")}
 
 
 class Config:
+    """
+    Settings from CONFIG_FILE.
+
+    Once watch_file() is called the file is watched with inotify and read
+    again when it changes; the callbacks passed to watch() for a section are
+    then called when any of its options changed, so settings apply without
+    restarting the service. A file that fails to parse is ignored and the
+    previous settings are kept, as are the settings of a section whose
+    callback rejects them.
+
+    CONFIG_FILE is only ever edited by the user; set() and save() keep their
+    values in STATE_FILE. Values are read as written, without interpolation,
+    so a stray % in a value such as a device name is not an error.
+    """
 
     def __init__(self):
-        self.config = configparser.ConfigParser()
+        self.config = new_parser()
+        self.state = new_parser()
+        self.watchers = {}
+        self.inotify_fd = None
+        self.reload_source = None
 
         if not os.path.exists(CONFIG_FILE):
             logging.info(f"Config {CONFIG_FILE} is not exists. Creating new one.")
@@ -19,24 +47,122 @@ class Config:
             self.config.read(CONFIG_FILE)
             logging.info(self.config["Bluetooth"]["paired"])
             logging.info(self.config["Bluetooth"]["name"])
+        try:
+            self.state.read(STATE_FILE)
+        except (configparser.Error, UnicodeError) as error:
+            logging.warning(f"Ignoring {STATE_FILE}: {error}")
+            self.state = new_parser()
+        self.config.read_dict(self.state)
 
-    def get(self, section, option):
+    def get(self, section, option, fallback=None):
+        if fallback is not None:
+            return self.config.get(section, option, fallback=fallback)
         return self.config[section][option]
 
-    def get_boolean(self, section, option):
-        value = self.config[section].getboolean(option)
+    def get_int(self, section, option, fallback=None):
+        return self.config.getint(section, option, fallback=fallback)
+
+    def get_float(self, section, option, fallback=None):
+        return self.config.getfloat(section, option, fallback=fallback)
+
+    def get_boolean(self, section, option, fallback=None):
+        value = self.config.getboolean(section, option, fallback=fallback)
         logging.info(f"Type: {type(value)}")
         logging.info(f"Get boolean {section}.{option} = {value}")
         return value
 
     def set(self, section, option, value):
-        logging.info("setting")
-#        self.config.set(section, option, value)
-        logging.info("is set")
+        for parser in (self.config, self.state):
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, option, str(value))
+        logging.info(f"Set {section}.{option} = {value}")
 
     def save(self):
-        with open(CONFIG_FILE) as configfile:
-            self.config.write(configfile)
+        """
+        Writes the values given to set() to a temporary file and renames it
+        over STATE_FILE, so the file is never left half written.
+        """
+        tmp_path = STATE_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            with open(tmp_path, "w") as state_file:
+                self.state.write(state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(tmp_path, STATE_FILE)
+        except OSError as error:
+            logging.warning(f"State is not saved: {error}")
+
+    def watch(self, section, callback):
+        self.watchers.setdefault(section, []).append(callback)
+
+    def watch_file(self):
+        """
+        Reloads the config when the file changes, on the event loop.
+        """
+        # imported here: the event loop is created from the config
+        from core.event_loop import event_loop
+        try:
+            self.inotify_fd = inotify.watch_file(CONFIG_FILE)
+        except OSError as error:
+            logging.warning(f"Config changes are not watched: {error}")
+            return
+        event_loop.io_add_watch(self.inotify_fd, self.on_inotify)
+        logging.info(f"Watching {CONFIG_FILE} for changes")
+
+    def on_inotify(self):
+        from core.event_loop import event_loop
+        changed = os.path.basename(CONFIG_FILE) in inotify.changed_names(self.inotify_fd)
+        if changed and self.reload_source is None:
+            self.reload_source = event_loop.timeout_add(RELOAD_DELAY_MS, self.reload)
+        return True
+
+    def reload(self):
+        self.reload_source = None
+        parser = new_parser()
+        try:
+            if not parser.read(CONFIG_FILE):
+                return False
+            parser.read_dict(self.state)
+            new = sections(parser)
+        except (configparser.Error, UnicodeError, OSError) as error:
+            logging.error(f"Ignoring changes to {CONFIG_FILE}: {error}")
+            return False
+        old = sections(self.config)
+        changed = {(section, option) for section in old.keys() | new.keys()
+                   for option in old.get(section, {}).keys() | new.get(section, {}).keys()
+                   if old.get(section, {}).get(option) != new.get(section, {}).get(option)}
+        if not changed:
+            return False
+        for section, option in sorted(changed):
+            logging.info(f"Config changed: {section}.{option} = {new.get(section, {}).get(option)}")
+            if (section, option) in RESTART_OPTIONS:
+                logging.warning(f"{section}.{option} takes effect after a restart")
+        previous, self.config = self.config, parser
+        for section in sorted({section for section, option in changed}):
+            try:
+                self.notify(section)
+            except ValueError as error:
+                logging.error(f"Invalid [{section}] settings, keeping the previous ones: {error}")
+                # the callbacks that already ran are called again with the previous settings
+                self.config.remove_section(section)
+                if previous.has_section(section):
+                    self.config.read_dict({section: dict(previous.items(section))})
+                self.notify(section)
+        return False
+
+    def notify(self, section):
+        for callback in self.watchers.get(section, []):
+            callback()
+
+
+def new_parser():
+    return configparser.ConfigParser(interpolation=None)
+
+
+def sections(parser):
+    return {section: dict(parser[section]) for section in parser.sections()}
 
 
 config = Config()
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import os
+
+from core.hid_descriptor import parse
+
+CACHE_DIR = "/var/lib/ble-hid-keyboard"
+CACHE_FILE = os.path.join(CACHE_DIR, "devices.json")
+
+
+class DeviceCache:
+    """
+    Keyboard classification of HID devices, persisted across restarts.
+
+    Devices are keyed by bus type, vendor, product and a hash of the report
+    descriptor, so a firmware update that changes the descriptor is classified
+    again. Known non-keyboards are skipped without parsing their descriptor,
+    parsed descriptors of keyboards are kept in memory for replugs.
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        self.descriptors = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def key(bustype, vendor, product, descriptor):
+        digest = hashlib.sha1(bytes(descriptor)).hexdigest()[:16]
+        return f"{bustype:04x}:{vendor:04x}:{product:04x}:{digest}"
+
+    def classify(self, bustype, vendor, product, descriptor, name):
+        """
+        Parsed report descriptor of a keyboard, None for any other device.
+        """
+        key = self.key(bustype, vendor, product, descriptor)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            if not entry["keyboard"]:
+                return None
+            report_descriptor = self.descriptors.get(key)
+            if report_descriptor is None:
+                report_descriptor = self.descriptors[key] = parse(descriptor)
+            return report_descriptor
+
+        self.misses += 1
+        report_descriptor = parse(descriptor)
+        keyboard = report_descriptor.is_keyboard()
+        self.entries[key] = {"keyboard": keyboard, "name": name}
+        self.save()
+        if not keyboard:
+            return None
+        self.descriptors[key] = report_descriptor
+        return report_descriptor
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                self.entries = json.load(cache_file)
+            logging.info(f"Loaded {len(self.entries)} devices from {self.path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as error:
+            logging.warning(f"Ignoring device cache {self.path}: {error}")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self.entries, cache_file, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            logging.warning(f"Device cache is not persisted: {error}")
+
+    def stats(self):
+        return {"devices": len(self.entries), "hits": self.hits, "misses": self.misses}
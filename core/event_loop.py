@@ -0,0 +1,110 @@
+"""
+Event loop used by the input pipeline.
+
+The GLib main loop serves the dbus-python backend, an asyncio loop serves the
+asyncio backend. Callbacks take no arguments; watch and timeout callbacks
+return True to stay registered, like GLib sources.
+"""
+import logging
+import math
+
+from core.config import config
+
+BACKEND_GLIB = "glib"
+BACKEND_ASYNCIO = "asyncio"
+
+
+class GLibEventLoop:
+    name = BACKEND_GLIB
+    # hidraw is read on a dedicated thread, see InputReader
+    threaded_input = True
+
+    def __init__(self):
+        from gi.repository import GLib
+        self.glib = GLib
+
+    def io_add_watch(self, fd, callback, high_priority=False):
+        priority = self.glib.PRIORITY_HIGH if high_priority else self.glib.PRIORITY_DEFAULT
+        return self.glib.io_add_watch(fd, priority, self.glib.IO_IN, lambda source, condition: callback())
+
+    def timeout_add(self, interval_ms, callback):
+        # GLib timeouts have millisecond resolution
+        return self.glib.timeout_add(max(1, math.ceil(interval_ms)), callback)
+
+    def idle_add(self, callback, *args):
+        # safe to call from any thread
+        self.glib.idle_add(lambda: callback(*args) and False)
+
+    def source_remove(self, source):
+        self.glib.source_remove(source)
+
+
+class AsyncioTimer:
+    def __init__(self, loop, interval_ms, callback):
+        self.loop = loop
+        self.interval = interval_ms / 1000
+        self.callback = callback
+        self.handle = loop.call_later(self.interval, self.fire)
+
+    def fire(self):
+        if self.callback():
+            self.handle = self.loop.call_later(self.interval, self.fire)
+        else:
+            self.handle = None
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+class AsyncioReader:
+    def __init__(self, loop, fd, callback):
+        self.loop = loop
+        self.fd = fd
+        self.callback = callback
+        loop.add_reader(fd, self.fire)
+
+    def fire(self):
+        if not self.callback():
+            self.cancel()
+
+    def cancel(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+
+
+class AsyncioEventLoop:
+    name = BACKEND_ASYNCIO
+    # hidraw is read by the event loop itself
+    threaded_input = False
+
+    def __init__(self):
+        self.loop = None
+
+    def attach(self, loop):
+        self.loop = loop
+
+    def io_add_watch(self, fd, callback, high_priority=False):
+        return AsyncioReader(self.loop, fd, callback)
+
+    def timeout_add(self, interval_ms, callback):
+        return AsyncioTimer(self.loop, interval_ms, callback)
+
+    def idle_add(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def source_remove(self, source):
+        source.cancel()
+
+
+def create_event_loop(backend):
+    if backend == BACKEND_ASYNCIO:
+        return AsyncioEventLoop()
+    if backend != BACKEND_GLIB:
+        logging.warning(f"Unknown backend {backend}, using {BACKEND_GLIB}")
+    return GLibEventLoop()
+
+
+event_loop = create_event_loop(config.get("Server", "backend", BACKEND_GLIB))
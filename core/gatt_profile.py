@@ -0,0 +1,43 @@
+#HID_REPORT_DESCRIPTOR = '05010906a1018501050719e029e71500250175019508810295017508810395057501050819012905910295017503910395067508150025ff0507190029ff8100c0'
+#HID_REPORT_DESCRIPTOR = '05010906a101050719e029e715002501750195088102750895018101050875019505190129059102750395019101050719002aff00150026ff00750895068100c0'
+HID_REPORT_DESCRIPTOR = "05010906a1018501050719e029e715002501750195088102750895018101050875019505190129059102750395019101050719002aff00150026ff00750895068100c0"
+#HID_REPORT_DESCRIPTOR = "05010906a101050719e029e715002501750195088102750895018101050875019505190129059102750395019101050719002aff00150026ff00750895068100c0"
+
+BATTERY_SERVICE_UUID = '180f'
+BATTERY_LVL_UUID = '2a19'
+DEVICE_INFO_SERVICE_UUID = '180A'
+VENDOR_CHARACTERISTIC_UUID = '2A29'
+PRODUCT_CHARACTERISTIC_UUID = '2A24'
+VERSION_CHARACTERISTIC_UUID = '2A28'
+PNP_CHARACTERISTIC_UUID = '2A50'
+HID_SERVICE_UUID = '1812'
+PROTOCOL_MODE_CHARACTERISTIC_UUID = '2A4E'
+HID_INFO_CHARACTERISTIC_UUID = '2A4A'
+CONTROL_POINT_CHARACTERISTIC_UUID = '2A4C'
+REPORT_MAP_CHARACTERISTIC_UUID = '2A4B'
+REPORT_CHARACTERISTIC_UUID = '2A4D'
+BOOT_KEYBOARD_INPUT_REPORT_UUID = '2A22'
+BOOT_KEYBOARD_OUTPUT_REPORT_UUID = '2A32'
+
+APPLICATION_IFACE = "com.artyomsoft.BleHidKeyboard1"
+
+# Device Information values
+PNP_ID = "02C41001000100"
+VENDOR = "artyomsoft"
+PRODUCT = "BLE Keyboard"
+VERSION = "1.0.0"
+
+# bcdHID 1.11, country code 0, flags: normally connectable
+HID_INFO = "01110002"
+PROTOCOL_MODE_BOOT = "00"
+PROTOCOL_MODE_REPORT = "01"
+PROTOCOL_MODES = {PROTOCOL_MODE_BOOT: "boot", PROTOCOL_MODE_REPORT: "report"}
+# Report ID 1, input report
+REPORT_REFERENCE_INPUT = "0101"
+# Report ID 1, output report: the keyboard LEDs
+REPORT_REFERENCE_OUTPUT = "0102"
+
+# Advertisement
+LOCAL_NAME = "BLE Keyboard"
+ADVERTISED_SERVICE_UUIDS = ["1812", "180F"]
+APPEARANCE_KEYBOARD = 0x03c1
@@ -0,0 +1,358 @@
+"""
+HID report descriptor parser and keyboard report translators.
+
+The parser walks the short items of a report descriptor (HID 1.11, 6.2.2) and
+produces one ReportField per main item. compile_translator() turns the keyboard
+fields of a device into a KeyboardTranslator that converts native input reports
+into the 8 byte report advertised in HID_REPORT_DESCRIPTOR (modifiers, reserved
+byte, 6 key slots) in a single pass; compile_led_encoder() does the reverse for
+the LED output report the host writes.
+"""
+
+INPUT = "input"
+OUTPUT = "output"
+FEATURE = "feature"
+
+MAIN_ITEMS = {0x80: INPUT, 0x90: OUTPUT, 0xb0: FEATURE}
+COLLECTION = 0xa0
+END_COLLECTION = 0xc0
+COLLECTION_APPLICATION = 0x01
+
+USAGE_PAGE_GENERIC_DESKTOP = 0x01
+USAGE_PAGE_KEYBOARD = 0x07
+USAGE_PAGE_LED = 0x08
+USAGE_KEYBOARD = USAGE_PAGE_GENERIC_DESKTOP << 16 | 0x06
+
+KEY_ERROR_ROLL_OVER = 0x01
+KEY_ERROR_UNDEFINED = 0x03
+KEY_LEFT_CONTROL = 0xe0
+KEY_RIGHT_GUI = 0xe7
+
+REPORT_LENGTH = 8
+KEY_SLOTS = 6
+# LED output report of HID_REPORT_DESCRIPTOR: Num Lock, Caps Lock, Scroll Lock, Compose and Kana in bits 0-4
+LED_COUNT = 5
+ROLL_OVER_REPORT = bytes([0, 0] + [KEY_ERROR_ROLL_OVER] * KEY_SLOTS)
+
+FLAG_CONSTANT = 0x01
+FLAG_VARIABLE = 0x02
+
+
+class ReportField:
+    __slots__ = ("report_type", "report_id", "offset", "size", "count", "flags",
+                 "usages", "logical_minimum", "logical_maximum", "application")
+
+    def __init__(self, report_type, report_id, offset, size, count, flags, usages,
+                 logical_minimum, logical_maximum, application):
+        self.report_type = report_type
+        self.report_id = report_id
+        # bit offset inside the report, not counting the report ID byte
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.flags = flags
+        self.usages = usages
+        self.logical_minimum = logical_minimum
+        self.logical_maximum = logical_maximum
+        self.application = application
+
+    @property
+    def constant(self):
+        return bool(self.flags & FLAG_CONSTANT)
+
+    @property
+    def variable(self):
+        return bool(self.flags & FLAG_VARIABLE)
+
+    def usage(self, index):
+        """
+        Usage of the index-th element of a variable field or of array value ``index``.
+        """
+        if not self.usages:
+            return 0
+        return self.usages[min(index, len(self.usages) - 1)]
+
+    def __repr__(self):
+        return (f"ReportField({self.report_type}, id={self.report_id}, offset={self.offset}, "
+                f"size={self.size}, count={self.count}, flags={self.flags:#x})")
+
+
+class ReportDescriptor:
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.report_ids = sorted({field.report_id for field in fields})
+
+    @property
+    def numbered(self):
+        return self.report_ids != [0]
+
+    def keyboard_fields(self, report_type=INPUT):
+        return [field for field in self.fields
+                if field.report_type == report_type and field.application == USAGE_KEYBOARD]
+
+    def is_keyboard(self):
+        return any(usage >> 16 == USAGE_PAGE_KEYBOARD
+                   for field in self.keyboard_fields() if not field.constant for usage in field.usages)
+
+    def report_length(self, report_type=INPUT, report_id=None):
+        """
+        Length in bytes, including the report ID, of the longest report of a type.
+        """
+        bits = {}
+        for field in self.fields:
+            if field.report_type == report_type and (report_id is None or field.report_id == report_id):
+                end = field.offset + field.size * field.count
+                bits[field.report_id] = max(bits.get(field.report_id, 0), end)
+        if not bits:
+            return 0
+        return max((length + 7) // 8 + (1 if rid else 0) for rid, length in bits.items())
+
+
+def parse(descriptor):
+    descriptor = bytes(descriptor)
+    fields = []
+    globals_ = {"page": 0, "logical_minimum": 0, "logical_maximum": 0, "size": 0, "count": 0, "report_id": 0}
+    stack = []
+    usages = []
+    usage_minimum = None
+    collections = []
+    offsets = {}
+    i = 0
+    while i < len(descriptor):
+        prefix = descriptor[i]
+        if prefix == 0xfe:
+            # long item: data size in the next byte, not used by any standard item
+            i += 3 + (descriptor[i + 1] if i + 1 < len(descriptor) else 0)
+            continue
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        data = descriptor[i + 1:i + 1 + size]
+        value = int.from_bytes(data, "little")
+        signed = int.from_bytes(data, "little", signed=True)
+        item = prefix & 0xfc
+        i += 1 + size
+
+        if item in MAIN_ITEMS:
+            report_type = MAIN_ITEMS[item]
+            key = (report_type, globals_["report_id"])
+            offset = offsets.get(key, 0)
+            offsets[key] = offset + globals_["size"] * globals_["count"]
+            application = next((usage for kind, usage in reversed(collections)
+                                if kind == COLLECTION_APPLICATION), 0)
+            fields.append(ReportField(report_type, globals_["report_id"], offset, globals_["size"],
+                                      globals_["count"], value, usages, globals_["logical_minimum"],
+                                      globals_["logical_maximum"], application))
+        elif item == COLLECTION:
+            collections.append((value, usages[0] if usages else 0))
+        elif item == END_COLLECTION:
+            if collections:
+                collections.pop()
+        elif item == 0x04:
+            globals_["page"] = value
+        elif item == 0x14:
+            globals_["logical_minimum"] = signed
+        elif item == 0x24:
+            # a logical maximum is unsigned when the minimum is not negative
+            globals_["logical_maximum"] = value if globals_["logical_minimum"] >= 0 else signed
+        elif item == 0x74:
+            globals_["size"] = value
+        elif item == 0x84:
+            globals_["report_id"] = value
+        elif item == 0x94:
+            globals_["count"] = value
+        elif item == 0xa4:
+            stack.append(dict(globals_))
+        elif item == 0xb4:
+            if stack:
+                globals_ = stack.pop()
+        elif item == 0x08:
+            usages = usages + [extended_usage(globals_["page"], value, size)]
+        elif item == 0x18:
+            usage_minimum = extended_usage(globals_["page"], value, size)
+        elif item == 0x28:
+            if usage_minimum is not None:
+                usage_maximum = extended_usage(globals_["page"], value, size)
+                usages = usages + list(range(usage_minimum, usage_maximum + 1))
+                usage_minimum = None
+
+        if item in MAIN_ITEMS or item in (COLLECTION, END_COLLECTION):
+            # local items only apply to the next main item
+            usages = []
+            usage_minimum = None
+    return ReportDescriptor(fields)
+
+
+def extended_usage(page, value, size):
+    if size == 4:
+        return value
+    return page << 16 | value
+
+
+def is_keyboard(descriptor):
+    return parse(descriptor).is_keyboard()
+
+
+class ReportPlan:
+    """
+    Precomputed layout of one keyboard input report.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        # (byte index, 256 entry table of modifier bits)
+        self.modifiers = []
+        # byte aligned 8 bit key arrays: (start, end) slices of usages
+        self.key_slices = []
+        # other arrays: (bit offset, size, count, logical minimum, usages)
+        self.key_arrays = []
+        # bitmap keys: (byte index, [usage for each bit])
+        self.key_bitmap = []
+
+
+class KeyboardTranslator:
+
+    def __init__(self, plans, numbered):
+        self.plans = plans
+        self.numbered = numbered
+        self.plan = None if numbered else plans.get(0)
+
+    def __call__(self, report):
+        if self.numbered:
+            if not report:
+                return None
+            plan = self.plans.get(report[0])
+        else:
+            plan = self.plan
+        if plan is None or len(report) < plan.length:
+            return None
+
+        modifiers = 0
+        for index, table in plan.modifiers:
+            modifiers |= table[report[index]]
+
+        keys = []
+        for start, end in plan.key_slices:
+            for key in report[start:end]:
+                if key:
+                    keys.append(key)
+        for offset, size, count, minimum, usages in plan.key_arrays:
+            for n in range(count):
+                value = read_bits(report, offset + n * size, size) - minimum
+                if 0 <= value < len(usages) and usages[value]:
+                    keys.append(usages[value])
+        for index, usages in plan.key_bitmap:
+            value = report[index]
+            while value:
+                bit = value & -value
+                keys.append(usages[bit.bit_length() - 1])
+                value ^= bit
+
+        if any(KEY_ERROR_ROLL_OVER <= key <= KEY_ERROR_UNDEFINED for key in keys) or len(keys) > KEY_SLOTS:
+            return ROLL_OVER_REPORT
+        return bytes([modifiers, 0] + keys + [0] * (KEY_SLOTS - len(keys)))
+
+
+def read_bits(report, offset, size):
+    start = offset // 8
+    end = (offset + size + 7) // 8
+    return (int.from_bytes(report[start:end], "little") >> (offset % 8)) & ((1 << size) - 1)
+
+
+def compile_translator(report_descriptor):
+    """
+    Translator from a device's native input reports to the advertised report.
+
+    Returns None when the device already sends the advertised layout, in which case
+    reports are forwarded unchanged.
+    """
+    plans = {}
+    fields = report_descriptor.keyboard_fields()
+    for report_id in sorted({field.report_id for field in fields}):
+        id_bytes = 1 if report_id else 0
+        plan = ReportPlan(report_descriptor.report_length(INPUT, report_id))
+        modifier_bits = {}
+        bitmap = {}
+        for field in fields:
+            if field.report_id != report_id or field.constant:
+                continue
+            base = field.offset + id_bytes * 8
+            if field.variable:
+                for n in range(field.count):
+                    usage = field.usage(n)
+                    if usage >> 16 != USAGE_PAGE_KEYBOARD or field.size != 1:
+                        continue
+                    usage &= 0xffff
+                    bit = base + n
+                    if KEY_LEFT_CONTROL <= usage <= KEY_RIGHT_GUI:
+                        modifier_bits.setdefault(bit // 8, []).append((bit % 8, usage - KEY_LEFT_CONTROL))
+                    elif usage > KEY_ERROR_UNDEFINED:
+                        bitmap.setdefault(bit // 8, [0] * 8)[bit % 8] = usage
+            elif any(usage >> 16 == USAGE_PAGE_KEYBOARD for usage in field.usages):
+                usages = [usage & 0xffff if usage >> 16 == USAGE_PAGE_KEYBOARD else 0 for usage in field.usages]
+                identity = all(usage == n for n, usage in enumerate(usages))
+                if field.size == 8 and base % 8 == 0 and field.logical_minimum == 0 and identity:
+                    plan.key_slices.append((base // 8, base // 8 + field.count))
+                else:
+                    plan.key_arrays.append((base, field.size, field.count, field.logical_minimum, usages))
+        for index, bits in sorted(modifier_bits.items()):
+            table = bytes(sum(1 << out for bit, out in bits if value >> bit & 1) for value in range(256))
+            plan.modifiers.append((index, table))
+        plan.key_bitmap = sorted(bitmap.items())
+        plans[report_id] = plan
+
+    if not report_descriptor.numbered and is_boot_layout(plans.get(0)):
+        return None
+    return KeyboardTranslator(plans, report_descriptor.numbered)
+
+
+def is_boot_layout(plan):
+    return (plan is not None and plan.length == REPORT_LENGTH
+            and plan.modifiers == [(0, bytes(range(256)))]
+            and plan.key_slices == [(2, 2 + KEY_SLOTS)]
+            and not plan.key_arrays and not plan.key_bitmap)
+
+
+class LedEncoder:
+    """
+    Converts the advertised LED output report into a device's native output report.
+    """
+
+    def __init__(self, reports):
+        # native report for each state of the advertised LEDs
+        self.reports = reports
+
+    def __call__(self, leds):
+        return self.reports[leds & ((1 << LED_COUNT) - 1)]
+
+
+def compile_led_encoder(report_descriptor):
+    """
+    Encoder of the LED states the host writes into the device's LED output report.
+
+    Returns None when the device has no LEDs.
+    """
+    bits = {}
+    for field in report_descriptor.fields:
+        if field.report_type != OUTPUT or field.constant or not field.variable or field.size != 1:
+            continue
+        for n in range(field.count):
+            usage = field.usage(n)
+            if usage >> 16 == USAGE_PAGE_LED and 1 <= usage & 0xffff <= LED_COUNT:
+                bits.setdefault(field.report_id, []).append((field.offset + n, (usage & 0xffff) - 1))
+    if not bits:
+        return None
+    # a device with several LED reports gets the one with most of the advertised LEDs
+    report_id = max(bits, key=lambda rid: len(bits[rid]))
+    id_bits = 8 if report_id else 0
+    length = report_descriptor.report_length(OUTPUT, report_id)
+    reports = []
+    for leds in range(1 << LED_COUNT):
+        report = bytearray(length)
+        if report_id:
+            report[0] = report_id
+        for bit, led in bits[report_id]:
+            if leds >> led & 1:
+                bit += id_bits
+                report[bit // 8] |= 1 << bit % 8
+        reports.append(bytes(report))
+    return LedEncoder(reports)
@@ -2,10 +2,21 @@ import array
 import ctypes
 import logging
 import os
+import time
 
 import ioctl
 import pyudev
-from gi.repository import GLib
+
+from core.config import config
+from core.device_cache import DeviceCache
+from core.event_loop import event_loop
+from core.hid_descriptor import parse, compile_translator, compile_led_encoder
+from core.input_reader import InputReader, LoopInputReader
+from core.led_writer import LedWriter
+from core.report_filter import ReportFilter
+from core.report_merger import ReportMerger, OVERFLOW_OLDEST
+from core.report_socket import ReportSocketServer
+from core.tracing import tracer
 
 
 class Hidraw(object):
@@ -26,6 +37,17 @@ class Hidraw(object):
         self._fd = os.open(path, os.O_RDWR)
         self.read_length = read_length
 
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     @property
     def path(self):
         return self._path
@@ -99,10 +121,27 @@ class HidrawDevinfo(ctypes.Structure):
 
 
 class Keyboard:
-    def __init__(self, dev_node, name, descriptor):
+    def __init__(self, dev_node, name, descriptor, report_descriptor=None):
         self.dev_node = dev_node
         self.name = name
         self.descriptor = descriptor
+        self.report_descriptor = report_descriptor or parse(descriptor)
+        # None when the device already sends the advertised report layout
+        self.translate = compile_translator(self.report_descriptor)
+        self.report_length = self.report_descriptor.report_length() or 64
+        # reads land in this buffer, so the input path does not allocate per report
+        self.buffer = bytearray(self.report_length)
+        self.view = memoryview(self.buffer)
+        # None when the device has no LEDs
+        self.encode_leds = compile_led_encoder(self.report_descriptor)
+        # LED output report last handed to the writer
+        self.led_report = None
+        self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
     def print(self):
         descriptor_hex = bytearray(self.descriptor).hex()
@@ -115,17 +154,50 @@ class Keyboards:
         self.keyboards = {}
         self.context = pyudev.Context()
         self.event_callback = None
- 
-    def callback(self, fd, cond, device):
-        loop = True
-        while loop:
-            data = os.read(device.fileno(), 4096)
-            self.event_callback(data)
-            if not data:
-                break
-            if len(data) < 4096:
-                loop = False
-        return True
+        self.report_merger = ReportMerger()
+        config.watch("Keyboard", lambda: self.report_merger.set_overflow(
+            config.get("Keyboard", "overflow", OVERFLOW_OLDEST)))
+        self.report_filter = ReportFilter(self.report_merger.process, tracer.stamp)
+        self.device_cache = DeviceCache()
+        self.input_reader = (InputReader if event_loop.threaded_input else LoopInputReader)(self.on_reports)
+        self.open_files = 0
+        self.watching = False
+        self.paused = False
+        # names of report sources other than hidraw devices, e.g. report socket connections
+        self.sources = set()
+        self.report_socket = ReportSocketServer(self)
+        # LED state last written by the host, None until it writes one
+        self.leds = None
+        self.leds_suppressed = 0
+        self.led_writer = LedWriter()
+
+    def on_reports(self, items):
+        """
+        Reports from the input reader; one batch is one emission window of the filter.
+        """
+        feed = self.report_filter.feed
+        traced = tracer.enabled
+        devices = set()
+        for dev_node, report, wakeup, read in items:
+            if dev_node not in self.keyboards and dev_node not in self.sources:
+                # queued before the device was detached
+                continue
+            if report is None:
+                self.detach(dev_node)
+                continue
+            # the stamps travel with the report through the filter, which may emit it later
+            feed(dev_node, report, (wakeup, read) if traced else None)
+            devices.add(dev_node)
+        for dev_node in devices:
+            self.report_filter.flush(dev_node)
+
+    def traced_emit(self, report):
+        tracer.report(report)
+        self.event_callback(report)
+
+    def queue_device_event(self, action, device):
+        # called on the udev observer thread, the event is handled on the main loop
+        event_loop.idle_add(self.on_device_event, action, device)
 
     def on_device_event(self, action, device):
         logging.info(action)
@@ -139,47 +211,178 @@ class Keyboards:
         logging.info("Monitor devices")
         monitor = pyudev.Monitor.from_netlink(self.context)
         monitor.filter_by(subsystem='hidraw')
-        observer = pyudev.MonitorObserver(monitor, self.on_device_event)
+        observer = pyudev.MonitorObserver(monitor, self.queue_device_event)
         observer.start()
 
-    def watch(self, event_callback):
-        logging.info("HID keyboard event watching started")
+    def set_event_callback(self, event_callback):
         self.event_callback = event_callback
+        self.report_merger.emit = self.traced_emit if tracer.enabled else event_callback
+
+    def watch(self, event_callback, backlog=None, resync=None):
+        if backlog is not None:
+            self.report_socket.backlog = backlog
+        if self.watching:
+            self.resume(event_callback, resync)
+            return
+        logging.info("HID keyboard event watching started")
+        self.watching = True
+        self.set_event_callback(event_callback)
+        if config.get_boolean("Socket", "enabled", False):
+            self.report_socket.start()
+        start = time.monotonic()
         for device in self.context.list_devices(subsystem='hidraw'):
             self.on_add(device)
+        logging.info(f"Enumerated hidraw devices in {(time.monotonic() - start) * 1000:.1f} ms, "
+                     f"device cache {self.device_cache.stats()}")
         self.monitor_devices()
         logging.info("Watching")
 
+    def pause(self):
+        """
+        Stops reading the keyboards and emitting reports while nobody is subscribed.
+        """
+        if self.paused:
+            return
+        self.paused = True
+        self.input_reader.pause()
+        # reports already queued by the reader still update the merged state
+        self.report_merger.emit = discard
+        logging.info("HID keyboard event watching paused")
+
+    def resume(self, event_callback, resync=None):
+        """
+        Reads the keyboards again and resyncs the host with the keys held right now.
+
+        The held keys are sent to resync when given, else to event_callback.
+        """
+        self.paused = False
+        items = self.input_reader.resume()
+        if items:
+            self.on_reports(items)
+        self.set_event_callback(event_callback)
+        (resync or event_callback)(self.report_merger.current())
+        logging.info("HID keyboard event watching resumed")
+
+    def set_leds(self, leds):
+        """
+        LED state written by the host, forwarded to every keyboard with LEDs.
+        """
+        if leds == self.leds:
+            self.leds_suppressed += 1
+            return
+        logging.info(f"Host LEDs: {leds:#04x}")
+        self.leds = leds
+        for keyboard in self.keyboards.values():
+            self.write_leds(keyboard)
+
+    def write_leds(self, keyboard):
+        if keyboard.encode_leds is None or self.leds is None:
+            return
+        report = keyboard.encode_leds(self.leds)
+        # keyboards without some of the LEDs get the same report for several states
+        if report != keyboard.led_report:
+            keyboard.led_report = report
+            self.led_writer.write(keyboard.dev_node, report)
+
     def on_add(self, device):
         logging.info(device)
-        hidraw = Hidraw(device.device_node)
-        if is_keyboard(hidraw):
-            keyboard = Keyboard(device.device_node, hidraw.name, hidraw.report_descriptor)
-            keyboard.print()
-            dev_file = open(keyboard.dev_node, "r+b")
-            keyboard.source = GLib.io_add_watch(dev_file, GLib.IO_IN, self.callback, dev_file)
-            self.keyboards[device.device_node] = keyboard
+        start = time.monotonic()
+        identity = udev_identity(device)
+        if identity is None:
+            with Hidraw(device.device_node) as hidraw:
+                identity = hidraw.info + (hidraw.name, hidraw.report_descriptor)
+        bustype, vendor, product, name, descriptor = identity
+        report_descriptor = self.device_cache.classify(bustype, vendor, product, descriptor, name)
+        elapsed = (time.monotonic() - start) * 1000
+        if report_descriptor is None:
+            logging.info(f"Skipped {device.device_node} - {name} in {elapsed:.1f} ms")
+            return
+        keyboard = Keyboard(device.device_node, name, descriptor, report_descriptor)
+        keyboard.print()
+        self.attach(keyboard)
+        logging.info(f"Added {device.device_node} in {(time.monotonic() - start) * 1000:.1f} ms")
+
+    def attach(self, keyboard):
+        self.detach(keyboard.dev_node)
+        if keyboard.file is None:
+            keyboard.file = open(keyboard.dev_node, "r+b", buffering=0)
+        self.open_files += 1
+        os.set_blocking(keyboard.file.fileno(), False)
+        self.keyboards[keyboard.dev_node] = keyboard
+        self.input_reader.add(keyboard)
+        self.input_reader.start_once()
+        if keyboard.encode_leds is not None:
+            self.led_writer.add(keyboard)
+            self.write_leds(keyboard)
+
+    def detach(self, dev_node):
+        keyboard = self.keyboards.pop(dev_node, None)
+        if keyboard is None:
+            return
+        if keyboard.file is not None:
+            self.input_reader.remove(keyboard)
+            self.led_writer.remove(dev_node)
+            self.open_files -= 1
+        keyboard.close()
+        self.forget(dev_node)
+
+    def attach_source(self, name):
+        self.sources.add(name)
+
+    def detach_source(self, name):
+        if name in self.sources:
+            self.sources.discard(name)
+            self.forget(name)
+
+    def forget(self, dev_node):
+        self.report_filter.forget(dev_node)
+        self.report_merger.remove(dev_node)
+        tracer.forget(dev_node)
 
     def on_remove(self, device):
-        if device.device_node in self.keyboards:
-            keyboard = self.keyboards[device.device_node]
+        keyboard = self.keyboards.get(device.device_node)
+        if keyboard is not None:
             keyboard.print()
-            del self.keyboards[device.device_node]
+            self.detach(device.device_node)
+            self.report_filter.print()
+            logging.info(f"Open resources: {self.resources()}")
+
+    def close(self):
+        for dev_node in list(self.keyboards):
+            self.detach(dev_node)
+        self.report_socket.stop()
+        self.input_reader.stop()
+
+    def resources(self):
+        return {"keyboards": len(self.keyboards), "files": self.open_files, "watches": self.input_reader.watches(),
+                "led_fds": len(self.led_writer.writers)}
+
+    def led_stats(self):
+        return dict(self.led_writer.stats(), suppressed=self.leds_suppressed)
 
     def print(self):
-        for key, device in self.keyboards.items():
-            hid_raw = Hidraw(device.device_node)
-            d = hid_raw.report_descriptor
-            s = bytearray(d).hex()
-            logging.info(len(d))
-            logging.info(hid_raw.name)
-            logging.info(s)
-
-
-def is_keyboard(hidraw):
-    descriptor = hidraw.report_descriptor
-    hex_string = bytearray(descriptor).hex()
-    return hex_string.startswith("05010906a101050719e0")
+        for keyboard in self.keyboards.values():
+            keyboard.print()
+
+
+def discard(report):
+    pass
+
+
+def udev_identity(device):
+    """
+    (bustype, vendor, product, name, descriptor) from udev properties and sysfs,
+    without opening the hidraw node. None when udev does not provide them.
+    """
+    hid = device.find_parent('hid')
+    if hid is None:
+        return None
+    hid_id = hid.properties.get('HID_ID')
+    descriptor = hid.attributes.get('report_descriptor')
+    if not hid_id or descriptor is None:
+        return None
+    bustype, vendor, product = (int(part, 16) for part in hid_id.split(':'))
+    return bustype, vendor, product, hid.properties.get('HID_NAME', ''), list(descriptor)
 
 
 keyboards = Keyboards()
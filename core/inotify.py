@@ -0,0 +1,49 @@
+"""
+Change notification for single files through inotify.
+
+The directory of the file is watched rather than the file itself, so a file
+replaced by renaming another over it, as editors and atomic saves do, is
+still seen.
+"""
+import ctypes
+import os
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT = struct.Struct("iIII")
+
+
+def watch_file(path):
+    """
+    Non-blocking inotify fd reporting files written or moved into the directory of path.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    directory = os.path.dirname(os.path.abspath(path))
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, os.strerror(error), directory)
+    return fd
+
+
+def changed_names(fd):
+    """
+    Names of the files changed since the last call.
+    """
+    names = set()
+    try:
+        data = os.read(fd, 4096)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+        offset += length
+    return names
@@ -0,0 +1,328 @@
+import logging
+import time
+
+from core.adapters import adapter_name
+from core.bluez_objects import bluez_objects, DEVICE_IFACE
+from core.config import config
+from core.gatt_profile import PROTOCOL_MODE_BOOT, PROTOCOL_MODE_REPORT, PROTOCOL_MODES
+from core.hidraw_keyboard import keyboards
+from core.keyboard_layouts import LAYOUTS, DEFAULT_LAYOUT
+from core.report_scheduler import ReportScheduler, DEFAULT_INTERVAL_MS, DEFAULT_REPORTS_PER_INTERVAL
+from core.startup import startup
+from core.text_typer import RELEASE, ReportSequence, TextTyper
+from core.tracing import tracer
+
+DEFAULT_MAX_BACKLOG = 256
+
+
+class InputPipeline:
+    """
+    Keyboard input behind the HID service of one adapter.
+
+    Reports go through one scheduler whose output is the Report
+    characteristic in report protocol mode and the Boot Keyboard Input
+    Report characteristic in boot protocol mode. Both carry the same 8 byte
+    report without a report ID, so switching modes only redirects the
+    scheduler and takes effect with the next report. Input runs while the
+    host is subscribed to either characteristic.
+
+    A host that falls more than max_backlog reports behind the keyboards has
+    its queued reports dropped and is sent the keys held now, so it never
+    holds up the hosts on other adapters and still ends up with the right
+    keys pressed.
+
+    When the host's link is lost, the time until it is connected again, until
+    it subscribes to input and until the first report is sent to it are kept
+    for the last reconnect.
+    """
+
+    def __init__(self, name, report_send, boot_send):
+        self.name = name
+        self.targets = {PROTOCOL_MODE_REPORT: report_send, PROTOCOL_MODE_BOOT: boot_send}
+        self.protocol_mode = PROTOCOL_MODE_REPORT
+        self.subscribed = set()
+        self.scheduler = ReportScheduler(report_send)
+        self.typer = TextTyper(self.scheduler, keyboards.report_merger.current)
+        self.max_backlog = config.get_int("Pacing", "max_backlog", DEFAULT_MAX_BACKLOG)
+        self.dropped = 0
+        self.link_lost_at = None
+        self.reconnects = 0
+        self.reconnect_ms = 0.0
+        self.ready_ms = 0.0
+        self.first_keystroke_ms = 0.0
+        report_fanout.pipelines[name] = self
+        config.watch("Pacing", self.configure)
+        bluez_objects.listeners.append(self.device_changed)
+
+    def configure(self):
+        interval_ms = config.get_float("Pacing", "interval_ms", DEFAULT_INTERVAL_MS)
+        if interval_ms <= 0:
+            raise ValueError(f"interval_ms must be positive, not {interval_ms}")
+        self.scheduler.configure(interval_ms,
+                                 config.get_int("Pacing", "reports_per_interval", DEFAULT_REPORTS_PER_INTERVAL))
+        self.max_backlog = config.get_int("Pacing", "max_backlog", DEFAULT_MAX_BACKLOG)
+
+    def submit(self, report):
+        if self.link_lost_at is not None:
+            self.first_keystroke()
+        scheduler = self.scheduler
+        # typed text is queued all at once and never dropped
+        if len(scheduler.queue) >= self.max_backlog and not self.typer.busy():
+            self.dropped += len(scheduler.queue)
+            logging.info(f"{self.name}: dropped {len(scheduler.queue)} reports, the host is not keeping up")
+            scheduler.clear()
+        scheduler.submit(report)
+
+    def set_protocol_mode(self, mode):
+        if mode not in PROTOCOL_MODES or mode == self.protocol_mode:
+            return
+        self.protocol_mode = mode
+        self.scheduler.send = self.targets[mode]
+        logging.info(f"{self.name}: protocol mode {PROTOCOL_MODES[mode]}")
+        if self.subscribed:
+            # the keys held now, on the characteristic the host reads from now
+            self.scheduler.submit(keyboards.report_merger.current())
+
+    def device_changed(self, path, changed):
+        if "Connected" not in changed \
+                or adapter_name(str(bluez_objects.property(path, DEVICE_IFACE, "Adapter", ""))) != self.name:
+            return
+        now = time.monotonic()
+        if not changed["Connected"]:
+            self.link_lost_at = self.link_lost_at or now
+        elif self.link_lost_at is not None:
+            self.reconnect_ms = (now - self.link_lost_at) * 1000
+
+    def first_keystroke(self):
+        self.first_keystroke_ms = (time.monotonic() - self.link_lost_at) * 1000
+        self.link_lost_at = None
+        self.reconnects += 1
+        logging.info(f"{self.name}: reconnected in {self.reconnect_ms:.0f} ms, "
+                     f"subscribed after {self.ready_ms:.0f} ms, first keystroke after {self.first_keystroke_ms:.0f} ms")
+
+    def subscribe(self, characteristic):
+        if not self.subscribed:
+            if self.link_lost_at is not None:
+                self.ready_ms = (time.monotonic() - self.link_lost_at) * 1000
+            report_fanout.attach(self)
+        self.subscribed.add(characteristic)
+
+    def unsubscribe(self, characteristic):
+        self.subscribed.discard(characteristic)
+        if not self.subscribed:
+            self.typer.cancel("Host unsubscribed")
+            self.scheduler.clear()
+            report_fanout.detach(self)
+
+    def stats(self):
+        stats = self.scheduler.stats()
+        latency = stats.pop("latency_ms")
+        stats.update({f"latency_{name}_ms": value for name, value in latency.items() if name != "count"})
+        stats["dropped"] = self.dropped
+        stats["reconnects"] = self.reconnects
+        stats["reconnect_ms"] = self.reconnect_ms
+        stats["ready_ms"] = self.ready_ms
+        stats["first_keystroke_ms"] = self.first_keystroke_ms
+        stats["subscribed"] = len(self.subscribed)
+        return {name: float(value) for name, value in stats.items()}
+
+
+class ReportFanout:
+    """
+    Hands every report read from the keyboards to the pipelines of subscribed hosts.
+
+    The keyboards are read and their reports merged once however many hosts
+    are subscribed; each host then has its own scheduler and pacing. The
+    report socket is throttled by the host with the shortest queue, slower
+    hosts are held to their max_backlog by InputPipeline.
+
+    With [Switching] hotkey set, reports go to one active host instead of
+    all of them, and pressing the hotkey switches to the next subscribed
+    host: the old host is sent a release of all keys and the new one the
+    keys held now, both ahead of anything still queued, so the switch is
+    complete within one connection interval. The hotkey itself never reaches
+    a host.
+    """
+
+    def __init__(self):
+        # every pipeline by adapter name, subscribed or not
+        self.pipelines = {}
+        self.subscribed = []
+        self.active = None
+        self.hotkey = None
+        self.hotkey_held = False
+        self.switches = 0
+        self.configure()
+        config.watch("Switching", self.configure)
+
+    def configure(self):
+        hotkey = config.get("Switching", "hotkey", "").strip()
+        self.hotkey = parse_hotkey(hotkey) if hotkey else None
+        self.hotkey_held = False
+        logging.info(f"Host switching hotkey: {hotkey or 'none'}")
+        if not self.subscribed:
+            return
+        if self.hotkey is None:
+            self.active = None
+        elif self.active is None:
+            self.active = self.subscribed[0]
+        keyboards.set_event_callback(self.emit())
+
+    def submit(self, report):
+        for pipeline in self.subscribed:
+            pipeline.submit(report)
+
+    def holds_hotkey(self, report):
+        modifiers, key = self.hotkey
+        return report[0] & modifiers == modifiers and key in report[2:]
+
+    def route(self, report):
+        key = self.hotkey[1]
+        if self.holds_hotkey(report):
+            stripped = strip_key(report, key)
+            if tracer.enabled:
+                tracer.replace(report, stripped)
+            report = stripped
+            if not self.hotkey_held:
+                self.hotkey_held = True
+                self.switch(self.next_host(), report)
+                return
+        else:
+            self.hotkey_held = False
+        if self.active is not None:
+            self.active.submit(report)
+
+    def resync(self, report):
+        """
+        Sends the keys held right now when watching resumes.
+
+        A hotkey chord in it was held before the host subscribed, so it does
+        not switch hosts; it only counts as held until it is released.
+        """
+        if self.hotkey is None:
+            self.emit()(report)
+            return
+        if self.holds_hotkey(report):
+            self.hotkey_held = True
+            report = strip_key(report, self.hotkey[1])
+        else:
+            self.hotkey_held = False
+        if self.active is not None:
+            self.active.submit(report)
+
+    def backlog(self):
+        if self.hotkey is not None:
+            return self.active.scheduler.backlog() if self.active is not None else 0
+        return min((pipeline.scheduler.backlog() for pipeline in self.subscribed), default=0)
+
+    def emit(self):
+        if self.hotkey is not None:
+            return self.route
+        return self.subscribed[0].submit if len(self.subscribed) == 1 else self.submit
+
+    def attach(self, pipeline):
+        if pipeline in self.subscribed:
+            return
+        self.subscribed.append(pipeline)
+        logging.info(f"{pipeline.name}: host subscribed, {len(self.subscribed)} hosts")
+        if self.hotkey is not None and self.active is None:
+            self.active = pipeline
+        if len(self.subscribed) == 1:
+            startup.mark("first connection")
+            keyboards.watch(self.emit(), self.backlog, self.resync)
+            logging.info("Started HID keyboard watching")
+            return
+        keyboards.set_event_callback(self.emit())
+        if self.hotkey is None:
+            pipeline.scheduler.submit(keyboards.report_merger.current())
+
+    def detach(self, pipeline):
+        if pipeline not in self.subscribed:
+            return
+        self.subscribed.remove(pipeline)
+        logging.info(f"{pipeline.name}: host unsubscribed, {len(self.subscribed)} hosts")
+        if not self.subscribed:
+            self.active = None
+            keyboards.pause()
+            return
+        if pipeline is self.active:
+            self.active = None
+            self.switch(self.subscribed[0], self.current())
+        keyboards.set_event_callback(self.emit())
+
+    def next_host(self):
+        if not self.subscribed:
+            return None
+        if self.active not in self.subscribed:
+            return self.subscribed[0]
+        return self.subscribed[(self.subscribed.index(self.active) + 1) % len(self.subscribed)]
+
+    def switch_to(self, name):
+        """
+        Makes the host on adapter name the active one.
+        """
+        pipeline = self.pipelines.get(name)
+        if pipeline is None or pipeline not in self.subscribed:
+            raise ValueError(f"No host is subscribed on {name}")
+        if self.hotkey is None:
+            raise ValueError("Host switching is not enabled")
+        self.switch(pipeline, self.current())
+
+    def switch(self, pipeline, report):
+        old = self.active
+        if pipeline is None or pipeline is old:
+            return
+        start = time.monotonic()
+        self.active = pipeline
+        self.switches += 1
+        if old is not None:
+            old.typer.cancel("Switched to another host")
+            old.scheduler.clear()
+            old.scheduler.submit(RELEASE)
+        pipeline.scheduler.clear()
+        pipeline.scheduler.submit(report)
+        logging.info(f"Switched from {old.name if old else None} to {pipeline.name} "
+                     f"in {(time.monotonic() - start) * 1000:.3f} ms")
+
+    def current(self):
+        report = keyboards.report_merger.current()
+        return strip_key(report, self.hotkey[1]) if self.hotkey is not None else report
+
+    def stats(self):
+        """
+        {adapter: {stat: value}}, latencies in ms
+        """
+        stats = {name: pipeline.stats() for name, pipeline in self.pipelines.items()}
+        for name, pipeline in self.pipelines.items():
+            stats[name]["active"] = float(pipeline is self.active)
+            stats[name]["switches"] = float(self.switches)
+        return stats
+
+
+def adapter_stats():
+    """
+    Stats of every adapter's pipeline with the connection state of its hosts.
+    """
+    stats = report_fanout.stats()
+    for name, connections in bluez_objects.stats().items():
+        if name in stats:
+            stats[name].update(connections)
+    return stats
+
+
+def parse_hotkey(chord):
+    """
+    (modifier bits, key usage) of a chord such as RCTRL+SCROLLLOCK.
+    """
+    sequence = ReportSequence()
+    sequence.chord(chord, LAYOUTS[DEFAULT_LAYOUT])
+    report = sequence.steps[0]
+    return report[0], report[2]
+
+
+def strip_key(report, key):
+    keys = [usage for usage in report[2:] if usage != key]
+    return bytes([report[0], 0] + keys + [0] * (6 - len(keys)))
+
+
+report_fanout = ReportFanout()
@@ -0,0 +1,253 @@
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from core.event_loop import event_loop
+from core.tracing import tracer
+
+DEFAULT_QUEUE_SIZE = 256
+
+
+class InputReader(threading.Thread):
+    """
+    Reads every hidraw device from one epoll-driven thread.
+
+    Reports are read and translated on this thread and passed through a bounded
+    queue to the main loop, which is woken through a pipe watched at high
+    priority and runs filtering, merging and D-Bus emission. Key input is
+    therefore never read late because the main loop is busy with D-Bus
+    traffic. When the queue is full the reader wakes the main loop and blocks
+    until it has been drained, leaving further reports buffered in the kernel.
+
+    Devices are added and removed from the main loop; the lock guarantees a
+    device file is never closed while this thread reads it. While paused the
+    devices stay open but are not polled, so reports wait in the kernel.
+    """
+
+    def __init__(self, handler, max_queue=DEFAULT_QUEUE_SIZE):
+        threading.Thread.__init__(self, name="InputReader", daemon=True)
+        self.handler = handler
+        self.queue = queue.Queue(max_queue)
+        self.epoll = select.epoll()
+        self.lock = threading.Lock()
+        self.keyboards = {}
+        self.wake_r, self.wake_w = os.pipe()
+        self.stop_r, self.stop_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.epoll.register(self.stop_r, select.EPOLLIN)
+        self.source = None
+        self.paused = False
+
+    def start_once(self):
+        if self.source is None:
+            self.source = event_loop.io_add_watch(self.wake_r, self.dispatch, high_priority=True)
+            self.start()
+
+    def add(self, keyboard):
+        fd = keyboard.file.fileno()
+        with self.lock:
+            self.keyboards[fd] = keyboard
+            if not self.paused:
+                self.epoll.register(fd, select.EPOLLIN)
+
+    def remove(self, keyboard):
+        with self.lock:
+            self.unregister(keyboard.file.fileno())
+
+    def unregister(self, fd):
+        if self.keyboards.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except OSError:
+                pass
+
+    def watches(self):
+        return 0 if self.paused else len(self.keyboards)
+
+    def pause(self):
+        with self.lock:
+            if self.paused:
+                return
+            self.paused = True
+            for fd in self.keyboards:
+                self.epoll.unregister(fd)
+
+    def resume(self):
+        """
+        Polls the devices again; returns the queued items and the reports read while paused.
+        """
+        with self.lock:
+            items = self.take_queued()
+            if not self.paused:
+                return items
+            self.paused = False
+            for fd, keyboard in list(self.keyboards.items()):
+                if read_reports(keyboard, items, 0.0):
+                    self.epoll.register(fd, select.EPOLLIN)
+                else:
+                    self.keyboards.pop(fd)
+        return items
+
+    def stop(self):
+        os.write(self.stop_w, b"\0")
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+            self.source = None
+
+    def run(self):
+        logging.info("Input reader started")
+        while True:
+            events = self.epoll.poll()
+            wakeup = time.monotonic() if tracer.enabled else 0.0
+            batch = []
+            with self.lock:
+                for fd, mask in events:
+                    if fd == self.stop_r:
+                        logging.info("Input reader stopped")
+                        return
+                    keyboard = self.keyboards.get(fd)
+                    if keyboard is not None and not read_reports(keyboard, batch, wakeup):
+                        self.unregister(fd)
+            if batch:
+                for item in batch:
+                    try:
+                        self.queue.put_nowait(item)
+                    except queue.Full:
+                        # the main loop has to be woken before the reader waits for it
+                        self.wake()
+                        self.queue.put(item)
+                self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            # the main loop has a wakeup pending already
+            pass
+
+    def dispatch(self):
+        try:
+            os.read(self.wake_r, 4096)
+        except BlockingIOError:
+            pass
+        items = self.take_queued()
+        if items:
+            self.handler(items)
+        return True
+
+    def take_queued(self):
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+
+
+class LoopInputReader:
+    """
+    Reads hidraw devices from the event loop, one watch per device.
+
+    Used with the asyncio backend, where input shares the loop with D-Bus.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.keyboards = {}
+        self.sources = {}
+        self.paused = False
+
+    def start_once(self):
+        pass
+
+    def add(self, keyboard):
+        fd = keyboard.file.fileno()
+        self.keyboards[fd] = keyboard
+        if not self.paused:
+            self.add_watch(fd)
+
+    def add_watch(self, fd):
+        self.sources[fd] = event_loop.io_add_watch(fd, lambda: self.ready(fd), high_priority=True)
+
+    def remove(self, keyboard):
+        fd = keyboard.file.fileno()
+        self.keyboards.pop(fd, None)
+        source = self.sources.pop(fd, None)
+        if source is not None:
+            event_loop.source_remove(source)
+
+    def watches(self):
+        return len(self.sources)
+
+    def pause(self):
+        self.paused = True
+        for source in self.sources.values():
+            event_loop.source_remove(source)
+        self.sources.clear()
+
+    def resume(self):
+        items = []
+        if not self.paused:
+            return items
+        self.paused = False
+        for fd, keyboard in list(self.keyboards.items()):
+            if read_reports(keyboard, items, 0.0):
+                self.add_watch(fd)
+            else:
+                self.keyboards.pop(fd)
+        return items
+
+    def stop(self):
+        pass
+
+    def ready(self, fd):
+        keyboard = self.keyboards.get(fd)
+        if keyboard is None:
+            return False
+        batch = []
+        ok = read_reports(keyboard, batch, time.monotonic() if tracer.enabled else 0.0)
+        if not ok:
+            # returning False removes the watch
+            self.keyboards.pop(fd, None)
+            self.sources.pop(fd, None)
+        if batch:
+            self.handler(batch)
+        return ok
+
+
+def read_reports(keyboard, batch, wakeup):
+    """
+    Reads all pending reports of a device into batch as (dev_node, report, wakeup, read) items.
+
+    Returns False when the device failed; a None report is queued for it then.
+    """
+    read = keyboard.file.readinto
+    view = keyboard.view
+    length = keyboard.report_length
+    translate = keyboard.translate
+    dev_node = keyboard.dev_node
+    while True:
+        try:
+            size = read(view)
+        except OSError as error:
+            logging.info(f"{dev_node}: {error}")
+            batch.append((dev_node, None, wakeup, wakeup))
+            return False
+        if size is None:
+            return True
+        read_time = time.monotonic() if tracer.enabled else 0.0
+        if not size:
+            batch.append((dev_node, b"", wakeup, read_time))
+            return True
+        report = view if size == length else view[:size]
+        if translate is not None:
+            report = translate(report)
+            if report is None:
+                continue
+        else:
+            report = bytes(report)
+        batch.append((dev_node, report, wakeup, read_time))
@@ -0,0 +1,58 @@
+"""
+Character to HID keyboard usage tables per host keyboard layout.
+
+A layout lists, for the keys in KEYS, the character each key produces alone,
+with Shift and with AltGr ("\0" where it produces none, or only a dead key).
+The tables are compiled once into ready-made press reports per character.
+"""
+
+KEY_SHIFT = 0x02
+KEY_ALTGR = 0x40
+
+KEY_ENTER = 0x28
+KEY_ESCAPE = 0x29
+KEY_BACKSPACE = 0x2a
+KEY_TAB = 0x2b
+KEY_SPACE = 0x2c
+
+# a-z, 1-0, the punctuation keys - = [ ] \ (non-US #) ; ' ` , . / and the non-US \ key
+KEYS = bytes(range(0x04, 0x28)) + bytes(range(0x2d, 0x39)) + bytes([0x64])
+
+COMMON = {"\n": KEY_ENTER, "\t": KEY_TAB, " ": KEY_SPACE, "\b": KEY_BACKSPACE, "\x1b": KEY_ESCAPE}
+
+LAYOUT_TABLES = {
+    "us": (
+        "abcdefghijklmnopqrstuvwxyz" "1234567890" "-=[]\\\0;'`,./" "\0",
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZ" "!@#$%^&*()" "_+{}|\0:\"~<>?" "\0",
+        "\0" * len(KEYS),
+    ),
+    "de": (
+        "abcdefghijklmnopqrstuvwxzy" "1234567890" "ß\0ü+\0#öä\0,.-" "<",
+        "ABCDEFGHIJKLMNOPQRSTUVWXZY" "!\"§$%&/()=" "?\0Ü*\0'ÖÄ°;:_" ">",
+        "\0\0\0\0€\0\0\0\0\0\0\0µ\0\0\0@\0\0\0\0\0\0\0\0\0" "\0²³\0\0\0{[]}" "\\\0\0~\0\0\0\0\0\0\0\0" "|",
+    ),
+    "fr": (
+        "qbcdefghijkl,noparstuvzxyw" "&é\"'(-è_çà" ")=\0$\0*mù²;:!" "<",
+        "QBCDEFGHIJKL?NOPARSTUVZXYW" "1234567890" "°+\0£\0µM%\0./§" ">",
+        "\0\0\0\0€\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0" "\0\0#{[|\0\\^@" "]}\0¤\0\0\0\0\0\0\0\0" "\0",
+    ),
+}
+
+DEFAULT_LAYOUT = "us"
+
+
+def compile_layout(tables):
+    """
+    ``{character: press report}`` for one layout.
+    """
+    reports = {}
+    for modifiers, characters in zip((0, KEY_SHIFT, KEY_ALTGR), tables):
+        for usage, character in zip(KEYS, characters):
+            if character != "\0" and character not in reports:
+                reports[character] = bytes([modifiers, 0, usage, 0, 0, 0, 0, 0])
+    for character, usage in COMMON.items():
+        reports[character] = bytes([0, 0, usage, 0, 0, 0, 0, 0])
+    return reports
+
+
+LAYOUTS = {name: compile_layout(tables) for name, tables in LAYOUT_TABLES.items()}
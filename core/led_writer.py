@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+
+
+class DeviceLedWriter(threading.Thread):
+    """
+    Writes the LED output reports of one hidraw device from a thread of its own.
+
+    A hidraw write is a synchronous transfer to the device, an interrupt OUT or
+    SET_REPORT on USB, however the file was opened, so a slow or wedged
+    keyboard blocks whoever writes to it; with a thread per device it only
+    holds up its own LEDs. The thread owns a duplicate of the hidraw file
+    descriptor and closes it itself, so a device removed during a write is
+    never written through a reused descriptor. Only the newest report is
+    kept: a report not written yet is replaced by a later one.
+    """
+
+    def __init__(self, dev_node, fd):
+        threading.Thread.__init__(self, name=f"LedWriter {dev_node}", daemon=True)
+        self.dev_node = dev_node
+        self.fd = fd
+        self.condition = threading.Condition()
+        self.report = None
+        self.closing = False
+        self.writes = 0
+        self.replaced = 0
+        self.failed = 0
+
+    def submit(self, report):
+        with self.condition:
+            if self.report is not None:
+                self.replaced += 1
+            self.report = report
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.report is None and not self.closing:
+                    self.condition.wait()
+                if self.closing:
+                    os.close(self.fd)
+                    return
+                report, self.report = self.report, None
+            try:
+                os.write(self.fd, report)
+                self.writes += 1
+            except OSError as error:
+                self.failed += 1
+                logging.info(f"{self.dev_node}: LED report {report.hex()} not written: {error}")
+
+    def stats(self):
+        return {"writes": self.writes, "replaced": self.replaced, "failed": self.failed}
+
+
+class LedWriter:
+    """
+    LED output reports of every keyboard, each written by its own DeviceLedWriter.
+
+    The main loop only hands reports over and never waits.
+    """
+
+    def __init__(self):
+        # dev_node: DeviceLedWriter
+        self.writers = {}
+        # counts of the writers of removed devices
+        self.totals = {"writes": 0, "replaced": 0, "failed": 0}
+
+    def add(self, keyboard):
+        self.remove(keyboard.dev_node)
+        writer = self.writers[keyboard.dev_node] = DeviceLedWriter(keyboard.dev_node, os.dup(keyboard.file.fileno()))
+        writer.start()
+
+    def remove(self, dev_node):
+        writer = self.writers.pop(dev_node, None)
+        if writer is not None:
+            writer.close()
+            for name, value in writer.stats().items():
+                self.totals[name] += value
+
+    def write(self, dev_node, report):
+        writer = self.writers.get(dev_node)
+        if writer is not None:
+            writer.submit(report)
+
+    def stats(self):
+        stats = dict(self.totals)
+        for writer in self.writers.values():
+            for name, value in writer.stats().items():
+                stats[name] += value
+        return stats
@@ -0,0 +1,148 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+from collections import deque
+
+LOG_FORMAT = "%(asctime)s [%(threadName)s][%(levelname)s] %(message)s"
+DEFAULT_LEVEL = "INFO"
+DEFAULT_RING_SIZE = 1000
+DEFAULT_RATE_INTERVAL_MS = 1000
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the most recent records in memory.
+
+    The ring may hold records below the level written to the log; they are
+    written out as context when an error is logged, only those added since
+    the last error so repeated errors do not repeat the same context, or all
+    of them on dump().
+    """
+
+    def __init__(self, capacity, output, output_level):
+        logging.Handler.__init__(self)
+        self.records = deque(maxlen=capacity)
+        self.output = output
+        self.output_level = output_level
+        # records appended, and appended when context was last written
+        self.added = 0
+        self.written = 0
+
+    def emit(self, record):
+        self.records.append(record)
+        self.added += 1
+        if record.levelno >= logging.ERROR and self.output_level > self.level:
+            fresh = min(len(self.records), self.added - self.written)
+            self.written = self.added
+            records = itertools.islice(self.records, len(self.records) - fresh, None)
+            self.write([r for r in records if r.levelno < self.output_level], "before the error")
+
+    def dump(self):
+        self.write(list(self.records), "in memory")
+
+    def write(self, records, title):
+        if not records:
+            return
+        self.output(logging.makeLogRecord({"msg": f"---- {len(records)} recent events {title} ----",
+                                           "levelno": logging.INFO, "levelname": "INFO"}))
+        for record in records:
+            self.output(record)
+        self.output(logging.makeLogRecord({"msg": "---- end of recent events ----",
+                                           "levelno": logging.INFO, "levelname": "INFO"}))
+
+
+class EventRate:
+    """
+    Logs how many events happened per interval instead of one line per event.
+
+    The first event of an interval arms an event loop timeout; counting is all
+    an event costs.
+    """
+    __slots__ = ("name", "interval_ms", "count", "source")
+
+    def __init__(self, name, interval_ms=DEFAULT_RATE_INTERVAL_MS):
+        self.name = name
+        self.interval_ms = interval_ms
+        self.count = 0
+        self.source = None
+
+    def hit(self):
+        self.count += 1
+        if self.source is None:
+            # imported here: the event loop reads the config, which is loaded after logging is set up
+            from core.event_loop import event_loop
+            self.source = event_loop.timeout_add(self.interval_ms, self.flush)
+
+    def flush(self):
+        logging.info(f"{self.count} {self.name} in last {self.interval_ms / 1000:g} s")
+        self.count = 0
+        self.source = None
+        return False
+
+
+class LogPipeline:
+    """
+    Root logging through a queue: records are formatted and written by a
+    background listener thread, so callers on the input path never wait on I/O.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.output = logging.StreamHandler()
+        self.output.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.listener = logging.handlers.QueueListener(self.queue, self.output, respect_handler_level=True)
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.ring = None
+
+    def start(self):
+        root = logging.getLogger()
+        root.handlers = [self.queue_handler]
+        root.setLevel(logging.INFO)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def configure(self, level, ring_size, ring_level):
+        level = logging.getLevelName(level.upper())
+        ring_level = logging.getLevelName(ring_level.upper())
+        if not isinstance(level, int) or not isinstance(ring_level, int):
+            logging.warning("Unknown log level, using INFO")
+            level = ring_level = logging.INFO
+        root = logging.getLogger()
+        self.queue_handler.setLevel(level)
+        old_ring = self.ring
+        self.ring = RingBufferHandler(ring_size, self.queue_handler.enqueue, level)
+        self.ring.setLevel(ring_level)
+        if old_ring is not None:
+            # reconfigured at runtime: keep the recent events
+            root.removeHandler(old_ring)
+            self.ring.records.extend(old_ring.records)
+            self.ring.added, self.ring.written = old_ring.added, old_ring.written
+        root.addHandler(self.ring)
+        root.setLevel(min(level, ring_level))
+
+    def dump(self):
+        if self.ring is not None:
+            self.ring.dump()
+
+
+log_pipeline = LogPipeline()
+
+
+def setup_logging():
+    """
+    Starts the queue-based logging and applies the [Logging] section of the config.
+    """
+    log_pipeline.start()
+    # config logs while loading, so it is imported once the handlers are in place
+    from core.config import config
+    configure_logging()
+    config.watch("Logging", configure_logging)
+
+
+def configure_logging():
+    from core.config import config
+    level = config.get("Logging", "level", DEFAULT_LEVEL)
+    log_pipeline.configure(level, config.get_int("Logging", "ring_size", DEFAULT_RING_SIZE),
+                           config.get("Logging", "ring_level", level))
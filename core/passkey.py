@@ -0,0 +1,32 @@
+"""
+Passkey entry during pairing.
+
+The keyboard module is imported on the first pairing request only: it is slow
+to import, and an already paired keyboard never needs it.
+"""
+
+# a passkey has six decimal digits
+MAX_PASSKEY = 999999
+
+
+def get_passkey():
+    import keyboard
+
+    recorded = keyboard.record(until="enter")
+    passkey = ''
+    for i in range(len(recorded) - 2):
+        event = recorded[i]
+        if event.event_type == "down":
+            passkey = passkey + event.name
+    return passkey
+
+
+def parse_passkey(passkey):
+    """
+    The typed passkey as a number, None when it is empty or not a passkey.
+    """
+    try:
+        value = int(passkey)
+    except ValueError:
+        return None
+    return value if 0 <= value <= MAX_PASSKEY else None
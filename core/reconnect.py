@@ -0,0 +1,138 @@
+"""
+Advertising modes of the reconnect window.
+
+After startup and whenever a host's link is lost the keyboard first gives
+its bonded hosts a head start: for [Advertising] bonded_window_s seconds an
+adapter with bonded hosts advertises at the fast intervals without the
+discoverable flag, so hosts that scan for new devices do not list it while
+a bonded host, which connects to a known address, reconnects. BlueZ offers
+neither directed advertising nor the controller's filter accept list to
+advertisers, so this is the closest preference it allows. The keyboard then
+advertises at the fast intervals with discoverability as configured, so new
+hosts can still pair, until [Advertising] fast_window_s seconds have
+passed, and then backs off to the slow intervals to save power.
+
+BlueZ reads the advertisement's properties when it is registered, so a
+change of mode registers the advertisement again.
+"""
+import logging
+
+from core.adapters import adapter_name
+from core.bluez_objects import bluez_objects, DEVICE_IFACE
+from core.config import config
+from core.event_loop import event_loop
+
+BONDED = "bonded"
+FAST = "fast"
+SLOW = "slow"
+# the intervals recommended for accessories that should be found quickly, then at low power
+DEFAULT_INTERVALS_MS = {FAST: (20, 30), SLOW: (152, 211)}
+DEFAULT_BONDED_WINDOW_S = 5
+DEFAULT_FAST_WINDOW_S = 30
+
+
+class ReconnectAdvertising:
+
+    def __init__(self, adapter, apply):
+        self.adapter = adapter
+        # called with no arguments to register the advertisement again
+        self.apply = apply
+        self.mode = FAST
+        self.source = None
+        self.bonded_window = DEFAULT_BONDED_WINDOW_S
+        self.fast_window = DEFAULT_FAST_WINDOW_S
+        self.configure()
+        bluez_objects.listeners.append(self.device_changed)
+        config.watch("Advertising", self.config_changed)
+
+    def configure(self):
+        self.fast_window = config.get_float("Advertising", "fast_window_s", DEFAULT_FAST_WINDOW_S)
+        self.bonded_window = min(self.fast_window,
+                                 config.get_float("Advertising", "bonded_window_s", DEFAULT_BONDED_WINDOW_S))
+
+    def intervals(self):
+        """
+        (min, max) advertising interval of the current mode, in ms.
+        """
+        mode = SLOW if self.mode == SLOW else FAST
+        low, high = DEFAULT_INTERVALS_MS[mode]
+        low = config.get_int("Advertising", f"{mode}_min_interval_ms", low)
+        high = config.get_int("Advertising", f"{mode}_max_interval_ms", high)
+        return low, max(low, high)
+
+    def discoverable(self, configured):
+        """
+        Whether the advertisement sets the discoverable flag, given the configured discoverability.
+        """
+        return configured and self.mode != BONDED
+
+    def start(self):
+        """
+        Opens the reconnect window when the advertisement is first registered.
+
+        The mode is set without calling apply(): the advertisement is being
+        registered with it.
+        """
+        self.mode = BONDED if self.bonded_hosts() else FAST
+        self.schedule_window()
+
+    def bonded_hosts(self):
+        return self.bonded_window > 0 \
+            and any(bluez_objects.bonded(path) for path in bluez_objects.devices(self.adapter))
+
+    def open_window(self):
+        self.set_mode(BONDED if self.bonded_hosts() else FAST)
+        self.schedule_window()
+
+    def schedule_window(self):
+        if self.mode == BONDED:
+            self.schedule(self.bonded_window, self.open_to_all)
+        else:
+            self.schedule(self.fast_window, self.slow_down)
+
+    def schedule(self, delay_s, callback):
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+        self.source = event_loop.timeout_add(delay_s * 1000, callback)
+
+    def open_to_all(self):
+        self.source = None
+        self.set_mode(FAST)
+        self.schedule(self.fast_window - self.bonded_window, self.slow_down)
+        return False
+
+    def slow_down(self):
+        self.source = None
+        self.set_mode(SLOW)
+        return False
+
+    def set_mode(self, mode):
+        if mode == self.mode:
+            return
+        self.mode = mode
+        low, high = self.intervals()
+        logging.info(f"{adapter_name(self.adapter)}: {mode} advertising, {low}-{high} ms")
+        self.apply()
+
+    def device_changed(self, path, changed):
+        if "Connected" not in changed or bluez_objects.property(path, DEVICE_IFACE, "Adapter") != self.adapter:
+            return
+        if changed["Connected"]:
+            if self.source is not None:
+                event_loop.source_remove(self.source)
+                self.source = None
+            self.set_mode(SLOW)
+        else:
+            self.open_window()
+
+    def config_changed(self):
+        self.configure()
+        self.apply()
+
+
+def includes():
+    return [name.strip() for name in config.get("Advertising", "includes", "").split(",") if name.strip()]
+
+
+def advertising_timeout():
+    return config.get_int("Advertising", "timeout_s", 0)
@@ -0,0 +1,110 @@
+import logging
+
+REPORT_KEYS_OFFSET = 2
+
+
+class DeviceReports:
+    __slots__ = ("last", "released", "pending", "stamps")
+
+    def __init__(self):
+        # last accepted report, whether it only released keys held before it
+        # and whether it is still waiting for the window to close
+        self.last = None
+        self.released = False
+        self.pending = False
+        # trace stamps of the last accepted report, None when not traced
+        self.stamps = None
+
+
+class ReportFilter:
+    """
+    Drops reports that would not change the host's view of the keyboard.
+
+    Reports read in one wakeup of the input watch form an emission window.
+    Within a window exact repeats and zero-length reads are dropped, and a run
+    of reports that only release keys is collapsed into its last report:
+    releases commute, so the host ends up in the same state while every press
+    is still delivered in order.
+
+    Trace stamps fed with a report are kept with it and handed to ``stamp``
+    right before the report is emitted, so a report emitted after another
+    device was fed is still attributed to its own device and read.
+    """
+
+    def __init__(self, emit=None, stamp=None):
+        self.emit = emit
+        self.stamp = stamp
+        self.devices = {}
+        self.forwarded = 0
+        self.dropped = 0
+
+    def feed(self, device, report, stamps=None):
+        state = self.devices.get(device)
+        if state is None:
+            state = self.devices[device] = DeviceReports()
+        last = state.last
+        if not report or report == last:
+            self.dropped += 1
+            return
+        released = last is not None and is_release(last, report)
+        if state.pending and state.released and released:
+            # the pending report only released keys and so does this one
+            self.dropped += 1
+        else:
+            if state.pending:
+                self.forwarded += 1
+                if state.stamps is not None:
+                    self.stamp(device, *state.stamps)
+                self.emit(device, last)
+            state.released = released
+        state.last = bytes(report)
+        state.stamps = stamps
+        state.pending = True
+
+    def flush(self, device):
+        state = self.devices.get(device)
+        if state is not None and state.pending:
+            state.pending = False
+            self.forwarded += 1
+            if state.stamps is not None:
+                self.stamp(device, *state.stamps)
+            self.emit(device, state.last)
+
+    def process(self, device, reports):
+        result = []
+        emit = self.emit
+        self.emit = lambda device, report: result.append(report)
+        try:
+            for report in reports:
+                self.feed(device, report)
+            self.flush(device)
+        finally:
+            self.emit = emit
+        return result
+
+    def forget(self, device):
+        self.devices.pop(device, None)
+
+    def stats(self):
+        return {"forwarded": self.forwarded, "dropped": self.dropped}
+
+    def print(self):
+        logging.info(f"Reports forwarded: {self.forwarded}, dropped: {self.dropped}")
+
+
+def is_release(before, after):
+    """
+    True when ``after`` only releases keys or modifiers held in ``before``.
+    """
+    if len(before) != len(after) or before == after:
+        return False
+    if after[0] & ~before[0]:
+        return False
+    if after.count(0, REPORT_KEYS_OFFSET) == len(after) - REPORT_KEYS_OFFSET:
+        # every key released
+        return True
+    for i in range(REPORT_KEYS_OFFSET, len(after)):
+        key = after[i]
+        if key and before.find(key, REPORT_KEYS_OFFSET) < 0:
+            return False
+    return True
@@ -0,0 +1,116 @@
+import logging
+
+from core.config import config
+from core.hid_descriptor import KEY_ERROR_ROLL_OVER, KEY_SLOTS, ROLL_OVER_REPORT
+
+REPORT_KEYS_OFFSET = 2
+
+OVERFLOW_OLDEST = "oldest"
+OVERFLOW_NEWEST = "newest"
+OVERFLOW_ROLLOVER = "rollover"
+OVERFLOW_POLICIES = (OVERFLOW_OLDEST, OVERFLOW_NEWEST, OVERFLOW_ROLLOVER)
+
+# the report of a device that holds nothing
+NO_KEYS = bytes(REPORT_KEYS_OFFSET + KEY_SLOTS)
+
+
+class ReportMerger:
+    """
+    Merges the reports of all keyboards into one outgoing report.
+
+    Every device keeps its own modifiers and pressed keys; the outgoing report
+    holds the union of them. Reference counts per modifier bit and per key
+    make an update cost proportional to the keys that changed, not to the
+    number of devices. Keys are kept in press order; when more than six are
+    held the overflow policy decides what is sent:
+
+    oldest   - the six keys pressed first
+    newest   - the six keys pressed last
+    rollover - ErrorRollOver in every slot, as a keyboard in phantom state does
+    """
+
+    def __init__(self, emit=None, overflow=None):
+        self.emit = emit
+        self.overflow = OVERFLOW_OLDEST
+        self.set_overflow(overflow or config.get("Keyboard", "overflow", OVERFLOW_OLDEST))
+        self.devices = {}
+        self.modifier_counts = [0] * 8
+        self.modifiers = 0
+        # usage -> number of devices holding it, in press order
+        self.keys = {}
+        self.last = NO_KEYS
+
+    def set_overflow(self, overflow):
+        if overflow not in OVERFLOW_POLICIES:
+            logging.warning(f"Unknown overflow policy {overflow}, using {OVERFLOW_OLDEST}")
+            overflow = OVERFLOW_OLDEST
+        self.overflow = overflow
+
+    def process(self, device, report):
+        if report[REPORT_KEYS_OFFSET] == KEY_ERROR_ROLL_OVER:
+            # phantom state: the device cannot tell which keys are down, keep its previous state
+            return
+        old = self.devices.get(device, NO_KEYS)
+        self.devices[device] = report
+        self.update(old, report)
+
+    def remove(self, device):
+        self.update(self.devices.pop(device, NO_KEYS), NO_KEYS)
+
+    def update(self, old, new):
+        """
+        Applies the change from the old to the new report of one device.
+
+        Reports are compared in place, so an update allocates nothing but the
+        outgoing report, and only when the merged state changed.
+        """
+        changed = old[0] ^ new[0]
+        if changed:
+            new_modifiers = new[0]
+            while changed:
+                bit = changed & -changed
+                index = bit.bit_length() - 1
+                if new_modifiers & bit:
+                    self.modifier_counts[index] += 1
+                    self.modifiers |= bit
+                else:
+                    self.modifier_counts[index] -= 1
+                    if not self.modifier_counts[index]:
+                        self.modifiers &= ~bit
+                changed ^= bit
+        keys = self.keys
+        for i in range(REPORT_KEYS_OFFSET, len(old)):
+            key = old[i]
+            if key and new.find(key, REPORT_KEYS_OFFSET) < 0:
+                count = keys[key] - 1
+                if count:
+                    keys[key] = count
+                else:
+                    del keys[key]
+        for i in range(REPORT_KEYS_OFFSET, len(new)):
+            key = new[i]
+            if key and old.find(key, REPORT_KEYS_OFFSET) < 0:
+                keys[key] = keys.get(key, 0) + 1
+
+        report = self.report()
+        if report != self.last:
+            self.last = report
+            self.emit(report)
+
+    def report(self):
+        keys = self.keys
+        if len(keys) > KEY_SLOTS:
+            if self.overflow == OVERFLOW_ROLLOVER:
+                return bytes([self.modifiers]) + ROLL_OVER_REPORT[1:]
+            iterator = iter(keys) if self.overflow == OVERFLOW_OLDEST else reversed(keys)
+            selected = [next(iterator) for _ in range(KEY_SLOTS)]
+            if self.overflow == OVERFLOW_NEWEST:
+                selected.reverse()
+            return bytes([self.modifiers, 0] + selected)
+        return bytes([self.modifiers, 0] + list(keys) + [0] * (KEY_SLOTS - len(keys)))
+
+    def current(self):
+        """
+        The report describing what is held right now on all devices.
+        """
+        return self.last
@@ -0,0 +1,139 @@
+import logging
+import time
+from collections import deque
+
+from core.config import config
+from core.event_loop import event_loop
+from core.tracing import percentiles, tracer
+
+# 7.5 ms is the shortest connection interval allowed by the spec and what
+# most hosts negotiate for HID devices.
+DEFAULT_INTERVAL_MS = 7.5
+DEFAULT_REPORTS_PER_INTERVAL = 1
+
+
+class ReportScheduler:
+    """
+    Paces reports to the connection interval.
+
+    A report is sent at once while the current interval still has a free
+    notification slot and nothing is queued; otherwise it is queued and the
+    queue is drained in order, one interval at a time. Reports are never
+    dropped or reordered, so every release reaches the host after its press.
+    The queue is drained by an event loop timeout armed for each interval
+    against an absolute deadline, so the time the drain takes and the
+    timer's rounding do not add up to a longer interval.
+
+    The time from submit to the send returning is kept for the last
+    LATENCY_WINDOW reports.
+    """
+
+    LATENCY_WINDOW = 1024
+
+    def __init__(self, send, interval_ms=None, reports_per_interval=None):
+        self.send = send
+        # (report, submit time)
+        self.queue = deque()
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self.source = None
+        # when the armed drain is due
+        self.due = 0.0
+        self.idle_callbacks = []
+        self.window_start = 0.0
+        self.window_sent = 0
+        self.sent = 0
+        self.delayed = 0
+        self.max_depth = 0
+        self.interval = 0.0
+        self.reports_per_interval = 1
+        self.configure(
+            interval_ms or config.get_float("Pacing", "interval_ms", DEFAULT_INTERVAL_MS),
+            reports_per_interval or config.get_int("Pacing", "reports_per_interval", DEFAULT_REPORTS_PER_INTERVAL))
+
+    def configure(self, interval_ms, reports_per_interval):
+        self.interval = interval_ms / 1000
+        self.reports_per_interval = max(1, reports_per_interval)
+        logging.info(f"Pacing reports: {self.reports_per_interval} per {interval_ms} ms")
+
+    def submit(self, report):
+        now = time.monotonic()
+        if not self.queue and self.take_slot(now):
+            self.sent += 1
+            self.send(report)
+            self.latencies.append(time.monotonic() - now)
+            return
+        self.queue.append((report, now))
+        self.delayed += 1
+        self.max_depth = max(self.max_depth, len(self.queue))
+        if self.source is None:
+            # the first report waits for the end of the current window, not a whole interval
+            self.schedule(self.window_start + self.interval, now)
+
+    def schedule(self, due, now):
+        self.due = due
+        self.source = event_loop.timeout_add(max(0.1, (due - now) * 1000), self.drain_due)
+
+    def take_slot(self, now):
+        if now - self.window_start >= self.interval:
+            self.window_start = now
+            self.window_sent = 0
+        if self.window_sent < self.reports_per_interval:
+            self.window_sent += 1
+            return True
+        return False
+
+    def drain_due(self):
+        # the deadline opens the next window, even when the timer fired a little early
+        self.window_start = self.due
+        self.window_sent = 0
+        if self.drain():
+            # one interval after the window opened, however long the drain took;
+            # a drain later than a whole interval opens its window when it runs,
+            # so the queue is not sent in a burst to catch up
+            self.schedule(self.window_start + self.interval, time.monotonic())
+        return False
+
+    def drain(self):
+        while self.queue and self.take_slot(time.monotonic()):
+            report, submitted = self.queue.popleft()
+            self.sent += 1
+            self.send(report)
+            self.latencies.append(time.monotonic() - submitted)
+        if self.queue:
+            return True
+        self.source = None
+        self.idle()
+        return False
+
+    def backlog(self):
+        return len(self.queue)
+
+    def when_idle(self, callback):
+        """
+        Calls callback once every queued report has been sent.
+        """
+        if self.queue:
+            self.idle_callbacks.append(callback)
+        else:
+            callback()
+
+    def idle(self):
+        callbacks, self.idle_callbacks = self.idle_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def clear(self):
+        """
+        Drops the queued reports, e.g. when the host unsubscribed.
+        """
+        if tracer.enabled:
+            tracer.discard(report for report, submitted in self.queue)
+        self.queue.clear()
+        self.idle_callbacks.clear()
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+            self.source = None
+
+    def stats(self):
+        return {"sent": self.sent, "delayed": self.delayed, "queued": len(self.queue), "max_depth": self.max_depth,
+                "latency_ms": percentiles(self.latencies)}
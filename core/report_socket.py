@@ -0,0 +1,186 @@
+import logging
+import os
+import socket
+import time
+
+from core.config import config
+from core.event_loop import event_loop
+from core.hid_descriptor import REPORT_LENGTH
+from core.tracing import tracer
+
+DEFAULT_PATH = "/run/ble-hid-keyboard/reports.sock"
+DEFAULT_MAX_BACKLOG = 64
+BUFFER_SIZE = 64 * 1024
+# longest frame: a length byte and a full report
+FRAME_LENGTH = 1 + REPORT_LENGTH
+# how often a throttled connection checks whether the backlog has drained, in ms
+THROTTLE_POLL_MS = 5
+
+
+class ReportConnection:
+    """
+    One client of the report socket.
+
+    The stream is a sequence of frames, a length byte followed by a boot
+    keyboard report of 1 to REPORT_LENGTH bytes; the bytes a shorter report
+    leaves out are zero, i.e. its remaining keys are released. Every recv
+    lands in the same buffer and all complete frames in it are parsed in
+    place: full reports are handed on as views of the buffer, which the
+    input path reads before the next recv, and only shorter reports and an
+    incomplete trailing frame are copied.
+    """
+
+    def __init__(self, server, sock, name):
+        self.server = server
+        self.sock = sock
+        self.name = name
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.end = 0
+        self.source = None
+        self.received = 0
+        self.reports = 0
+        self.invalid = 0
+        self.throttled = 0
+        self.connected = time.monotonic()
+
+    def watch(self):
+        self.source = event_loop.io_add_watch(self.sock.fileno(), self.readable)
+
+    def readable(self):
+        room = self.server.max_backlog - self.server.backlog()
+        if room <= 0:
+            # stop reading: the kernel buffer fills up and the sender blocks
+            self.throttled += 1
+            self.source = event_loop.timeout_add(THROTTLE_POLL_MS, self.drained)
+            return False
+        try:
+            # never take more reports than the scheduler has room for
+            size = self.sock.recv_into(self.view[self.end:self.end + room * FRAME_LENGTH])
+        except BlockingIOError:
+            return True
+        except OSError as error:
+            logging.info(f"{self.name}: {error}")
+            size = 0
+        if not size:
+            self.source = None
+            self.server.close(self)
+            return False
+        self.received += size
+        self.end += size
+        self.parse(time.monotonic() if tracer.enabled else 0.0)
+        return True
+
+    def drained(self):
+        if self.server.backlog() >= self.server.max_backlog:
+            return True
+        self.watch()
+        return False
+
+    def parse(self, wakeup):
+        buffer = self.buffer
+        view = self.view
+        end = self.end
+        position = 0
+        items = []
+        while position < end:
+            length = buffer[position]
+            frame_end = position + 1 + length
+            if frame_end > end:
+                break
+            if length == REPORT_LENGTH:
+                items.append((self.name, view[position + 1:frame_end], wakeup, wakeup))
+            elif 0 < length < REPORT_LENGTH:
+                report = bytes(view[position + 1:frame_end]) + bytes(REPORT_LENGTH - length)
+                items.append((self.name, report, wakeup, wakeup))
+            else:
+                self.invalid += 1
+            position = frame_end
+        if items:
+            self.reports += len(items)
+            # the reports are views of the buffer, they are read before it is compacted
+            self.server.handler(items)
+        if position:
+            buffer[:end - position] = bytes(view[position:end])
+            self.end = end - position
+
+    def stats(self):
+        return {"bytes": self.received, "reports": self.reports, "invalid": self.invalid,
+                "throttled": self.throttled, "seconds": time.monotonic() - self.connected}
+
+    def close(self):
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+            self.source = None
+        self.view.release()
+        self.sock.close()
+
+
+class ReportSocketServer:
+    """
+    Unix socket other processes feed keyboard reports into.
+
+    Every connection is a keyboard of its own to the rest of the input path:
+    its reports are handed to Keyboards.on_reports in batches, one batch per
+    recv, and go through the same filtering, merging and scheduling as
+    reports read from hidraw. A connection is not read while the report
+    scheduler has more than max_backlog reports queued.
+    """
+
+    def __init__(self, keyboards, path=None, max_backlog=None):
+        self.keyboards = keyboards
+        self.handler = keyboards.on_reports
+        self.path = path or config.get("Socket", "path", DEFAULT_PATH)
+        self.max_backlog = max_backlog or config.get_int("Socket", "max_backlog", DEFAULT_MAX_BACKLOG)
+        self.backlog = lambda: 0
+        self.sock = None
+        self.source = None
+        self.connections = {}
+        self.accepted = 0
+
+    def start(self):
+        if self.sock is not None:
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self.sock.listen()
+        self.sock.setblocking(False)
+        self.source = event_loop.io_add_watch(self.sock.fileno(), self.accept)
+        logging.info(f"Listening for reports on {self.path}")
+
+    def accept(self):
+        try:
+            sock, _ = self.sock.accept()
+        except BlockingIOError:
+            return True
+        sock.setblocking(False)
+        self.accepted += 1
+        connection = ReportConnection(self, sock, f"socket:{self.accepted}")
+        self.connections[connection.name] = connection
+        self.keyboards.attach_source(connection.name)
+        connection.watch()
+        logging.info(f"{connection.name} connected")
+        return True
+
+    def close(self, connection):
+        self.connections.pop(connection.name, None)
+        self.keyboards.detach_source(connection.name)
+        logging.info(f"{connection.name} disconnected: {connection.stats()}")
+        connection.close()
+
+    def stop(self):
+        for connection in list(self.connections.values()):
+            self.close(connection)
+        if self.source is not None:
+            event_loop.source_remove(self.source)
+            self.source = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            os.unlink(self.path)
+
+    def stats(self):
+        return {name: connection.stats() for name, connection in self.connections.items()}
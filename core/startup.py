@@ -0,0 +1,54 @@
+"""
+Startup phase timeline.
+
+Phases are timed from the start of the process, interpreter startup included,
+and also reported as time since boot, which is what matters when the keyboard
+has to come back after a reboot. Each phase is recorded when it is first
+reached.
+"""
+import logging
+import os
+import time
+
+PHASES = ("import", "bus connect", "adapter ready", "GATT registered", "advertising", "first connection")
+
+
+def process_start():
+    """
+    Start of this process on the CLOCK_BOOTTIME clock, in seconds.
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+
+class StartupTimeline:
+
+    def __init__(self):
+        self.start = process_start()
+        self.marks = {}
+
+    def mark(self, phase):
+        if phase in self.marks:
+            return
+        now = time.clock_gettime(time.CLOCK_BOOTTIME)
+        self.marks[phase] = now - self.start
+        logging.info(f"Startup: {phase} at {self.marks[phase] * 1000:.0f} ms, {now:.1f} s after boot")
+        if len(self.marks) == len(PHASES):
+            self.print()
+
+    def print(self):
+        logging.info("Startup timeline: " + ", ".join(f"{phase} {self.marks[phase] * 1000:.0f} ms"
+                                                      for phase in PHASES if phase in self.marks))
+
+    def stats(self):
+        """
+        {phase: ms since process start}
+        """
+        return {phase: seconds * 1000 for phase, seconds in self.marks.items()}
+
+
+startup = StartupTimeline()
@@ -0,0 +1,217 @@
+import logging
+import time
+
+from core.config import config
+from core.event_loop import event_loop
+from core.keyboard_layouts import LAYOUTS, DEFAULT_LAYOUT, KEY_ENTER, KEY_ESCAPE, KEY_BACKSPACE, KEY_TAB, \
+    KEY_SPACE
+
+RELEASE = bytes(8)
+
+MODIFIERS = {
+    "CTRL": 0x01, "SHIFT": 0x02, "ALT": 0x04, "GUI": 0x08,
+    "RCTRL": 0x10, "RSHIFT": 0x20, "RALT": 0x40, "ALTGR": 0x40, "RGUI": 0x80,
+}
+
+NAMED_KEYS = {
+    "ENTER": KEY_ENTER, "ESC": KEY_ESCAPE, "BACKSPACE": KEY_BACKSPACE, "TAB": KEY_TAB, "SPACE": KEY_SPACE,
+    "CAPSLOCK": 0x39, "PRINTSCREEN": 0x46, "SCROLLLOCK": 0x47, "PAUSE": 0x48, "INSERT": 0x49, "HOME": 0x4a,
+    "PAGEUP": 0x4b, "DELETE": 0x4c, "END": 0x4d, "PAGEDOWN": 0x4e, "RIGHT": 0x4f, "LEFT": 0x50, "DOWN": 0x51,
+    "UP": 0x52, "MENU": 0x65,
+}
+NAMED_KEYS.update({f"F{n}": 0x3a + n - 1 for n in range(1, 13)})
+
+
+class ReportSequence:
+    """
+    Press reports with the releases the host needs to see every key press.
+
+    A press directly replaces the previous one when they share no key: the
+    host sees the old key released and the new one pressed in one report, so
+    text takes one report per character. A release is inserted only before a
+    character on the same key as the previous one, e.g. the second "l" of
+    "hello" or "aA".
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.last = RELEASE
+        self.characters = 0
+
+    def press(self, report):
+        if report[2] == self.last[2]:
+            self.steps.append(RELEASE)
+        self.steps.append(report)
+        self.last = report
+
+    def release(self):
+        if self.last != RELEASE:
+            self.steps.append(RELEASE)
+            self.last = RELEASE
+
+    def delay(self, ms):
+        self.release()
+        self.steps.append(ms)
+
+    def text(self, text, layout):
+        for character in text:
+            report = layout.get(character)
+            if report is None:
+                raise ValueError(f"Character {character!r} is not in the keyboard layout")
+            self.press(report)
+        self.characters += len(text)
+
+    def chord(self, chord, layout):
+        modifiers = 0
+        *names, key = chord.split("+")
+        for name in names:
+            modifier = MODIFIERS.get(name.upper())
+            if modifier is None:
+                raise ValueError(f"Unknown modifier {name}")
+            modifiers |= modifier
+        usage = NAMED_KEYS.get(key.upper())
+        if usage is None:
+            report = layout.get(key) if len(key) == 1 else None
+            if report is None:
+                raise ValueError(f"Unknown key {key}")
+            modifiers |= report[0]
+            usage = report[2]
+        # a chord is always let go before whatever follows it
+        self.press(bytes([modifiers, 0, usage, 0, 0, 0, 0, 0]))
+        self.release()
+        self.characters += 1
+
+
+def get_layout(name):
+    layout = LAYOUTS.get((name or config.get("Typing", "layout", DEFAULT_LAYOUT)).lower())
+    if layout is None:
+        raise ValueError(f"Unknown keyboard layout {name}, known layouts: {', '.join(LAYOUTS)}")
+    return layout
+
+
+def compile_text(text, layout_name=None):
+    sequence = ReportSequence()
+    sequence.text(text, get_layout(layout_name))
+    sequence.release()
+    return sequence
+
+
+def compile_macro(script, layout_name=None):
+    """
+    Text with commands in braces:
+
+    {ENTER}, {F5}, {CTRL+ALT+DELETE}, {GUI+r} - press and release a key or chord
+    {DELAY 500}                             - wait 500 ms
+    {{ and }}                               - literal braces
+    """
+    layout = get_layout(layout_name)
+    sequence = ReportSequence()
+    position = 0
+    while position < len(script):
+        brace = script.find("{", position)
+        if brace < 0:
+            brace = len(script)
+        sequence.text(script[position:brace].replace("}}", "}"), layout)
+        if brace == len(script):
+            break
+        if script.startswith("{{", brace):
+            sequence.text("{", layout)
+            position = brace + 2
+            continue
+        end = script.find("}", brace)
+        if end < 0:
+            raise ValueError(f"Unterminated command at {brace}")
+        command = script[brace + 1:end].strip()
+        if command.upper().startswith("DELAY "):
+            sequence.delay(int(command[6:]))
+        else:
+            sequence.chord(command, layout)
+        position = end + 1
+    sequence.release()
+    return sequence
+
+
+class TextTyper:
+    """
+    Streams a compiled report sequence through the report scheduler.
+
+    The scheduler paces the reports to the connection interval, so text is
+    typed as fast as the link sends notifications without any being dropped.
+    done(stats) is called once the last report has been sent, failed(message)
+    when typing is cancelled.
+    """
+
+    def __init__(self, scheduler, final_report=None):
+        self.scheduler = scheduler
+        # report restoring the keys physically held once typing is over
+        self.final_report = final_report or (lambda: RELEASE)
+        self.sequence = None
+        self.position = 0
+        self.start = 0.0
+        self.done = None
+        self.failed = None
+        # timeout of a {DELAY} step
+        self.timer = None
+
+    def busy(self):
+        return self.sequence is not None
+
+    def type(self, sequence, done, failed):
+        if self.busy():
+            raise RuntimeError("Typing is in progress")
+        self.stop_timer()
+        self.sequence = sequence
+        self.position = 0
+        self.done = done
+        self.failed = failed
+        self.start = time.monotonic()
+        self.resume()
+
+    def resume(self):
+        self.timer = None
+        sequence = self.sequence
+        if sequence is None:
+            return False
+        steps = sequence.steps
+        while self.position < len(steps):
+            step = steps[self.position]
+            self.position += 1
+            if isinstance(step, int):
+                self.scheduler.when_idle(lambda: self.delay(sequence, step))
+                return False
+            self.scheduler.submit(step)
+        final = self.final_report()
+        if final != RELEASE:
+            self.scheduler.submit(final)
+        self.scheduler.when_idle(lambda: self.finished(sequence))
+        return False
+
+    def delay(self, sequence, step):
+        # the sequence may have been cancelled while its reports were sent
+        if sequence is self.sequence:
+            self.timer = event_loop.timeout_add(step, self.resume)
+
+    def stop_timer(self):
+        if self.timer is not None:
+            event_loop.source_remove(self.timer)
+            self.timer = None
+
+    def finished(self, sequence):
+        if sequence is not self.sequence:
+            return
+        elapsed = time.monotonic() - self.start
+        self.sequence = None
+        stats = {"characters": sequence.characters,
+                 "reports": sum(1 for step in sequence.steps if not isinstance(step, int)),
+                 "seconds": elapsed,
+                 "chars_per_sec": sequence.characters / elapsed if elapsed else 0.0}
+        logging.info(f"Typed {stats['characters']} characters in {elapsed:.3f} s, "
+                     f"{stats['chars_per_sec']:.0f} characters/s")
+        self.done(stats)
+
+    def cancel(self, message):
+        self.stop_timer()
+        if self.sequence is not None:
+            self.sequence = None
+            logging.info(f"Typing cancelled: {message}")
+            self.failed(message)
@@ -0,0 +1,125 @@
+import logging
+import time
+from collections import deque, OrderedDict
+
+from core.config import config
+
+STAGES = ("read", "queue", "emit", "total")
+PERCENTILES = (50, 95, 99)
+# reports traced but not sent yet; older ones are forgotten beyond this
+MAX_PENDING = 4096
+
+
+class LatencyTracer:
+    """
+    Per-stage keystroke latency, kept as rolling percentiles per device.
+
+    A report is stamped when the input reader wakes up, when its read completes,
+    when ReportCharacteristic.send is entered and when PropertiesChanged has been
+    emitted. The stages are the intervals between those stamps:
+
+    read  - input reader wakeup to read complete
+    queue - read complete to send entry (main loop handoff, filter and scheduler)
+    emit  - send entry to PropertiesChanged emitted
+    total - input reader wakeup to PropertiesChanged emitted
+
+    Reports that are never sent, because a queue was cleared or the report was
+    replaced on the way, are discarded or fall out of the pending entries
+    after MAX_PENDING newer ones. With several hosts the first send is
+    measured. When tracing is disabled the input path only checks ``enabled``.
+    """
+
+    def __init__(self, enabled=False, window=1024):
+        self.enabled = enabled
+        self.window = window
+        # {id(report): (device, wakeup, read, report)}; holding the report keeps its id unique
+        self.pending = OrderedDict()
+        self.samples = {}
+        self.wakeup = 0.0
+        self.read = 0.0
+        self.device = None
+
+    def stamp(self, device, wakeup, read):
+        """
+        Device, wakeup and read complete times of the report about to be merged.
+
+        Called by ReportFilter right before it emits a report, with the stamps
+        the report was fed with, so the merged report sent next is attributed
+        to the device and read it came from.
+        """
+        self.device = device
+        self.wakeup = wakeup
+        self.read = read
+
+    def report(self, report):
+        pending = self.pending
+        pending[id(report)] = (self.device, self.wakeup, self.read, report)
+        if len(pending) > MAX_PENDING:
+            pending.popitem(last=False)
+
+    def replace(self, report, replacement):
+        """
+        Carries the stamps of report over to the report sent in its place.
+        """
+        stamps = self.pending.pop(id(report), None)
+        if stamps is not None and stamps[3] is report:
+            self.pending[id(replacement)] = stamps[:3] + (replacement,)
+
+    def discard(self, reports):
+        for report in reports:
+            stamps = self.pending.get(id(report))
+            if stamps is not None and stamps[3] is report:
+                del self.pending[id(report)]
+
+    def send_entry(self, report):
+        stamps = self.pending.pop(id(report), None)
+        if stamps is None or stamps[3] is not report:
+            return None
+        return stamps, time.monotonic()
+
+    def emitted(self, trace):
+        if trace is None:
+            return
+        end = time.monotonic()
+        (device, wakeup, read, report), send = trace
+        samples = self.samples.get(device)
+        if samples is None:
+            samples = self.samples[device] = {stage: deque(maxlen=self.window) for stage in STAGES}
+        samples["read"].append(read - wakeup)
+        samples["queue"].append(send - read)
+        samples["emit"].append(end - send)
+        samples["total"].append(end - wakeup)
+
+    def forget(self, device):
+        self.samples.pop(device, None)
+
+    def stats(self):
+        """
+        {device: {stage: {"count": n, "p50": ms, "p95": ms, "p99": ms}}}
+        """
+        result = {}
+        for device, stages in self.samples.items():
+            result[device] = {stage: percentiles(values) for stage, values in stages.items()}
+        return result
+
+    def print(self):
+        if not self.enabled:
+            logging.info("Latency tracing is disabled")
+            return
+        for device, stages in self.stats().items():
+            for stage, values in stages.items():
+                logging.info(f"{device} {stage}: " + ", ".join(f"{k}={v:.3f}" for k, v in values.items()))
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    result = {"count": float(len(ordered))}
+    for p in PERCENTILES:
+        if ordered:
+            result[f"p{p}"] = ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000
+        else:
+            result[f"p{p}"] = 0.0
+    return result
+
+
+tracer = LatencyTracer(config.get_boolean("Tracing", "enabled", False), config.get_int("Tracing", "window", 1024))
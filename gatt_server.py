@@ -2,44 +2,70 @@
 
 import logging
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(threadName)s][%(levelname)s] %(message)s",
-                    handlers=[logging.StreamHandler()])
+from core.log import setup_logging
 
-import dbus.mainloop.glib
-import dbus.service
+setup_logging()
 
-import time
-
-from gi.repository import GLib
-
-from core.advertisement import register_advertisement
-from core.agent import register_agent
-from core.ble_dbus import find_adapter
-from core.ble_hid_keyboard import register_application
-from core.bluetooth_utils import listen_to_device, enable_discovering, turn_on
 from core.config import config
+from core.event_loop import BACKEND_ASYNCIO, BACKEND_GLIB
+from core.startup import startup
 
 
 def main():
-#    time.sleep(5)
+    if config.get("Server", "backend", BACKEND_GLIB) == BACKEND_ASYNCIO:
+        from core.aio_server import run
+        exit(run())
+    run_glib()
+
+
+def run_glib():
+    import dbus.mainloop.glib
+    import dbus.service
+
+    from gi.repository import GLib
+
+    from core.advertisement import register_advertisement
+    from core.agent import register_agent
+    from core.ble_dbus import find_adapters
+    from core.ble_hid_keyboard import register_application
+    from core.bluetooth_utils import turn_on
+    from core.bluez_objects import bluez_objects, remember_pairing
+
+    startup.mark("import")
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     bus = dbus.SystemBus()
-    adapter = find_adapter(bus)
-    if not adapter:
+    startup.mark("bus connect")
+    adapters = find_adapters(bus)
+    if not adapters:
         logging.error('GattManager1 interface not found')
         exit(-1)
+    logging.info(f"Serving adapters: {', '.join(adapters)}")
 
     mainloop = GLib.MainLoop()
-    turn_on(bus)
-    listen_to_device(bus)
-
     discoverable = not config.get_boolean("Bluetooth", "paired")
     if discoverable:
-        register_agent(adapter, bus)
+        bluez_objects.listeners.append(remember_pairing)
+    config.watch_file()
+
+    # none of these wait for BlueZ: every adapter is powered on, its
+    # application and the agent registered at once, and each advertisement
+    # is registered as soon as its adapter is powered
+    def advertise(adapter, index):
+        def powered():
+            startup.mark("adapter ready")
+            register_advertisement(adapter, bus, discoverable, index)
 
-    register_advertisement(adapter, bus, discoverable)
-    register_application(adapter, bus, mainloop)
+        def failed(error):
+            logging.error(f"Failed to power on {adapter}: " + str(error))
+
+        turn_on(bus, adapter, reply_handler=powered, error_handler=failed)
+
+    for index, adapter in enumerate(adapters):
+        advertise(adapter, index)
+        register_application(adapter, bus, mainloop, adapters)
+    if discoverable:
+        register_agent(adapters[0], bus)
 
     mainloop.run()
 
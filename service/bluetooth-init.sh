@@ -1,7 +1,5 @@
 #! /bin/bash
+# btmgmt waits for each command to complete, no delays are needed in between
 btmgmt power off&&\
-sleep 1&&\
 btmgmt bredr off&&\
-sleep 1&&\
 btmgmt power on
-
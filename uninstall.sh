@@ -3,3 +3,4 @@ systemctl disable ble-hid-keyboard
 systemctl stop ble-hid-keyboard.service
 rm /usr/lib/systemd/system/ble-hid-keyboard.service
 rm -r /usr/lib/ble-hid-keyboard
+rm -rf /var/lib/ble-hid-keyboard